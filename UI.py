@@ -1,17 +1,22 @@
 import streamlit as st
-import pandas as pd
 import pydeck as pdk
-import os
-import pickle
-import osmnx as ox
+import numpy as np
 import random
+from build_graph import load_graph
+from edge_table import edge_node_ids, edge_paths
+from ownership import edge_segments, make_palette, path_frame
+from cache_manifest import artifact_status
+from data_cache import get_shelters
+from hazards import ST_COLS
+from instrument import admin_sidebar, span, trace_run
+from regions import get_region, missing_inputs, rank_limit, region_ranks
 
 # --- 1. パスワード認証 ---
 APP_PASSWORD = "114" 
 
 def check_password():
     if "password_correct" not in st.session_state:
-        st.title("前橋市 避難所解析システム")
+        st.title(f"{REGION['label']} 避難所解析システム")
         pwd = st.text_input("パスワードを入力してください", type="password", key="pwd_input")
         if st.button("ログイン"):
             if pwd == APP_PASSWORD:
@@ -23,72 +28,77 @@ def check_password():
     return True
 
 # --- 2. データ読み込み（キャッシュを利用） ---
-CSV_FILE = "emergency_shelter_maebashi.csv"
-GRAPH_CACHE = "maebashi_graph.graphml"
-RESULT_CACHE_DIR = "cache_results"
+# 対象地域は環境変数 SHELTER_REGION で選ぶ（regions.json。既定は前橋市）
+REGION = get_region()
+CSV_FILE = REGION["csv"]
+GRAPH_CACHE = REGION["graph"]
+RESULT_CACHE_DIR = REGION["cache_dir"]
 
 @st.cache_resource
 def load_graph_edges():
-    G = ox.load_graphml(GRAPH_CACHE)
-    edges = []
-    for u, v, data in G.edges(data=True):
-        if 'geometry' in data:
-            path = [[lon, lat] for lon, lat in data['geometry'].coords]
-        else:
-            path = [[G.nodes[u]['x'], G.nodes[u]['y']], [G.nodes[v]['x'], G.nodes[v]['y']]]
-        edges.append({"u": u, "v": v, "path": path})
-    return edges
+    # GraphML ではなく事前に書き出した道路形状テーブルを読む（入力ファイルが変わったときだけ作り直す）
+    table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+    u, v = edge_node_ids(table)
+    return {"u": u, "v": v, "table": table}
 
 def main():
     if not check_password():
         st.stop()
 
-    st.title("前橋市 避難所道路網解析（最終版）")
+    st.title(f"{REGION['label']} 避難所道路網解析（最終版）")
 
-    try:
-        df = pd.read_csv(CSV_FILE, encoding='utf-8')
-    except:
-        df = pd.read_csv(CSV_FILE, encoding='cp932')
+    missing = missing_inputs(REGION)
+    if missing:
+        st.error(f"{REGION['label']} の入力ファイルが見つかりません: {', '.join(missing)}（regions.json の設定を確認してください）")
+        st.stop()
+
+    # CSV とランキングはプロセス全体で共有し、入力が変わらない限り再実行では読み直さない
+    with span("CSV 読み込み"):
+        df = get_shelters(CSV_FILE, RESULT_CACHE_DIR)
 
     # --- サイドバー設定 ---
     st.sidebar.header("表示条件")
-    ST_COLS = {
-        "洪水": "flood", "崖崩れ...": "landslides_debrisflow_medslides",
-        "高潮": "storm_surge", "地震": "earthquake", "津波": "tsunami",
-        "大規模な火事": "largescale_fire", "内水氾濫": "inlandflooding", "火山現象": "volcanic_phenomena"
-    }
     selected_label = st.sidebar.selectbox("災害種類", list(ST_COLS.keys()))
     disaster_col = ST_COLS[selected_label]
     active_shelters = df[df[disaster_col] == True].copy()
     
-    n_rank = st.sidebar.number_input(f"何番目に近い施設 (n)", 1, len(active_shelters), 1)
+    max_n = rank_limit(REGION, len(active_shelters))
+    n_rank = st.sidebar.number_input(f"何番目に近い施設 (n)", 1, max_n, 1)
+    if max_n < len(active_shelters):
+        st.sidebar.caption(f"この地域は分割して計算しているため、n は {max_n} までです。")
+    admin_sidebar()
 
     # --- データの準備 ---
-    cache_path = os.path.join(RESULT_CACHE_DIR, f"full_ranks_{disaster_col}.pkl")
-    if not os.path.exists(cache_path):
-        st.error("解析データ(.pkl)が見つかりません。")
+    # 目録のハッシュと今の入力を照合する（ランキング本体は読まない）
+    with span("キャッシュの状態確認"):
+        status = artifact_status(f"ranks_{disaster_col}", df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+    if status == "stale":
+        st.error("解析データが現在の道路グラフ・避難所データと一致しません。python build_cache.py で更新してください。")
+        return
+    if status == "unknown":
+        st.warning("解析データの作成元が記録されていません。python build_cache.py での更新をおすすめします。")
+    with span("ランキング読み込み"):
+        store = region_ranks(REGION, disaster_col)
+    if store is None:
+        st.error("解析データが見つかりません。")
         return
 
     with st.spinner("地図を構築中..."):
-        all_edges = load_graph_edges()
-        with open(cache_path, 'rb') as f:
-            node_rankings = pickle.load(f)
+        with span("道路形状の読み込み"):
+            all_edges = load_graph_edges()
         
         random.seed(42)
         color_map = {idx: [random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)] 
                      for idx in active_shelters.index}
 
-        path_data = []
-        for edge in all_edges:
-            ranks = node_rankings.get(edge['u'], [])
-            if len(ranks) >= n_rank:
-                print(f"Node {edge['u']}only has {len(ranks)} shelters in its list.")
-                owner_id = ranks[n_rank-1]
-                if owner_id in color_map:
-                    path_data.append({
-                        "path": edge['path'],
-                        "color": color_map[owner_id]
-                    })
+        # 全道路の持ち主と色をまとめて求める（両端の持ち主が異なる道路は切り替え位置で分割する）
+        with span("持ち主と色の計算"):
+            segments = edge_segments(
+                all_edges['table'], store.owner(n_rank), store.distance(n_rank),
+                store.node_index(all_edges['u']), store.node_index(all_edges['v'])
+            )
+            colors = make_palette(color_map, len(df))[segments['owner']]
+            path_data = path_frame(edge_paths(segments), colors, np.isin(segments['owner'], active_shelters.index))
         
         shelter_data = []
         for idx, row in active_shelters.iterrows():
@@ -105,7 +115,7 @@ def main():
         "PathLayer",
         path_data,
         get_path="path",
-        get_color="color",
+        get_color="[r, g, b]",
         width_min_pixels=2,
         pickable=False, 
     )
@@ -125,21 +135,24 @@ def main():
         pickable=True,
     )
 
-    view_state = pdk.ViewState(latitude=36.3895, longitude=139.0634, zoom=12)
+    view_state = pdk.ViewState(latitude=REGION["center"][0], longitude=REGION["center"][1], zoom=REGION["zoom"])
 
     # デックの描画
-    st.pydeck_chart(pdk.Deck(
-        layers=[path_layer, shelter_layer],
-        initial_view_state=view_state,
-        map_style="mapbox://styles/mapbox/light-v9",
-        # 施設(ScatterplotLayer)だけに反応するツールチップ設定
-        tooltip={
-            "html": "<b>施設名:</b> {name}",
-            "style": {"color": "white"}
-        }
-    ))
+    with span("地図の描画 (pydeck)"):
+        st.pydeck_chart(pdk.Deck(
+            layers=[path_layer, shelter_layer],
+            initial_view_state=view_state,
+            map_style="mapbox://styles/mapbox/light-v9",
+            # 施設(ScatterplotLayer)だけに反応するツールチップ設定
+            tooltip={
+                "html": "<b>施設名:</b> {name}",
+                "style": {"color": "white"}
+            }
+        ))
 
     st.success(f"表示完了: {selected_label} (n={n_rank})")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 環境変数 SHELTER_PROFILE または管理者メニューで有効にすると、区間ごとの処理時間を表示・記録する
+    with trace_run("UI"):
+        main()
\ No newline at end of file
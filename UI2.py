@@ -1,18 +1,31 @@
 import streamlit as st
 import pandas as pd
 import pydeck as pdk
+import numpy as np
 import os
-import pickle
-import osmnx as ox
 import random
-from collections import Counter
+from build_graph import load_graph
+from edge_table import edge_node_ids
+from ownership import coverage_meters, edge_owners, edge_ownership, edge_segments, make_palette
+from catchments import LEVELS, feature_collection, get_catchments
+from analytics import (
+    BANDS, POPULATION_FILE, PopulationModel, band_labels, coverage_stats, population_key, read_population,
+)
+from cache_manifest import artifact_status
+from data_cache import artifact_key, get_shelters
+from closures import ClosureModel, circle, edges_in_polygon, scenario_store
+from capacity import assign_with_capacity, default_capacity, node_demand, shelter_capacity
+from hazards import ALL_SHELTERS, ST_COLS, eligible_shelters, hazard_mask, shelter_bits
+from instrument import admin_sidebar, span, trace_run
+from rank_store import NO_SHELTER, load_distances
+from regions import get_region, is_partitioned, missing_inputs, rank_limit, region_ranks
 
 # --- 1. パスワード認証 ---
 APP_PASSWORD = "114" 
 
 def check_password():
     if "password_correct" not in st.session_state:
-        st.title("前橋市 避難所解析システム")
+        st.title(f"{REGION['label']} 避難所解析システム")
         pwd = st.text_input("パスワードを入力してください", type="password", key="pwd_input")
         if st.button("ログイン"):
             if pwd == APP_PASSWORD:
@@ -24,49 +37,86 @@ def check_password():
     return True
 
 # --- 設定 ---
-CSV_FILE = "emergency_shelter_maebashi.csv"
-GRAPH_CACHE = "maebashi_graph.graphml"
-RESULT_CACHE_DIR = "cache_results"
+# 対象地域は環境変数 SHELTER_REGION で選ぶ（regions.json。既定は前橋市）
+REGION = get_region()
+CSV_FILE = REGION["csv"]
+GRAPH_CACHE = REGION["graph"]
+RESULT_CACHE_DIR = REGION["cache_dir"]
+POPULATION = REGION.get("population", POPULATION_FILE)  # 人口メッシュの CSV（なければ人口の集計を省く）
 
 @st.cache_resource
 def load_graph_edges():
-    if not os.path.exists(GRAPH_CACHE):
+    # GraphML ではなく事前に書き出した道路形状テーブルを読む（入力ファイルが変わったときだけ作り直す）
+    table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+    if table is None:
         st.error(f"グラフファイル {GRAPH_CACHE} が見つかりません。")
-        return []
-    G = ox.load_graphml(GRAPH_CACHE)
-    edges = []
-    for u, v, data in G.edges(data=True):
-        if 'geometry' in data:
-            path = [[lon, lat] for lon, lat in data['geometry'].coords]
-        else:
-            path = [[G.nodes[u]['x'], G.nodes[u]['y']], [G.nodes[v]['x'], G.nodes[v]['y']]]
-        edges.append({"u": u, "v": v, "path": path})
-    return edges
+        return {"u": np.empty(0, dtype=np.int64), "v": np.empty(0, dtype=np.int64), "table": None}
+    u, v = edge_node_ids(table)
+    return {"u": u, "v": v, "table": table}
+
+@st.cache_resource
+def load_closure_model(cache_dir):
+    # 通行止めの想定に使う逆向きの辺リストと距離行列（1度だけ用意する）
+    table = load_graph(GRAPH_CACHE, cache_dir)
+    distances = load_distances(cache_dir)
+    if table is None or distances is None:
+        return None
+    return ClosureModel(table, distances)
+
+@st.cache_resource
+def load_population_model(path, source_key):
+    # メッシュの人口を道路ノードに割り当てる（人口ファイルが変わったときだけやり直す）
+    return PopulationModel(load_graph_edges()['table'], read_population(path), list(source_key))
+
+def parse_points(text):
+    """「緯度,経度」を1行に1つ書いたテキストを [(緯度, 経度), ...] にする（読めない行は無視）"""
+    points = []
+    for line in text.splitlines():
+        try:
+            lat, lon = (float(x) for x in line.replace("、", ",").split(","))
+        except ValueError:
+            continue
+        points.append((lat, lon))
+    return points
 
 def main():
     if not check_password():
         st.stop()
 
-    st.title("前橋市 避難所【ネットワークボロノイ図解析】")
+    st.title(f"{REGION['label']} 避難所【ネットワークボロノイ図解析】")
+
+    missing = missing_inputs(REGION)
+    if missing:
+        st.error(f"{REGION['label']} の入力ファイルが見つかりません: {', '.join(missing)}（regions.json の設定を確認してください）")
+        st.stop()
 
     # --- データの読み込み ---
-    try:
-        df = pd.read_csv(CSV_FILE, encoding='utf-8')
-    except:
-        df = pd.read_csv(CSV_FILE, encoding='cp932')
+    # CSV とランキングはプロセス全体で共有し、入力が変わらない限り再実行では読み直さない
+    with span("CSV 読み込み"):
+        df = get_shelters(CSV_FILE, RESULT_CACHE_DIR)
 
     # --- サイドバー設定 ---
     st.sidebar.header("解析条件")
-    ST_COLS = {
-        "洪水": "flood", "崖崩れ、土石流及び地滑り": "landslides_debrisflow_mudslides",
-        "高潮": "storm_surge", "地震": "earthquake", "津波": "tsunami",
-        "大規模な火事": "largescale_fire", "内水氾濫": "inlandflooding", "火山現象": "volcanic_phenomena"
-    }
-    selected_label = st.sidebar.selectbox("災害種類", list(ST_COLS.keys()))
-    disaster_col = ST_COLS[selected_label]
-    
-    # 災害種別でフィルタリング
-    active_shelters_all = df[df[disaster_col] == True].copy()
+    selected_labels = st.sidebar.multiselect(
+        "災害種類（複数選ぶと、すべてに対応する避難所だけで数える）", list(ST_COLS.keys()),
+        default=list(ST_COLS.keys())[:1],
+    )
+    if not selected_labels:
+        st.info("災害種類を選んでください。")
+        st.stop()
+    selected_label = "・".join(selected_labels)
+    disaster_cols = [ST_COLS[label] for label in selected_labels]
+
+    # 災害種別でフィルタリング（避難所ごとの災害のビット列に、選んだ災害のビットがすべて立っているもの）
+    active_shelters_all = df.iloc[eligible_shelters(shelter_bits(df), hazard_mask(disaster_cols))].copy()
+    # 1種類ならその災害のランキングを、組み合わせなら全避難所のランキングを条件で絞って使う。
+    # 分割した地域には全避難所のランキングがないので、選んだ中で避難所の最も少ない災害のランキングを絞る
+    if len(disaster_cols) == 1:
+        disaster_col = disaster_cols[0]
+    elif is_partitioned(REGION):
+        disaster_col = min(disaster_cols, key=lambda col: int((df[col] == True).sum()))
+    else:
+        disaster_col = ALL_SHELTERS
     
     # 重複を削除（名前が同じ施設は一つに統合）
     active_shelters = active_shelters_all.drop_duplicates(subset=['name']).copy()
@@ -80,26 +130,74 @@ def main():
         st.info(f"【{selected_label}】に対応可能な避難所は0件です。")
         st.stop()
 
+    # 収容上限モード: 近い順に割り当て、上限に達した施設の分は次に近い施設へ回す
+    capacity_mode = st.sidebar.checkbox("収容上限を考慮して割り当てる")
+
+    n_limit = rank_limit(REGION, max_n)
     n_rank = st.sidebar.number_input(
-        f"何番目に近い施設(n)※最大{max_n}",
+        f"何番目に近い施設(n)※最大{n_limit}",
         min_value=1,
-        max_value=max_n,
-        value=1 
+        max_value=n_limit,
+        value=1,
+        disabled=capacity_mode,
     )
+    if n_limit < max_n:
+        st.sidebar.caption(f"この地域は分割して計算しているため、n は {n_limit} までです。")
+    if capacity_mode:
+        n_rank = 1
+        cap_value = st.sidebar.number_input(
+            "1施設あたりの収容上限（担当道路数）※CSVに capacity 列があればそちらを優先",
+            min_value=1,
+            value=int(default_capacity(len(load_graph_edges()['u']), len(active_ids_all))),
+        )
+
+    # 通行止めの想定: 指定した地点の周囲の道路を通れないものとして、影響範囲だけ計算し直す
+    st.sidebar.header("通行止めの想定")
+    closure_points = parse_points(st.sidebar.text_area("通行止め地点（緯度,経度 を1行に1つ）", ""))
+    closure_radius = st.sidebar.number_input("通行止めの半径 [m]", min_value=10, max_value=2000, value=100)
+
+    # 地図には道路1本ずつではなく、施設ごとにまとめて簡略化した担当範囲を描く
+    st.sidebar.header("地図の表示")
+    detail = st.sidebar.select_slider("表示の詳細度", options=list(LEVELS.keys()), value="mid")
+    kind = "hull" if st.sidebar.radio("担当範囲の形", ["道路", "範囲（凹包）"], horizontal=True) != "道路" else "lines"
+    admin_sidebar()
 
     # --- 解析データの読み込み ---
-    cache_path = os.path.join(RESULT_CACHE_DIR, f"full_ranks_{disaster_col}.pkl")
-    if not os.path.exists(cache_path):
-        cache_path = os.path.join(RESULT_CACHE_DIR, "full_ranks_all.pkl") 
+    # 目録のハッシュと今の入力を照合する（ランキング本体は読まない）
+    with span("キャッシュの状態確認"):
+        status = artifact_status(f"ranks_{disaster_col}", df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+    if status == "stale":
+        st.error("解析データが現在の道路グラフ・避難所データと一致しません。python build_cache.py で更新してください。")
+        return
+    if status == "unknown":
+        st.warning("解析データの作成元が記録されていません。python build_cache.py での更新をおすすめします。")
+    with span("ランキング読み込み"):
+        store = region_ranks(REGION, disaster_col)
 
-    if not os.path.exists(cache_path):
-        st.error("解析用データ(.pkl)が見つかりません。")
+    if store is None:
+        if disaster_col == ALL_SHELTERS:
+            st.error("災害の組み合わせ用のランキングがありません。python build_cache.py で作成してください。")
+        else:
+            st.error("解析用データが見つかりません。")
         return
 
+    if closure_points:
+        with span("通行止めモデルの準備"):
+            model = load_closure_model(RESULT_CACHE_DIR)
+        if model is None:
+            st.warning("距離行列がないため、通行止めの想定は使えません。")
+        else:
+            with span("通行止めの再計算"):
+                closed = np.unique(np.concatenate([
+                    edges_in_polygon(model.table, circle(lat, lon, closure_radius)) for lat, lon in closure_points
+                ]))
+                scenario, changed, _ = model.apply(closed)
+                store = scenario_store(store, scenario, changed, sorted(active_ids_all))
+            st.info(f"通行止め: 道路 {len(closed)} 本 / 距離が変わった地点 {int(changed.sum())} 箇所")
+
     with st.spinner("ネットワーク解析を実行中..."):
-        all_edges = load_graph_edges()
-        with open(cache_path, 'rb') as f:
-            node_rankings = pickle.load(f)
+        with span("道路形状の読み込み"):
+            all_edges = load_graph_edges()
         
         # 名前ベースで色を固定
         random.seed(42)
@@ -107,57 +205,114 @@ def main():
         name_to_color = {name: [random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)] 
                          for name in unique_names}
 
-        path_data = []
-        assigned_names_list = []
-
-        for edge in all_edges:
-            ranks = node_rankings.get(edge['u'], [])
-            filtered_ranks = [sid for sid in ranks if sid in active_ids_all]
-            
-            if len(filtered_ranks) >= n_rank:
-                owner_id = filtered_ranks[n_rank-1]
-                owner_name = df.at[owner_id, 'name']
-                
-                path_data.append({
-                    "path": edge['path'],
-                    "color": name_to_color.get(owner_name, [200, 200, 200]),
-                    "owner_name": owner_name
-                })
-                assigned_names_list.append(owner_name)
+        # 重複削除前の全IDに、施設名の色を割り当てる
+        color_map = {sid: name_to_color[df.at[sid, 'name']] for sid in active_ids_all}
+
+        # 有効な避難所だけで数えた n番目の持ち主・色・担当道路数をまとめて求める
+        with span("持ち主の計算"):
+            u_pos = store.node_index(all_edges['u'])
+            if capacity_mode:
+                cand_ids, cand_dist = store.candidates(active_ids_all, len(active_ids_all))
+                owners, _ = assign_with_capacity(
+                    cand_ids, cand_dist, node_demand(u_pos, len(store.node_ids)), shelter_capacity(df, cap_value)
+                )
+            else:
+                owners = store.owner(n_rank, allowed=active_ids_all)
+            palette = make_palette(color_map, len(df))
+            edge_owner, _, counts = edge_ownership(owners, u_pos, palette)
+        if not (np.asarray(owners) != NO_SHELTER).any():
+            # 分割した地域で災害を組み合わせると、タイルの上位K件に条件に合う施設が n件ない地点もある
+            st.warning(f"{n_rank}番目に近い施設を求められる地点がありません。n を小さくしてください。")
+            return
+        # 道路は両端の持ち主が異なれば途中の切り替え位置で分割し、担当範囲を道路延長で数える
+        with span("道路の分割"):
+            segments = edge_segments(
+                all_edges['table'], owners, store.distance_to(owners), u_pos, store.node_index(all_edges['v'])
+            )
+            meters = coverage_meters(segments, len(df))
+        # 収容上限モードでは、どの施設にも入れなかった道路も灰色（色表の最終行）の範囲として表示する
+        with span("担当範囲の図形"):
+            shown = (edge_owners(cand_ids[0], u_pos) if capacity_mode else edge_owner) != NO_SHELTER
+            draw_owner = segments['owner'].copy()
+            draw_owner[shown[segments['edge']] & (draw_owner == NO_SHELTER)] = len(df)
+            catchment_ids, geoms = get_catchments(segments, draw_owner, detail, kind)
+            catchment_data = feature_collection(catchment_ids, geoms, lambda sid: {
+                "name": df.at[sid, 'name'] if sid < len(df) else "未割り当て",
+                "r": int(palette[sid][0]), "g": int(palette[sid][1]), "b": int(palette[sid][2]),
+            })
+
+    # --- 人口の集計（人口メッシュがある場合）: 避難所ごとの担当人口と徒歩時間帯ごとの人口 ---
+    pop_stats = None
+    # 旧形式から変換したランキングには距離がないので、徒歩時間帯は数えられない（担当人口だけ表示する）
+    has_times = store.dist is not None or store.distances is not None
+    if os.path.exists(POPULATION):
+        with span("人口の集計"):
+            model = load_population_model(POPULATION, tuple(population_key(POPULATION)))
+            if capacity_mode or closure_points:
+                # 保存済みのランキングと異なる割り当てなので、キャッシュせずにその場で求める
+                pop_stats = coverage_stats(owners, store.distance_to(owners), model.node_population(store), len(df))
+            else:
+                key = None if is_partitioned(REGION) else artifact_key(disaster_col, RESULT_CACHE_DIR)
+                pop_stats = model.stats(store, n_rank, len(df), allowed=active_ids_all, key=key,
+                                        cache_dir=os.path.join(RESULT_CACHE_DIR, "analytics"))
 
     # --- 統計データの作成（名前ベース） ---
-    name_counts = Counter(assigned_names_list)
-    summary_data = []
-    for _, row in active_shelters.iterrows():
-        summary_data.append({
-            "避難所名": row['name'],
-            "担当道路数": name_counts.get(row['name'], 0)
-        })
-
-    # 【重要】ソート順を固定
-    # 第1優先：道路数（多い順）、第2優先：避難所名（あいうえお順）
-    res_df = pd.DataFrame(summary_data).sort_values(
-        by=["担当道路数", "避難所名"], 
-        ascending=[False, True]
-    )
+    with span("集計"):
+        ids = active_shelters_all.index
+        name_counts = pd.Series(counts[ids], index=df.loc[ids, 'name']).groupby(level=0).sum().to_dict()
+        name_meters = pd.Series(meters[ids], index=df.loc[ids, 'name']).groupby(level=0).sum().to_dict()
+        if pop_stats is not None:
+            name_pop = pd.DataFrame(
+                np.column_stack([pop_stats["demand"][ids], pop_stats["bands"][ids]]),
+                index=df.loc[ids, 'name'], columns=["担当人口"] + band_labels(),
+            ).groupby(level=0).sum().round().astype(int)
+            if not has_times:
+                name_pop = name_pop[["担当人口"]]
+        summary_data = []
+        for _, row in active_shelters.iterrows():
+            summary_data.append({
+                "避難所名": row['name'],
+                "担当道路延長 (km)": round(name_meters.get(row['name'], 0.0) / 1000, 2),
+                "担当道路数": name_counts.get(row['name'], 0),
+                **({} if pop_stats is None else name_pop.loc[row['name']].to_dict()),
+            })
+
+        # 【重要】ソート順を固定
+        # 第1優先：道路延長（長い順）、第2優先：避難所名（あいうえお順）
+        res_df = pd.DataFrame(summary_data).sort_values(
+            by=["担当道路延長 (km)", "避難所名"], 
+            ascending=[False, True]
+        )
 
-    # インデックスを 1, 2, 3... に振り直して「順位」として見せる
-    res_df = res_df.reset_index(drop=True)
-    res_df.index = res_df.index + 1
+        # インデックスを 1, 2, 3... に振り直して「順位」として見せる
+        res_df = res_df.reset_index(drop=True)
+        res_df.index = res_df.index + 1
 
-    num_assigned_unique = len([name for name, count in name_counts.items() if count > 0])
+        num_assigned_unique = len([name for name, length in name_meters.items() if length > 0])
 
     # --- メトリクス表示 ---
     col1, col2 = st.columns(2)
     col1.metric("有効な施設総数", f"{max_n} 箇所")
     col2.metric("道路をカバー中の施設数", f"{num_assigned_unique} 箇所")
+    if capacity_mode:
+        st.metric("収容しきれない道路数", f"{int((shown & (edge_owner == NO_SHELTER)).sum())} 本")
+    if pop_stats is not None and has_times:
+        # n番目の施設までの徒歩時間で数える（n=1 なら最寄りの施設まで）
+        total = pop_stats["total"]
+        within = total[len(BANDS) - 1]
+        col3, col4 = st.columns(2)
+        col3.metric(f"{BANDS[-1]}分以内に歩いて行ける人口", f"{within:,.0f} 人",
+                    f"{within / max(total[len(BANDS) - 1:].sum(), 1) * 100:.1f} %", delta_color="off")
+        col4.metric(f"{BANDS[-1]}分を超える・到達できない人口", f"{total[len(BANDS):].sum():,.0f} 人")
 
     # --- Pydeck描画 ---
-    view_state = pdk.ViewState(latitude=36.3895, longitude=139.0634, zoom=12)
+    view_state = pdk.ViewState(latitude=REGION["center"][0], longitude=REGION["center"][1], zoom=REGION["zoom"])
     
-    path_layer = pdk.Layer(
-        "PathLayer", path_data, get_path="path", get_color="color",
-        width_min_pixels=2, pickable=False,
+    catchment_layer = pdk.Layer(
+        "GeoJsonLayer", catchment_data,
+        get_line_color="[properties.r, properties.g, properties.b]",
+        get_fill_color="[properties.r, properties.g, properties.b, 90]",
+        filled=kind == "hull", stroked=True, line_width_min_pixels=2, pickable=False,
     )
 
     shelter_layer_data = [{
@@ -171,22 +326,26 @@ def main():
         get_fill_color="fill_color", get_radius=100, radius_min_pixels=8, pickable=True,
     )
 
-    st.pydeck_chart(pdk.Deck(
-        layers=[path_layer, shelter_layer],
-        initial_view_state=view_state,
-        map_style="mapbox://styles/mapbox/light-v9",
-        tooltip={"html": "<b>施設名:</b> {name}"}
-    ))
+    with span("地図の描画 (pydeck)"):
+        st.pydeck_chart(pdk.Deck(
+            layers=[catchment_layer, shelter_layer],
+            initial_view_state=view_state,
+            map_style="mapbox://styles/mapbox/light-v9",
+            tooltip={"html": "<b>施設名:</b> {name}"}
+        ))
 
     # --- 結果表示 ---
-    st.subheader("避難所別の担当道路数")
-    st.dataframe(res_df, use_container_width=True)
+    st.subheader("避難所別の担当道路延長")
+    with span("表の表示"):
+        st.dataframe(res_df, use_container_width=True)
 
     # 担当0の警告
-    zero_shelters = res_df[res_df["担当道路数"] == 0]
+    zero_shelters = res_df[res_df["担当道路延長 (km)"] == 0]
     if not zero_shelters.empty:
         st.warning(f"以下の施設は、n={n_rank} の条件で担当エリアを持ちません：")
         st.write(", ".join(zero_shelters["避難所名"].tolist()))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 環境変数 SHELTER_PROFILE または管理者メニューで有効にすると、区間ごとの処理時間を表示・記録する
+    with trace_run("UI2"):
+        main()
\ No newline at end of file
@@ -0,0 +1,260 @@
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from rank_store import NO_SHELTER, RESULT_CACHE_DIR
+
+# --- 人口で重み付けした担当範囲と徒歩時間の分析 ---
+# 手元の人口メッシュ（国勢調査の地域メッシュ統計など）を読み込み、各メッシュの人口を最寄りの道路ノードに
+# KD 木で一括して割り当てる。ノードごとの人口と「n番目の避難所までの道路距離」から、避難所ごとの
+# 担当人口と徒歩時間帯（5 / 10 / 20 / 30 分以内・30 分超・到達できない）ごとの人口を求める。
+# 人口ファイルは次のどちらかの CSV:
+#   - 地域メッシュコードの列 (KEY_CODE など) と人口の列を持つもの（1次〜1/8 メッシュに対応）
+#   - lat, lon 列と人口の列を持つもの（任意の格子の中心点）
+# 結果は (災害種類, n) ごとにプロセス内の LRU と cache_results/analytics/ に保存し、
+# ランキング・人口ファイルが変わらない限り計算し直さない。
+
+POPULATION_FILE = "population_mesh.csv"
+ANALYTICS_DIR = os.path.join(RESULT_CACHE_DIR, "analytics")
+WALK_SPEED = 80.0  # 徒歩の速さ [m/分]
+BANDS = (5, 10, 20, 30)  # 徒歩時間帯の区切り [分]
+MAX_SNAP = 1000.0  # メッシュの中心から道路ノードまでの直線距離がこれを超える人口は割り当てない [m]
+MESH_COLS = ("KEY_CODE", "key_code", "mesh", "meshcode", "mesh_code", "メッシュコード")
+POPULATION_COLS = ("population", "pop", "人口", "人口総数")
+MAX_CACHED = 64
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+
+
+def band_labels():
+    """徒歩時間帯の列名"""
+    return [f"{b}分以内" for b in BANDS] + [f"{BANDS[-1]}分超", "到達不可"]
+
+
+# --- 人口ファイルの読み込み ---
+def decode_mesh(codes):
+    """地域メッシュコード (JIS X 0410) の配列を、各メッシュの中心の (緯度, 経度) に変換する
+
+    1次 (4桁)・2次 (6桁)・3次 (8桁)・1/2 (9桁)・1/4 (10桁)・1/8 (11桁) メッシュに対応する。
+    """
+    codes = np.asarray(codes).astype(str)
+    digits = np.char.str_len(codes)
+    # 桁ごとの数字の (メッシュ数, 11) 行列（短いコードは 0 で埋める）
+    table = np.char.ljust(codes, 11, '0').astype('U11').view('U1').reshape(-1, 11).astype(np.int64)
+    lat = np.zeros(len(codes))
+    lon = np.zeros(len(codes))
+    height = np.full(len(codes), 40 / 60)  # メッシュの南北の大きさ [度]
+    width = np.ones(len(codes))  # 東西の大きさ [度]
+
+    def part(start, stop):
+        return table[:, start:stop] @ (10 ** np.arange(stop - start - 1, -1, -1))
+
+    lat += part(0, 2) / 1.5
+    lon += part(2, 4) + 100
+    for start, stop, rows, cols in ((4, 6, 8, 8), (6, 8, 10, 10)):
+        has = digits >= stop
+        rc = part(start, stop)
+        height = np.where(has, height / rows, height)
+        width = np.where(has, width / cols, width)
+        lat += np.where(has, rc // 10 * height, 0)
+        lon += np.where(has, rc % 10 * width, 0)
+    # 1/2・1/4・1/8 メッシュ: 1=南西, 2=南東, 3=北西, 4=北東
+    for pos in (8, 9, 10):
+        has = digits > pos
+        q = part(pos, pos + 1)
+        height = np.where(has, height / 2, height)
+        width = np.where(has, width / 2, width)
+        lat += np.where(has & (q >= 3), height, 0)
+        lon += np.where(has & ((q == 2) | (q == 4)), width, 0)
+    return lat + height / 2, lon + width / 2
+
+
+def _pick(columns, candidates):
+    for col in candidates:
+        if col in columns:
+            return col
+    return None
+
+
+def read_population(path=POPULATION_FILE, column=None):
+    """人口ファイルを (lat, lon, population) の DataFrame として読む
+
+    column を省略すると POPULATION_COLS の列、なければ e-Stat の統計表の最初の項目 (T で始まる列) を使う。
+    """
+    try:
+        raw = pd.read_csv(path, encoding='utf-8', dtype=str)
+    except UnicodeDecodeError:
+        raw = pd.read_csv(path, encoding='cp932', dtype=str)
+    column = column or _pick(raw.columns, POPULATION_COLS) or next(
+        (c for c in raw.columns if c.startswith("T") and c[1:].isdigit()), None)
+    if column is None:
+        raise ValueError(f"{path} に人口の列が見つかりません")
+
+    mesh_col = _pick(raw.columns, MESH_COLS)
+    if mesh_col is not None:
+        # e-Stat の CSV は2行目が項目名の説明なので、メッシュコードが数字の行だけ使う
+        raw = raw[raw[mesh_col].str.fullmatch(r"\d{4,11}", na=False)]
+        lat, lon = decode_mesh(raw[mesh_col].to_numpy())
+    else:
+        lat, lon = raw['lat'].astype(float).to_numpy(), raw['lon'].astype(float).to_numpy()
+    # 秘匿値 ("*" など) や空欄は 0 人として扱う
+    population = pd.to_numeric(raw[column], errors='coerce').fillna(0.0).to_numpy(dtype=np.float64)
+    return pd.DataFrame({"lat": lat, "lon": lon, "population": population})
+
+
+def population_key(path):
+    """人口ファイルを識別するキー（ファイルが変わると変わる）"""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def assign_population(locator, population_df, n_nodes, max_snap=MAX_SNAP):
+    """各メッシュの人口を最寄りの道路ノードに集計し、(ノードごとの人口, 割り当てられなかった人口) を返す
+
+    locator はノード位置 (0..n_nodes-1) を返す NodeLocator。
+    """
+    pos, snap = locator.nearest(population_df['lat'].to_numpy(), population_df['lon'].to_numpy())
+    population = population_df['population'].to_numpy(dtype=np.float64)
+    ok = snap <= max_snap
+    node_pop = np.bincount(np.asarray(pos)[ok], weights=population[ok], minlength=n_nodes)
+    return node_pop, float(population[~ok].sum())
+
+
+# --- 担当人口と徒歩時間帯 ---
+def coverage_stats(owners, dist, node_pop, size, speed=WALK_SPEED):
+    """避難所IDごとの担当人口と徒歩時間帯ごとの人口を求める
+
+    owners, dist はノードごとの担当避難所ID と、その避難所までの道路距離 [m]（到達できなければ inf）。
+    戻り値は {"demand": (size,), "bands": (size, 時間帯数), "total": (時間帯数,)}。
+    bands の最後の2列は「最後の区切りを超える」「到達できない」人口で、到達できないノードの人口は
+    担当のない行として total にだけ数える。
+    """
+    owners = np.asarray(owners)
+    node_pop = np.asarray(node_pop, dtype=np.float64)
+    minutes = np.full(len(owners), np.inf) if dist is None else np.asarray(dist, dtype=np.float64) / speed
+    band = np.searchsorted(np.asarray(BANDS, dtype=np.float64), minutes, side='left')
+    band[~np.isfinite(minutes) | (owners == NO_SHELTER)] = len(BANDS) + 1
+    n_bands = len(BANDS) + 2
+
+    total = np.bincount(band, weights=node_pop, minlength=n_bands)
+    has = owners != NO_SHELTER
+    flat = owners[has].astype(np.int64) * n_bands + band[has]
+    bands = np.bincount(flat, weights=node_pop[has], minlength=size * n_bands).reshape(size, n_bands)
+    # 徒歩時間帯は「以内」の累積で見せる（30 分超・到達不可は累積しない）
+    bands[:, :len(BANDS)] = np.cumsum(bands[:, :len(BANDS)], axis=1)
+    total[:len(BANDS)] = np.cumsum(total[:len(BANDS)])
+    demand = np.bincount(owners[has], weights=node_pop[has], minlength=size)
+    return {"demand": demand, "bands": bands, "total": total}
+
+
+def stats_frame(stats, shelters_df, ids=None):
+    """coverage_stats の結果を避難所ごとの表にする（ids で行を絞る）"""
+    ids = np.arange(len(shelters_df)) if ids is None else np.asarray(ids)
+    frame = pd.DataFrame(np.round(stats["bands"][ids]).astype(np.int64), columns=band_labels())
+    frame.insert(0, "担当人口", np.round(stats["demand"][ids]).astype(np.int64))
+    frame.insert(0, "避難所名", shelters_df['name'].to_numpy()[ids])
+    frame.index = ids
+    return frame
+
+
+class PopulationModel:
+    """ノードごとの人口を保持し、(災害種類, n) ごとの分析結果をキャッシュ付きで返す"""
+
+    def __init__(self, table, population_df, source_key=None, max_snap=MAX_SNAP):
+        self.table = table
+        self.population_df = population_df
+        self.max_snap = max_snap
+        self.node_ids = np.asarray(table["nodes"])
+        self.total = float(population_df['population'].sum())
+        self.source_key = source_key
+        self._assigned = None  # (ノードごとの人口, 割り当てられなかった人口)
+
+    def _assign(self):
+        # KD 木での割り当ては、保存済みの結果がなく計算が必要になったときに1度だけ行う
+        if self._assigned is None:
+            from query import NodeLocator
+            n_nodes = len(self.node_ids)
+            locator = NodeLocator(np.arange(n_nodes), self.table["x"], self.table["y"])
+            self._assigned = assign_population(locator, self.population_df, n_nodes, self.max_snap)
+        return self._assigned
+
+    @property
+    def node_pop(self):
+        return self._assign()[0]
+
+    @property
+    def unassigned(self):
+        return self._assign()[1]
+
+    def node_population(self, store):
+        """store のノードの並びに合わせたノードごとの人口"""
+        if len(store.node_ids) == len(self.node_ids) and np.array_equal(store.node_ids, self.node_ids):
+            return self.node_pop
+        pos = np.searchsorted(self.node_ids, np.asarray(store.node_ids))
+        pos = np.minimum(pos, len(self.node_ids) - 1)
+        return np.where(self.node_ids[pos] == np.asarray(store.node_ids), self.node_pop[pos], 0.0)
+
+    def stats(self, store, n, size, allowed=None, key=None, cache_dir=ANALYTICS_DIR):
+        """n番目に近い避難所を担当としたときの coverage_stats
+
+        key（ランキングを識別する data_cache.artifact_key など）を渡すと結果をキャッシュする。
+        通行止めの想定など、保存済みのランキングと異なる store では key を省略する。
+        """
+        if key is None:
+            return self._compute(store, n, size, allowed)
+        digest = hashlib.sha1(json.dumps(
+            [key, self.source_key, n, size, None if allowed is None else sorted(int(a) for a in allowed)],
+            default=str,
+        ).encode()).hexdigest()
+        with _lock:
+            if digest in _cache:
+                _cache.move_to_end(digest)
+                return _cache[digest]
+
+        path = os.path.join(cache_dir, f"{digest}.npz")
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                result = {name: saved[name] for name in saved.files}
+        else:
+            result = self._compute(store, n, size, allowed)
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path + ".tmp", 'wb') as f:
+                np.savez(f, **result)
+            os.replace(path + ".tmp", path)
+
+        with _lock:
+            _cache[digest] = result
+            while len(_cache) > MAX_CACHED:
+                _cache.popitem(last=False)
+        return result
+
+    def _compute(self, store, n, size, allowed=None):
+        owners = store.owner(n, allowed=allowed)
+        return coverage_stats(owners, store.distance_to(owners), self.node_population(store), size)
+
+
+if __name__ == "__main__":
+    # 使い方: python analytics.py [人口ファイル] [災害列] [n]
+    from build_graph import load_graph
+    from data_cache import artifact_key, get_ranks, get_shelters
+    from update_ranks import CSV_FILE, GRAPH_CACHE
+    path = sys.argv[1] if len(sys.argv) > 1 else POPULATION_FILE
+    hazard = sys.argv[2] if len(sys.argv) > 2 else "flood"
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    df = get_shelters(CSV_FILE)
+    model = PopulationModel(load_graph(GRAPH_CACHE, RESULT_CACHE_DIR), read_population(path), population_key(path))
+    store = get_ranks(hazard, RESULT_CACHE_DIR)
+    if store is None:
+        print(f"⚠️ {hazard} のランキングがありません。python build_cache.py で作成してください。")
+        sys.exit(1)
+    stats = model.stats(store, n, len(df), key=artifact_key(hazard, RESULT_CACHE_DIR))
+    print(f"👥 人口 {model.total:,.0f} 人（道路から {MAX_SNAP:.0f} m 以上離れて割り当てなかった人口 {model.unassigned:,.0f} 人）")
+    for label, value in zip(band_labels(), stats["total"]):
+        print(f"  {label:>8}: {value:12,.0f} 人")
+    frame = stats_frame(stats, df, np.flatnonzero(stats["demand"] > 0))
+    print(frame.sort_values("担当人口", ascending=False).head(20).to_string())
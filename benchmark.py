@@ -0,0 +1,503 @@
+import numpy as np
+import pandas as pd
+import glob
+import gzip
+import importlib
+import json
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from hazards import HAZARD_COLS
+
+# --- 設定 ---
+CSV_FILE = "emergency_shelter_maebashi.csv"
+GRAPH_CACHE = "maebashi_graph.graphml"
+BUNDLED_GRAPH = "maebshi_graph.graphml.gz"  # リポジトリに同梱している圧縮済みの道路グラフ
+RESULT_CACHE_DIR = "cache_results"
+BASELINE_FILE = "benchmark_baselines.json"
+
+# --- ベンチマークの構成 ---
+# 対象 (同梱の道路グラフと、格子状の合成グラフ) ごとに作業フォルダを作り、リポジトリと同じ配置
+# (maebashi_graph.graphml / emergency_shelter_maebashi.csv / cache_results/) で各段階を実行する。
+# 各段階は別プロセスで実行し、経過時間・最大メモリ使用量 (ピーク RSS)・成果物のサイズを測る。
+#   graphml_load  : GraphML の読み込み（osmnx。比較用）
+#   graph_build   : GraphML から道路グラフ（道路形状テーブル）の書き出し (build_graph.build_graph)
+#   graph_load    : 書き出した道路グラフの読み込みと CSR 隣接行列の作成 (build_graph.load_routing_graph)
+#   rankings      : 距離行列と全災害のランキングの計算 (rank_engine.compute_rankings)
+#   build_cache   : cache_results/ の作成 (build_cache.rebuild_stale)。成果物はキャッシュ全体
+#   ranks_load    : 全災害のランキングを開いて1番目の持ち主を読む
+#   pickle_load   : 旧形式 full_ranks_*.pkl の読み込み (同梱グラフのみ)
+#   edge_coloring : UI2 と同じ道路の分割・色分け・担当範囲の図形の作成
+#   map_export    : precompute.generate_all_maps による静的地図の書き出し。成果物は static_maps/
+#   app_import    : 新しいプロセスで UI2 が読み込むモジュールを import する時間（計算用の scipy などが
+#                   読み込まれていたらエラーにする）
+#   first_map     : 新しいプロセスで UI2 を1回実行し、最初の地図ができるまでの時間 (streamlit の AppTest。
+#                   streamlit 自体の import は含まない)。基準値とは別に FIRST_MAP_TARGET 秒以内かも確かめる
+# 結果は BASELINE_FILE の基準値と比べ、許容幅を超えて遅く（大きく）なった段階があれば終了コード 1 で終わる。
+# 基準値はマシンごとに異なるのでリポジトリには含めない。初めに python benchmark.py baseline で保存しておくこと
+# （基準値のない対象・段階も終了コード 1 で知らせる）。
+# ピーク RSS に段階に関係のないライブラリの分が混ざらないよう、osmnx・networkx・scipy は使う関数の中で読み込む。
+
+STAGES = (
+    "graphml_load", "graph_build", "graph_load", "rankings", "build_cache", "ranks_load", "pickle_load",
+    "edge_coloring", "map_export", "app_import", "first_map",
+)
+SYNTHETIC_SIZES = {"synthetic_10k": 10_000, "synthetic_40k": 40_000}  # 合成グラフのおおよそのノード数
+TARGETS = ("bundled", *SYNTHETIC_SIZES)
+GRID_SPACING = 80.0  # 合成グラフの格子の間隔 [m]
+DROP_RATE = 0.1  # 合成グラフから取り除く道路の割合（格子のままだと経路が単調になるため）
+WALL_TOLERANCE = 1.5  # 基準値の何倍までの経過時間を許すか
+WALL_SLACK = 0.2  # 短い段階のばらつきを吸収するための経過時間の余裕 [秒]
+SIZE_TOLERANCE = 1.25  # 基準値の何倍までのピーク RSS・成果物サイズを許すか
+TIE_TOL = 0.01  # 旧ランキングとの比較で、同じ距離とみなす差 [m]
+FIRST_MAP_TARGET = 2.0  # 最初の地図ができるまでの時間の上限 [秒]
+APP_SCRIPT = "UI2.py"  # app_import・first_map で測る画面
+APP_MODULES = (
+    "streamlit", "pandas", "pydeck", "build_graph", "edge_table", "ownership", "catchments", "analytics",
+    "cache_manifest", "data_cache", "closures", "capacity", "hazards", "instrument", "rank_store", "regions",
+)
+# 画面の表示だけでは読み込まないはずのライブラリ（再計算が必要になったときだけ読み込む）
+LAZY_MODULES = ("scipy.sparse.csgraph", "scipy.spatial", "shapely", "osmnx", "networkx", "sklearn", "geopandas")
+
+def _read_csv(csv_file=CSV_FILE):
+    try:
+        return pd.read_csv(csv_file, encoding='utf-8')
+    except UnicodeDecodeError:
+        return pd.read_csv(csv_file, encoding='cp932')
+
+def _size(path):
+    """ファイルまたはフォルダ以下の合計サイズ [バイト]"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(p) for p in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+               if os.path.isfile(p))
+
+def _peak_rss_mb():
+    # ru_maxrss は fork 元のプロセスの値を引き継ぐため、Linux では exec 後に数え直される VmHWM を使う
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    try:
+        import resource
+    except ImportError:  # Windows では測らない
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+# --- 合成グラフ ---
+def synthetic_graph(n_nodes, seed=0):
+    """前橋市付近に置いた格子状の道路グラフ（双方向、一部の道路を取り除く）を作る"""
+    import networkx as nx
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_nodes)))
+    lat_step = GRID_SPACING / 111320.0
+    lon_step = lat_step / np.cos(np.radians(36.3895))
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(side):
+        for j in range(side):
+            G.add_node(i * side + j + 1, y=36.3895 + (i - side / 2) * lat_step, x=139.0634 + (j - side / 2) * lon_step)
+    for i in range(side):
+        for j in range(side):
+            node = i * side + j + 1
+            for ni, nj in ((i + 1, j), (i, j + 1)):
+                if ni < side and nj < side and rng.random() >= DROP_RATE:
+                    length = float(GRID_SPACING * rng.uniform(1.0, 1.3))  # 道路の曲がりの分だけ長くする
+                    G.add_edge(node, ni * side + nj + 1, length=length)
+                    G.add_edge(ni * side + nj + 1, node, length=length)
+    return G
+
+def synthetic_shelters(G, df, seed=0):
+    """実際の避難所 CSV の列・災害フラグはそのままに、座標だけ合成グラフの範囲内に散らす"""
+    rng = np.random.default_rng(seed)
+    ys = [d['y'] for _, d in G.nodes(data=True)]
+    xs = [d['x'] for _, d in G.nodes(data=True)]
+    df = df.copy()
+    df['lat'] = rng.uniform(min(ys), max(ys), len(df))
+    df['lon'] = rng.uniform(min(xs), max(xs), len(df))
+    return df
+
+def prepare_target(target, work_dir):
+    """対象の作業フォルダに道路グラフと避難所 CSV を用意する（用意できなければ理由を返す）"""
+    import osmnx as ox
+    os.makedirs(work_dir, exist_ok=True)
+    graph_path = os.path.join(work_dir, GRAPH_CACHE)
+    csv_path = os.path.join(work_dir, CSV_FILE)
+    df = _read_csv()
+    if target == "bundled":
+        if os.path.exists(GRAPH_CACHE):
+            shutil.copyfile(GRAPH_CACHE, graph_path)
+        elif os.path.exists(BUNDLED_GRAPH):
+            with gzip.open(BUNDLED_GRAPH, 'rb') as src, open(graph_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            return f"{GRAPH_CACHE} も {BUNDLED_GRAPH} も見つかりません"
+        df.to_csv(csv_path, index=False)
+        # 旧形式の読み込み時間を測るため、同梱の full_ranks_*.pkl を置く
+        os.makedirs(os.path.join(work_dir, "legacy"), exist_ok=True)
+        for path in glob.glob(os.path.join(RESULT_CACHE_DIR, "full_ranks_*.pkl")):
+            shutil.copyfile(path, os.path.join(work_dir, "legacy", os.path.basename(path)))
+    else:
+        G = synthetic_graph(SYNTHETIC_SIZES[target])
+        ox.save_graphml(G, graph_path)
+        synthetic_shelters(G, df).to_csv(csv_path, index=False)
+    return None
+
+# --- 各段階（作業フォルダをカレントディレクトリにした子プロセスで実行する） ---
+def run_stage(stage):
+    """1つの段階を実行し、(経過時間 [秒], 成果物のパス) を返す"""
+    if stage == "graphml_load":
+        import osmnx as ox
+        t0 = time.perf_counter()
+        ox.load_graphml(GRAPH_CACHE)
+        return time.perf_counter() - t0, GRAPH_CACHE
+
+    if stage == "graph_build":
+        from build_graph import build_graph
+        t0 = time.perf_counter()
+        build_graph(GRAPH_CACHE, os.path.join(RESULT_CACHE_DIR, "edges"))
+        return time.perf_counter() - t0, os.path.join(RESULT_CACHE_DIR, "edges")
+
+    if stage == "graph_load":
+        from build_graph import load_routing_graph
+        # scipy の import 時間は含めない（load_routing_graph の中で読み込む rank_engine を先に読んでおく）
+        importlib.import_module("rank_engine")
+        t0 = time.perf_counter()
+        load_routing_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+        return time.perf_counter() - t0, None
+
+    if stage == "rankings":
+        from build_graph import load_graph
+        from rank_engine import compute_rankings
+        table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+        df = _read_csv()
+        t0 = time.perf_counter()
+        compute_rankings(table, df, HAZARD_COLS, workers=1)
+        return time.perf_counter() - t0, None
+
+    if stage == "build_cache":
+        from build_cache import rebuild_stale
+        t0 = time.perf_counter()
+        rebuild_stale()
+        return time.perf_counter() - t0, RESULT_CACHE_DIR
+
+    if stage == "ranks_load":
+        from rank_store import load_ranks
+        t0 = time.perf_counter()
+        for col in HAZARD_COLS:
+            store = load_ranks(col, RESULT_CACHE_DIR)
+            if store is not None:
+                np.asarray(store.owner(1)).sum()
+        return time.perf_counter() - t0, None
+
+    if stage == "pickle_load":
+        paths = glob.glob(os.path.join("legacy", "full_ranks_*.pkl"))
+        if not paths:
+            return None, None
+        t0 = time.perf_counter()
+        for path in paths:
+            with open(path, 'rb') as f:
+                pickle.load(f)
+        return time.perf_counter() - t0, "legacy"
+
+    if stage == "edge_coloring":
+        from catchments import build_catchments
+        from edge_table import edge_node_ids, load_edge_table
+        from ownership import edge_segments, make_palette
+        from rank_store import load_ranks
+        table = load_edge_table()
+        u, v = edge_node_ids(table)
+        df = _read_csv()
+        t0 = time.perf_counter()
+        for col in HAZARD_COLS:
+            store = load_ranks(col, RESULT_CACHE_DIR)
+            if store is None:
+                continue
+            owners = store.owner(1)
+            segments = edge_segments(table, owners, store.distance(1), store.node_index(u), store.node_index(v))
+            make_palette({}, len(df))[segments['owner']]
+            build_catchments(segments, segments['owner'])
+        return time.perf_counter() - t0, None
+
+    if stage == "map_export":
+        import precompute
+        precompute.VIEWER_HTML = os.path.join(os.path.dirname(os.path.abspath(__file__)), precompute.VIEWER_HTML)
+        t0 = time.perf_counter()
+        precompute.generate_all_maps(workers=1)
+        return time.perf_counter() - t0, precompute.MAP_SAVE_DIR
+
+    if stage == "app_import":
+        code = (
+            "import json, sys, time\n"
+            "t0 = time.perf_counter()\n"
+            f"for name in {APP_MODULES!r}: __import__(name)\n"
+            "wall = time.perf_counter() - t0\n"
+            f"print(json.dumps([wall, [m for m in {LAZY_MODULES!r} if m in sys.modules]]))\n"
+        )
+        wall, loaded = json.loads(_fresh_python(code))
+        if loaded:
+            raise RuntimeError(f"画面の起動時に {', '.join(loaded)} を読み込んでいます")
+        return wall, None
+
+    if stage == "first_map":
+        app = os.path.join(os.path.dirname(os.path.abspath(__file__)), APP_SCRIPT)
+        code = (
+            "import time\n"
+            "from streamlit.testing.v1 import AppTest\n"
+            f"at = AppTest.from_file({app!r}, default_timeout=120)\n"
+            "at.session_state['password_correct'] = True\n"
+            "t0 = time.perf_counter()\n"
+            "at.run()\n"
+            "wall = time.perf_counter() - t0\n"
+            "errors = [e.value for e in at.exception] + [e.value for e in at.error]\n"
+            "print(repr(errors[0]) if errors else wall)\n"
+        )
+        out = _fresh_python(code)
+        try:
+            return float(out), None
+        except ValueError:
+            raise RuntimeError(f"{APP_SCRIPT} の実行に失敗しました: {out}") from None
+
+    raise ValueError(f"unknown stage: {stage}")
+
+def _fresh_python(code):
+    """新しい Python プロセスで code を実行し、標準出力の最後の行を返す（import 済みのモジュールの影響を除く）"""
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=os.environ)
+    if proc.returncode != 0:
+        raise RuntimeError((proc.stderr.strip().splitlines() or ["(出力なし)"])[-1])
+    return proc.stdout.strip().splitlines()[-1]
+
+def measure(target, stage, work_dir):
+    """子プロセスで1つの段階を実行し、{wall_s, peak_rss_mb, artifact_mb} を返す（失敗時は error）"""
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "_stage", stage],
+        cwd=work_dir, capture_output=True, text=True,
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))),
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH "):
+            return json.loads(line[len("BENCH "):])
+    return {"error": (proc.stderr.strip().splitlines() or ["(出力なし)"])[-1]}
+
+def run_suite(targets):
+    """対象ごとに全段階を測り、{対象: {段階: 結果}} を返す"""
+    results = {}
+    root = tempfile.mkdtemp(prefix="shelter_bench_")
+    try:
+        for target in targets:
+            work_dir = os.path.join(root, target)
+            print(f"🚀 {target}: 準備中...")
+            error = prepare_target(target, work_dir)
+            if error:
+                print(f"⚠️ {target} をスキップします: {error}")
+                continue
+            results[target] = {}
+            for stage in STAGES:
+                result = measure(target, stage, work_dir)
+                if result.get("skipped"):
+                    continue
+                results[target][stage] = result
+                print(f"  {stage:14s} {_format(result)}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def _format(result):
+    if "error" in result:
+        return f"❌ {result['error']}"
+    rss = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:8.1f} MB"
+    size = "-" if result["artifact_mb"] is None else f"{result['artifact_mb']:8.2f} MB"
+    return f"{result['wall_s']:8.3f} 秒  RSS {rss}  成果物 {size}"
+
+# --- 基準値との比較 ---
+def load_baselines(path=BASELINE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_baselines(results, path=BASELINE_FILE):
+    baselines = load_baselines(path)
+    for target, stages in results.items():
+        baselines[target] = {stage: r for stage, r in stages.items() if "error" not in r}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2)
+
+def regressions(results, baselines):
+    """基準値から許容幅を超えて悪化した項目の説明のリストを返す"""
+    found = []
+    for target, stages in results.items():
+        for stage, result in stages.items():
+            if "error" in result:
+                found.append(f"{target}/{stage}: 実行に失敗しました ({result['error']})")
+                continue
+            if stage == "first_map" and result["wall_s"] > FIRST_MAP_TARGET:
+                found.append(f"{target}/{stage}: 最初の地図まで {result['wall_s']:.3f} 秒 > 目標 {FIRST_MAP_TARGET:.1f} 秒")
+            base = baselines.get(target, {}).get(stage)
+            if base is None:
+                found.append(f"{target}/{stage}: 基準値がありません (先に python benchmark.py baseline を実行してください)")
+                continue
+            limit = base["wall_s"] * WALL_TOLERANCE + WALL_SLACK
+            if result["wall_s"] > limit:
+                found.append(f"{target}/{stage}: 経過時間 {result['wall_s']:.3f} 秒 > 上限 {limit:.3f} 秒 "
+                             f"(基準 {base['wall_s']:.3f} 秒)")
+            for key, label in (("peak_rss_mb", "ピーク RSS"), ("artifact_mb", "成果物サイズ")):
+                if result.get(key) is None or base.get(key) is None:
+                    continue
+                limit = base[key] * SIZE_TOLERANCE
+                if result[key] > limit:
+                    found.append(f"{target}/{stage}: {label} {result[key]:.1f} MB > 上限 {limit:.1f} MB "
+                                 f"(基準 {base[key]:.1f} MB)")
+    return found
+
+# --- 旧ランキングとの照合 ---
+def check_legacy(cache_dir=RESULT_CACHE_DIR, graph_path=GRAPH_CACHE):
+    """新エンジンの距離が cache_results/full_ranks_*.pkl の順位を再現するか確かめる（不一致数を返す）
+
+    旧方式は同じ道路ノードに紐づく避難所を1つにまとめ、到達できない避難所を含めないため、
+    「旧順位が新しい距離で近い順になっているか」「旧順位にない到達可能な避難所が、
+    旧順位にある避難所と同じノードに紐づくものだけか」を確かめる。同じ距離の並びは問わない。
+    """
+    from build_graph import load_graph
+    from rank_engine import compute_distances
+    df = _read_csv()
+    node_ids, dist, shelter_idx = compute_distances(load_graph(graph_path, cache_dir), df)
+    node_pos = {node: i for i, node in enumerate(node_ids.tolist())}
+    shelter_idx = np.asarray(shelter_idx)
+
+    total_bad = 0
+    for col in HAZARD_COLS:
+        path = os.path.join(cache_dir, f"full_ranks_{col}.pkl")
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            legacy = pickle.load(f)
+        active = set(df.index[df[col] == True].tolist())
+        bad = unreachable = skipped = 0
+        for node, old in legacy.items():
+            pos = node_pos.get(node)
+            if pos is None:
+                skipped += 1
+                continue
+            d = dist[:, pos]
+            old_d = d[old] if old else np.empty(0)
+            # 旧順位にある避難所へ今のグラフでは到達できない場合は、グラフが作成時と異なる。
+            # 順位の並びは到達できる避難所だけで確かめる
+            unreachable += not np.all(np.isfinite(old_d))
+            old_d = old_d[np.isfinite(old_d)]
+            ordered = bool(np.all(np.diff(old_d) >= -TIE_TOL))
+            reachable = {sid for sid in active if np.isfinite(d[sid])}
+            old_nodes = set(shelter_idx[old].tolist()) if old else set()
+            merged = all(shelter_idx[sid] in old_nodes for sid in reachable - set(old))
+            bad += not (ordered and merged)
+        total_bad += bad + unreachable
+        print(f"{'✅' if bad + unreachable == 0 else '❌'} {col}: 順位の不一致 {bad} 件 / "
+              f"到達できない避難所を含む {unreachable} 件 / {len(legacy) - skipped} 件"
+              + (f"（グラフにないノード {skipped} 件は対象外）" if skipped else ""))
+    return total_bad
+
+# --- 旧方式との計算時間の比較 ---
+def legacy_rankings(G, active_shelters, nodes):
+    """旧 createpkl.generate_rankings と同じ (ノード, 避難所) ごとの最短経路計算"""
+    import networkx as nx
+    import osmnx as ox
+    target_nodes = ox.nearest_nodes(G, active_shelters['lon'], active_shelters['lat'])
+    node_to_shelter_id = {node: sid for node, sid in zip(target_nodes, active_shelters.index)}
+
+    node_rankings = {}
+    for node in nodes:
+        distances = {}
+        for target_node, sid in node_to_shelter_id.items():
+            try:
+                distances[sid] = nx.shortest_path_length(G, node, target_node, weight='length')
+            except nx.NetworkXNoPath:
+                continue
+        node_rankings[node] = sorted(distances, key=distances.get)
+    return node_rankings
+
+def bench_rankings(sample_size=20):
+    """旧方式（サンプルから全体を推定）と新エンジン（全ノード実測）の計算時間を比較する"""
+    import osmnx as ox
+    from build_graph import load_graph
+    from rank_engine import compute_rankings
+    G = ox.load_graphml(GRAPH_CACHE)
+    df = _read_csv()
+
+    t0 = time.perf_counter()
+    rankings, node_ids = compute_rankings(load_graph(GRAPH_CACHE, RESULT_CACHE_DIR), df, HAZARD_COLS)
+    engine_sec = time.perf_counter() - t0
+    node_pos = {node: i for i, node in enumerate(node_ids.tolist())}
+
+    random.seed(0)
+    sample = random.sample(list(G.nodes()), sample_size)
+    legacy_sec = 0.0
+    mismatches = compared = 0
+    for col in HAZARD_COLS:
+        active_shelters = df[df[col] == True]
+        if active_shelters.empty:
+            continue
+        t0 = time.perf_counter()
+        legacy = legacy_rankings(G, active_shelters, sample)
+        legacy_sec += time.perf_counter() - t0
+
+        # 旧方式は同じノードに紐づく避難所を1つにまとめるため、旧方式に残った避難所だけで比較する
+        for node, old in legacy.items():
+            kept = set(old)
+            new = [sid for sid in rankings[col][:, node_pos[node]].tolist() if sid in kept]
+            mismatches += new != old
+            compared += 1
+
+    legacy_total = legacy_sec * G.number_of_nodes() / sample_size
+    print(f"ノード数: {G.number_of_nodes()}, 避難所数: {len(df)}, 災害種類: {len(HAZARD_COLS)}")
+    print(f"旧方式 (推定): {legacy_total:10.1f} 秒  ({sample_size} ノードの実測 {legacy_sec:.1f} 秒から換算)")
+    print(f"新エンジン    : {engine_sec:10.1f} 秒")
+    print(f"高速化        : {legacy_total / engine_sec:10.0f} 倍")
+    print(f"順位の不一致  : {mismatches} 件 / {compared} 件")
+
+USAGE = f"""使い方:
+  python benchmark.py [対象 ...]           全段階を測って基準値と比べる（既定は同梱グラフと全合成グラフ）
+  python benchmark.py baseline [対象 ...]  測った結果を基準値として {BASELINE_FILE} に保存する
+  python benchmark.py check                新エンジンが full_ranks_*.pkl の順位を再現するか確かめる
+  python benchmark.py legacy [サンプル数]  旧方式との計算時間の比較
+対象: {", ".join(TARGETS)}"""
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "_stage":
+        wall, artifact = run_stage(sys.argv[2])
+        if wall is None:
+            print("BENCH " + json.dumps({"skipped": True}))
+        else:
+            print("BENCH " + json.dumps({
+                "wall_s": round(wall, 4),
+                "peak_rss_mb": None if _peak_rss_mb() is None else round(_peak_rss_mb(), 1),
+                "artifact_mb": None if artifact is None else round(_size(artifact) / 2**20, 3),
+            }))
+    elif command == "check":
+        sys.exit(1 if check_legacy() else 0)
+    elif command == "legacy":
+        bench_rankings(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    else:
+        args = sys.argv[2:] if command in ("run", "baseline") else sys.argv[1:]
+        targets = args or list(TARGETS)
+        unknown = [t for t in targets if t not in TARGETS]
+        if unknown:
+            print(USAGE)
+            sys.exit(0 if unknown[0] in ("-h", "--help") else 2)
+        results = run_suite(targets)
+        if command == "baseline":
+            save_baselines(results)
+            print(f"💾 基準値を {BASELINE_FILE} に保存しました。")
+        else:
+            found = regressions(results, load_baselines())
+            if found:
+                print("❌ 基準値との比較で問題が見つかりました:")
+                for message in found:
+                    print(f"  - {message}")
+                sys.exit(1)
+            print("✅ すべての段階が基準値の許容範囲内です。")
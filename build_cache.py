@@ -0,0 +1,62 @@
+import os
+import sys
+from cache_manifest import artifact_status, current_inputs, load_cache_manifest, record_artifacts
+from hazards import ALL_SHELTERS, HAZARD_COLS
+from update_ranks import read_shelters, update_rankings
+
+# --- キャッシュの再構築スケジューラ ---
+# cache_results/manifest.json と今の入力（道路グラフ・CSV）を照合し、古くなった成果物だけを作り直す。
+# すべて最新ならグラフも読み込まずに終わるので、デプロイのたびに実行してよい。
+
+CSV_FILE = "emergency_shelter_maebashi.csv"
+GRAPH_CACHE = "maebashi_graph.graphml"
+RESULT_CACHE_DIR = "cache_results"
+
+
+def cache_plan(df, cache_dir=RESULT_CACHE_DIR, graph_path=GRAPH_CACHE, csv_file=CSV_FILE):
+    """成果物ごとの状態 {成果物名: "fresh" | "stale" | "unknown" | "missing"} を返す"""
+    manifest = load_cache_manifest(cache_dir)
+    names = ["edges", "distances"] + [f"ranks_{col}" for col in HAZARD_COLS + [ALL_SHELTERS]]
+    return {
+        name: artifact_status(name, df, cache_dir, graph_path, csv_file, manifest)
+        for name in names
+    }
+
+
+def rebuild_stale(cache_dir=RESULT_CACHE_DIR, graph_path=GRAPH_CACHE, csv_file=CSV_FILE):
+    """古くなった成果物だけを作り直し、作り直した成果物名のリストを返す"""
+    df = read_shelters(csv_file)
+    plan = cache_plan(df, cache_dir, graph_path, csv_file)
+    stale = [name for name, status in plan.items() if status != "fresh"]
+    for name, status in plan.items():
+        print(f"{'✅' if status == 'fresh' else '🔁'} {name}: {status}")
+    if not stale:
+        print("✨ すべてのキャッシュが最新です。再計算は不要です。")
+        return []
+    if not os.path.exists(graph_path):
+        print(f"⚠️ グラフファイル {graph_path} がないため、キャッシュを作り直せません。")
+        return []
+
+    rebuilt = []
+    if "edges" in stale:
+        from build_graph import build_graph
+        build_graph(graph_path, os.path.join(cache_dir, "edges"))
+        record_artifacts(["edges"], df, cache_dir, graph_path, csv_file)
+        rebuilt.append("edges")
+
+    # 距離行列が別のグラフから作られている（または由来が分からない）ときだけ全避難所を計算し直す。
+    # それ以外は CSV の差分だけを反映し、古くなった災害のランキングを作り直す。
+    hazards = [name[len("ranks_"):] for name in stale if name.startswith("ranks_")]
+    if "distances" in stale or hazards:
+        manifest = load_cache_manifest(cache_dir)
+        recorded = manifest["artifacts"].get("distances")
+        graph = current_inputs(graph_path, csv_file, manifest)["graph"]
+        full = recorded is None or recorded.get("graph") != graph["sha256"]
+        dirty = update_rankings(cache_dir, csv_file, graph_path, force=hazards, full=full)
+        rebuilt += ["distances"] + [f"ranks_{col}" for col in dirty]
+    return rebuilt
+
+
+if __name__ == "__main__":
+    # 使い方: python build_cache.py [キャッシュフォルダ]
+    rebuild_stale(sys.argv[1] if len(sys.argv) > 1 else RESULT_CACHE_DIR)
@@ -0,0 +1,207 @@
+import numpy as np
+import os
+import re
+import sys
+from cache_manifest import artifact_status, record_artifacts
+from edge_table import EDGE_TABLE_DIR, load_edge_table, save_edge_table
+
+# --- 道路グラフの構築と読み込み ---
+# ネットワークに接続せず、手元の OSM 抽出ファイル (.osm.pbf / .osm / .xml) から歩行者用の道路グラフを作る。
+# osmnx の network_type='walk' と同じ条件で道路を選び、交差点・行き止まり・way の境目以外のノードを
+# 道路の形状にまとめて（osmnx の simplify_graph(G, edge_attrs_differ=["osmid"]) と同じ結果）、
+# 道路形状テーブル (edge_table.py の形式) として書き出す。
+# 属性は端点・長さ・形状だけを残す。歩行者の道路は双方向なので、各道路を両方向の2本として保存する。
+# .osm.pbf の読み込みには pyosmium (pip install osmium) が必要。XML は標準ライブラリだけで読める。
+#
+# ランキングの計算・画面・API はすべて load_graph() で道路グラフを読む。
+# 道路形状テーブルが入力ファイル（GraphML または OSM 抽出ファイル）と一致していればそれを
+# メモリマップで開くだけで、古い・ない場合だけ入力ファイルから作り直す。
+# 経路探索用の CSR 隣接行列は、テーブルの端点と長さから数十ミリ秒で作れるので保存しない。
+
+GRAPH_CACHE = "maebashi_graph.graphml"
+RESULT_CACHE_DIR = "cache_results"
+OSM_SUFFIXES = (".osm.pbf", ".pbf", ".osm", ".xml")
+EARTH_RADIUS = 6371009.0  # osmnx の道路長と同じ地球半径 [m]
+
+# osmnx の network_type='walk' の条件（タグの値が正規表現に一致する道路を除く）
+WALK_EXCLUDE = {
+    "highway": re.compile("abandoned|bus_guideway|construction|cycleway|motor|no|planned|platform|proposed"
+                          "|raceway|razed"),
+    "area": re.compile("yes"),
+    "access": re.compile("private"),
+    "foot": re.compile("no"),
+    "service": re.compile("private"),
+}
+
+
+def is_osm_extract(path):
+    return path.lower().endswith(OSM_SUFFIXES)
+
+
+def is_walkable(tags):
+    """歩行者用の道路グラフに含める way か"""
+    if "highway" not in tags:
+        return False
+    return not any(key in tags and pattern.search(tags[key]) for key, pattern in WALK_EXCLUDE.items())
+
+
+def _read_pbf(path):
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError(".osm.pbf を読むには pyosmium が必要です (pip install osmium)") from None
+
+    node_ids, lons, lats, ways = [], [], [], []
+
+    class Handler(osmium.SimpleHandler):
+        def way(self, w):
+            tags = {tag.k: tag.v for tag in w.tags}
+            if not is_walkable(tags):
+                return
+            refs = []
+            for n in w.nodes:
+                if not n.location.valid():
+                    continue
+                node_ids.append(n.ref)
+                lons.append(n.location.lon)
+                lats.append(n.location.lat)
+                refs.append(n.ref)
+            ways.append(refs)
+
+    # locations=True で way の各ノードの座標を1回の走査で引く
+    Handler().apply_file(path, locations=True)
+    return np.array(node_ids, dtype=np.int64), np.array(lons), np.array(lats), ways
+
+
+def _read_xml(path):
+    import xml.etree.ElementTree as ET
+    node_ids, lons, lats, ways = [], [], [], []
+    for _, elem in ET.iterparse(path, events=("end",)):
+        if elem.tag == "node":
+            node_ids.append(int(elem.get("id")))
+            lons.append(float(elem.get("lon")))
+            lats.append(float(elem.get("lat")))
+        elif elem.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+            if is_walkable(tags):
+                ways.append([int(nd.get("ref")) for nd in elem.iter("nd")])
+        else:
+            continue
+        elem.clear()  # 読み終えた要素は捨て、メモリを抽出ファイルの大きさに比例させない
+    return np.array(node_ids, dtype=np.int64), np.array(lons), np.array(lats), ways
+
+
+def read_osm(path):
+    """OSM 抽出ファイルから (ノードID, 経度, 緯度, 歩行者用 way のノードID列のリスト) を読む"""
+    if path.lower().endswith((".osm.pbf", ".pbf")):
+        return _read_pbf(path)
+    return _read_xml(path)
+
+
+def _segment_lengths(lon, lat):
+    """点列の隣り合う点の間の大円距離 [m]（osmnx の great_circle と同じ式）"""
+    lon, lat = np.radians(lon), np.radians(lat)
+    h = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def osm_edge_table(path):
+    """OSM 抽出ファイルから道路形状テーブル（の配列の辞書）を作る"""
+    node_ids, lons, lats, ways = read_osm(path)
+    ids, first = np.unique(node_ids, return_index=True)
+    lons, lats = lons[first], lats[first]
+
+    # way の中の連続する同じノード・座標のないノードを除き、2点未満の way は捨てる
+    refs = []
+    for way in ways:
+        way = np.asarray(way, dtype=np.int64)
+        pos = np.searchsorted(ids, way)
+        pos = pos[(pos < len(ids)) & (ids[np.minimum(pos, len(ids) - 1)] == way)]
+        pos = pos[np.r_[True, pos[1:] != pos[:-1]]]
+        if len(pos) >= 2:
+            refs.append(pos)
+    if not refs:
+        raise ValueError(f"{path} に歩行者用の道路がありません")
+
+    # 交差点・行き止まり: way の端点、または複数回使われるノード
+    flat = np.concatenate(refs)
+    uses = np.bincount(flat, minlength=len(ids))
+    endpoint = uses >= 2
+    for pos in refs:
+        endpoint[pos[0]] = endpoint[pos[-1]] = True
+
+    us, vs, lengths, pieces = [], [], [], []
+    for pos in refs:
+        cut = np.flatnonzero(endpoint[pos])
+        seg = _segment_lengths(lons[pos], lats[pos])
+        for a, b in zip(cut[:-1], cut[1:]):
+            us.append(pos[a])
+            vs.append(pos[b])
+            lengths.append(seg[a:b].sum())
+            pieces.append(pos[a:b + 1])
+
+    # 歩行者の道路は双方向なので、逆向きの道路も加える（形状の点の並びも逆にする）
+    us, vs, lengths = np.array(us), np.array(vs), np.array(lengths)
+    pieces += [p[::-1] for p in pieces]
+    us, vs = np.r_[us, vs], np.r_[vs, us]
+    lengths = np.r_[lengths, lengths]
+
+    # 端点だけをノードとして残し、位置を付け直す
+    keep = np.flatnonzero(endpoint & (uses > 0))
+    new_pos = np.full(len(ids), -1, dtype=np.int64)
+    new_pos[keep] = np.arange(len(keep))
+    points = np.concatenate(pieces)
+    offsets = np.zeros(len(pieces) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in pieces], out=offsets[1:])
+    return {
+        "nodes": ids[keep], "x": lons[keep], "y": lats[keep],
+        "u": new_pos[us].astype(np.int32), "v": new_pos[vs].astype(np.int32),
+        "length": lengths.astype(np.float32),
+        "coords": np.column_stack([lons[points], lats[points]]),
+        "offsets": offsets,
+    }
+
+
+def build_graph(graph_path=GRAPH_CACHE, path=EDGE_TABLE_DIR):
+    """GraphML または OSM 抽出ファイルから道路形状テーブルを作って保存する"""
+    if is_osm_extract(graph_path):
+        table = osm_edge_table(graph_path)
+    else:
+        import osmnx as ox
+        from edge_table import edge_table_from_graph
+        table = edge_table_from_graph(ox.load_graphml(graph_path))
+    return save_edge_table(table, path)
+
+
+def load_graph(graph_path=GRAPH_CACHE, cache_dir=RESULT_CACHE_DIR):
+    """道路形状テーブルを開く。入力ファイルと一致しない・まだない場合は作り直す
+
+    入力ファイルがなければ手元のテーブルをそのまま使う（テーブルもなければ None）。
+    """
+    path = os.path.join(cache_dir, "edges")
+    status = artifact_status("edges", None, cache_dir, graph_path)
+    if status in ("stale", "missing") and os.path.exists(graph_path):
+        build_graph(graph_path, path)
+        record_artifacts(["edges"], None, cache_dir, graph_path)
+    return load_edge_table(path)
+
+
+def load_routing_graph(graph_path=GRAPH_CACHE, cache_dir=RESULT_CACHE_DIR):
+    """(道路形状テーブル, 辺の向きを逆にした CSR 隣接行列) を返す（グラフがない場合は None）"""
+    from rank_engine import table_to_csr
+    table = load_graph(graph_path, cache_dir)
+    if table is None:
+        return None
+    return table, table_to_csr(table)[0]
+
+
+if __name__ == "__main__":
+    # 使い方: python build_graph.py [GraphML または OSM 抽出ファイル] [キャッシュフォルダ]
+    import time
+    graph_path = sys.argv[1] if len(sys.argv) > 1 else GRAPH_CACHE
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else RESULT_CACHE_DIR
+    t0 = time.perf_counter()
+    table = build_graph(graph_path, os.path.join(cache_dir, "edges"))
+    record_artifacts(["edges"], None, cache_dir, graph_path)
+    print(f"✅ {graph_path} から道路 {len(table['u'])} 本・ノード {len(table['nodes'])} 件の道路グラフを "
+          f"{os.path.join(cache_dir, 'edges')} に書き出しました（{time.perf_counter() - t0:.1f} 秒）。")
@@ -0,0 +1,156 @@
+import numpy as np
+import hashlib
+import json
+import os
+from edge_table import EDGE_TABLE_FILES
+from hazards import hazard_active
+from rank_store import DISTANCE_DIR, RESULT_CACHE_DIR, store_path
+
+# --- キャッシュの目録 (cache_results/manifest.json) ---
+# 各成果物がどの入力から作られたかを sha256 で記録し、読み込み時に入力と照合する。
+#   inputs    : 入力ファイル (graph, csv) ごとの {path, size, mtime_ns, sha256}
+#               サイズと更新時刻が同じなら記録済みの sha256 を使い、ファイルを読み直さない
+#   artifacts : 成果物ごとの作成時の入力ハッシュ
+#     edges         : graph
+#     distances     : graph, csv, shelters (全避難所のID・座標)
+#     ranks_<災害列> : graph, csv, column  (全避難所のID・座標とその災害のフラグ)
+# csv は記録のみで、鮮度の判定には使わない。ある災害の列だけを変えたときに
+# 他の災害のランキングまで作り直さないよう、CSV からその成果物に関係する部分だけを比べる。
+
+CSV_FILE = "emergency_shelter_maebashi.csv"
+GRAPH_CACHE = "maebashi_graph.graphml"
+MANIFEST_FILE = "manifest.json"
+FRESHNESS_KEYS = ("graph", "shelters", "column")
+
+_digest_memo = {}  # (パス, サイズ, 更新時刻) → sha256（プロセス内で同じファイルを何度も読まない）
+
+
+def file_digest(path, known=None):
+    """ファイルの {path, size, mtime_ns, sha256} を返す（存在しない場合は None）
+
+    known にサイズ・更新時刻が同じ記録があれば、その sha256 をそのまま使う。
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    entry = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if known and all(known.get(k) == entry[k] for k in ("path", "size", "mtime_ns")):
+        _digest_memo[key] = known["sha256"]
+    if key not in _digest_memo:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _digest_memo[key] = h.hexdigest()
+    entry["sha256"] = _digest_memo[key]
+    return entry
+
+
+def _array_digest(*arrays):
+    h = hashlib.sha256()
+    for array in arrays:
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def shelters_digest(df):
+    """全避難所の ID・座標のハッシュ（距離行列が依存する部分）"""
+    return _array_digest(
+        df.index.to_numpy(dtype=np.int64),
+        df['lat'].to_numpy(dtype=np.float64), df['lon'].to_numpy(dtype=np.float64),
+    )
+
+
+def column_digest(df, col):
+    """全避難所の ID・座標と災害フラグのハッシュ（その災害のランキングが依存する部分）"""
+    return _array_digest(
+        df.index.to_numpy(dtype=np.int64),
+        df['lat'].to_numpy(dtype=np.float64), df['lon'].to_numpy(dtype=np.float64),
+        hazard_active(df, col),
+    )
+
+
+def load_cache_manifest(cache_dir=RESULT_CACHE_DIR):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {"inputs": {}, "artifacts": {}}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_cache_manifest(manifest, cache_dir=RESULT_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def current_inputs(graph_path, csv_file, manifest):
+    """入力ファイルのハッシュを求める（目録の記録と同じサイズ・更新時刻なら読み直さない）"""
+    known = manifest.get("inputs", {})
+    return {
+        "graph": file_digest(graph_path, known.get("graph")),
+        "csv": file_digest(csv_file, known.get("csv")),
+    }
+
+
+def _sha(entry):
+    return entry["sha256"] if entry else None
+
+
+def expected_entry(name, df, inputs):
+    """成果物 name を今の入力から作ったときに記録されるべきハッシュ"""
+    entry = {"graph": _sha(inputs["graph"])}
+    if name == "edges":
+        return entry
+    entry["csv"] = _sha(inputs["csv"])
+    if name == "distances":
+        entry["shelters"] = shelters_digest(df)
+    else:
+        entry["column"] = column_digest(df, name[len("ranks_"):])
+    return entry
+
+
+def artifact_exists(name, cache_dir=RESULT_CACHE_DIR):
+    if name == "edges":
+        path = os.path.join(cache_dir, "edges")
+        return all(os.path.exists(os.path.join(path, f"{f}.npy")) for f in EDGE_TABLE_FILES)
+    if name == "distances":
+        return os.path.exists(os.path.join(cache_dir, DISTANCE_DIR, "dist.npy"))
+    # 分割して計算した地域 (regions.py) のランキングはタイルごとに保存される
+    return (os.path.exists(os.path.join(store_path(name[len("ranks_"):], cache_dir), "ranks.npy"))
+            or os.path.exists(os.path.join(cache_dir, "tiles", "index.json")))
+
+
+def artifact_status(name, df, cache_dir=RESULT_CACHE_DIR, graph_path=GRAPH_CACHE, csv_file=CSV_FILE, manifest=None):
+    """成果物が今の入力と一致するかを調べる
+
+    戻り値は "fresh"（一致）, "stale"（入力が変わっている）, "unknown"（記録がない旧キャッシュ）,
+    "missing"（成果物がない）のいずれか。入力ファイルが見つからない項目は比較しない。
+    """
+    if not artifact_exists(name, cache_dir):
+        return "missing"
+    if manifest is None:
+        manifest = load_cache_manifest(cache_dir)
+    recorded = manifest["artifacts"].get(name)
+    if recorded is None:
+        return "unknown"
+    expected = expected_entry(name, df, current_inputs(graph_path, csv_file, manifest))
+    for key in FRESHNESS_KEYS:
+        if key in expected and expected[key] is not None and recorded.get(key) != expected[key]:
+            return "stale"
+    return "fresh"
+
+
+def record_artifacts(names, df, cache_dir=RESULT_CACHE_DIR, graph_path=GRAPH_CACHE, csv_file=CSV_FILE):
+    """作り直した成果物の入力ハッシュを目録に記録する"""
+    manifest = load_cache_manifest(cache_dir)
+    inputs = current_inputs(graph_path, csv_file, manifest)
+    for key, entry in inputs.items():
+        if entry is not None:
+            manifest["inputs"][key] = entry
+    for name in names:
+        manifest["artifacts"][name] = expected_entry(name, df, inputs)
+    save_cache_manifest(manifest, cache_dir)
@@ -0,0 +1,107 @@
+import numpy as np
+from rank_store import NO_SHELTER
+
+# --- 収容上限を考慮した割り当て ---
+# 各ノードの候補を保存済みランキングの上位K件に限り、受け入れ保留方式（ノード側が近い順に申し込み、
+# 避難所側は近いノードから上限まで受け入れる）で割り当てる。あふれたノードは次の順位の避難所に
+# 申し込み直すので、上限に達した避難所の需要が順位どおりに次の避難所へ流れる。
+# 1ラウンドは全ノード分の一括ソート1回で、通常は数ラウンドで収束する。
+
+CAPACITY_COL = "capacity"  # CSV に収容上限の列があればそれを使う
+DEFAULT_SLACK = 1.2  # 上限の列がないとき、需要を均等に分けた量の何倍を上限とするか
+
+
+def node_demand(u_pos, n_nodes, weights=None):
+    """道路ごとの需要（既定では1本 = 1）を u側ノードに集計する"""
+    u_pos = np.asarray(u_pos)
+    has_node = u_pos >= 0
+    w = None if weights is None else np.asarray(weights, dtype=np.float64)[has_node]
+    return np.bincount(u_pos[has_node], weights=w, minlength=n_nodes).astype(np.float64)
+
+
+def default_capacity(total_demand, n_shelters, slack=DEFAULT_SLACK):
+    """需要を避難所数で均等に分けた量に余裕を持たせた上限"""
+    return float(np.ceil(total_demand / max(n_shelters, 1) * slack))
+
+
+def shelter_capacity(shelters_df, default):
+    """避難所IDで引ける収容上限の配列を返す（CSV に列があればその値、なければ default）"""
+    capacity = np.full(len(shelters_df), default, dtype=np.float64)
+    if CAPACITY_COL in shelters_df.columns:
+        given = shelters_df[CAPACITY_COL].to_numpy(dtype=np.float64)
+        capacity = np.where(np.isnan(given), capacity, given)
+    return capacity
+
+
+def _first_fit(demand, groups, capacity):
+    """避難所ごとに並べた申し込みを先頭から順に、入るものだけ受け入れる（受け入れる行の bool 配列）
+
+    入らない申し込みは飛ばして後ろの小さい申し込みを受け入れる逐次処理と同じ結果を、
+    「どう詰めても入らない申し込みをまとめて外し、残りで累積和を取り直す」繰り返しで求める。
+    """
+    group_start = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sizes = np.diff(np.r_[group_start, len(groups)])
+    group_of = np.repeat(np.arange(len(group_start)), sizes)
+    alive = np.ones(len(groups), dtype=bool)
+    while True:
+        d = np.where(alive, demand, 0.0)
+        load = np.cumsum(d)
+        load -= np.repeat(load[group_start] - d[group_start], sizes)
+        over = alive & (load > capacity)
+        if not over.any():
+            return alive
+        # 各避難所で最初にあふれた申し込みの直前までの空き容量より大きい申し込みは、もう入らない
+        first = np.full(len(group_start), len(groups))
+        np.minimum.at(first, group_of[over], np.flatnonzero(over))
+        room = np.full(len(group_start), np.inf)
+        has_over = first < len(groups)
+        room[has_over] = capacity[first[has_over]] - (load[first[has_over]] - d[first[has_over]])
+        alive &= ~(over & (demand > room[group_of]))
+
+
+def assign_with_capacity(cand_ids, cand_dist, demand, capacity):
+    """候補 (K, ノード数) の中から、収容上限を守って各ノードの避難所を決める
+
+    cand_ids  : 近い順の避難所ID (RankStore.ranks の上位K行など)。候補がなければ NO_SHELTER
+    cand_dist : 上記の距離。None なら順位を距離の代わりに使う
+    demand    : ノードごとの需要 (node_demand)
+    capacity  : 避難所IDで引ける収容上限 (shelter_capacity)
+    戻り値は (ノードごとの避難所ID, 避難所IDごとの割り当て済み需要)。
+    どの候補にも入れなかったノードと需要0のノードは NO_SHELTER。同じ距離なら小さいノード番号が優先される。
+    """
+    cand_ids = np.asarray(cand_ids)
+    depth, n_nodes = cand_ids.shape
+    if cand_dist is None:
+        cand_dist = np.broadcast_to(np.arange(depth, dtype=np.float32)[:, None], cand_ids.shape)
+    cand_dist = np.asarray(cand_dist)
+    demand = np.asarray(demand, dtype=np.float64)
+    capacity = np.asarray(capacity, dtype=np.float64)
+
+    assigned = np.full(n_nodes, NO_SHELTER, dtype=np.int16)
+    choice = np.zeros(n_nodes, dtype=np.int64)  # 次に申し込む（または保留中の）候補の順位
+    free = np.flatnonzero(demand > 0)
+    while True:
+        # 候補が残っていないノードは諦める
+        free = free[choice[free] < depth]
+        free = free[cand_ids[choice[free], free] != NO_SHELTER]
+        if len(free) == 0:
+            break
+
+        # 保留中のノードと新たに申し込むノードを、避難所ごとに近い順に並べて上限まで受け入れる
+        holders = np.flatnonzero(assigned != NO_SHELTER)
+        nodes = np.concatenate([holders, free])
+        shelters = cand_ids[choice[nodes], nodes]
+        order = np.lexsort((nodes, cand_dist[choice[nodes], nodes], shelters))
+        nodes, shelters = nodes[order], shelters[order]
+
+        keep = _first_fit(demand[nodes], shelters, capacity[shelters])
+
+        assigned[nodes[keep]] = shelters[keep]
+        rejected = nodes[~keep]
+        assigned[rejected] = NO_SHELTER
+        choice[rejected] += 1
+        free = rejected
+
+    loads = np.bincount(assigned[assigned != NO_SHELTER], weights=demand[assigned != NO_SHELTER],
+                        minlength=len(capacity))
+    return assigned, loads
@@ -0,0 +1,145 @@
+import numpy as np
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from rank_store import NO_SHELTER, RESULT_CACHE_DIR
+
+# --- 避難所ごとの担当範囲の図形 ---
+# 道路1本ごとに線を描く代わりに、同じ避難所が担当する道路をまとめて1つの図形にする。
+#   lines : 担当道路をつないだ線 (MultiLineString) を簡略化したもの
+#   hull  : 担当道路の頂点を囲む凹包 (Polygon)
+# 描画する図形の数は道路数 (約10^5) から避難所数 (約10^2) に減る。
+# 簡略化の許容誤差はズームに応じた3段階で、結果は持ち主配列のハッシュをキーにして
+# プロセス内の LRU と cache_results/catchments/ の両方に保存する。フォルダ内のファイルは
+# 最後に使った時刻（更新時刻）で MAX_FILES 個まで残し、古いものから消す。
+
+CATCHMENT_DIR = os.path.join(RESULT_CACHE_DIR, "catchments")
+LEVELS = {"low": 30.0, "mid": 8.0, "high": 2.0}  # 詳細度ごとの簡略化の許容誤差 [m]
+HULL_RATIO = 0.2  # 凹包のくぼみ具合（0 に近いほど道路に沿う）
+MAX_CACHED = 64  # プロセス内に保持する図形の組の数
+MAX_FILES = 256  # cache_results/catchments/ に残すファイルの数
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+
+
+def zoom_level(zoom):
+    """地図のズームに対応する詳細度"""
+    if zoom is None or zoom < 13:
+        return "low"
+    return "mid" if zoom < 15 else "high"
+
+
+def build_catchments(table, edge_owner, level="mid", kind="lines"):
+    """道路ごとの持ち主から、避難所ごとの担当範囲の図形を作る
+
+    table は道路形状テーブル、または ownership.split_segments で分割した区間のテーブル。
+    戻り値は (避難所IDの配列, shapely の図形の配列)。
+    """
+    import shapely
+    edge_owner = np.asarray(edge_owner)
+    owned = np.flatnonzero(edge_owner != NO_SHELTER)
+    owned = owned[np.argsort(edge_owner[owned], kind='stable')]
+    if len(owned) == 0:
+        return np.empty(0, dtype=np.int16), np.empty(0, dtype=object)
+    coords = np.asarray(table["coords"])
+    offsets = np.asarray(table["offsets"])
+
+    # 持ち主のある道路だけの座標を連結し、道路ごとの線を一括で作る
+    counts = offsets[owned + 1] - offsets[owned]
+    starts = np.repeat(offsets[owned] - np.r_[0, np.cumsum(counts)[:-1]], counts)
+    points = coords[starts + np.arange(counts.sum())]
+    lines = shapely.linestrings(points, indices=np.repeat(np.arange(len(owned)), counts))
+
+    ids, group = np.unique(edge_owner[owned], return_inverse=True)
+    multi = shapely.multilinestrings(lines, indices=group)
+    tolerance = LEVELS[level] / 111320.0  # [m] → 緯度方向の度
+    if kind == "hull":
+        geoms = shapely.concave_hull(multi, ratio=HULL_RATIO)
+    else:
+        geoms = shapely.line_merge(multi)
+    return ids.astype(np.int16), shapely.simplify(geoms, tolerance, preserve_topology=False)
+
+
+def _to_geojson(result):
+    import shapely
+    ids, geoms = result
+    return ids, shapely.to_geojson(geoms).tolist()
+
+
+def _key(table, edge_owner, level, kind):
+    h = hashlib.sha1(np.ascontiguousarray(edge_owner, dtype=np.int16).tobytes())
+    # 道路を持ち主の切り替え位置で分割した区間 (ownership.split_segments) も渡せるよう、形状もキーに含める
+    h.update(np.ascontiguousarray(table["offsets"]).tobytes())
+    h.update(np.ascontiguousarray(table["coords"]).tobytes())
+    return f"{h.hexdigest()}_{level}_{kind}"
+
+
+def get_catchments(table, edge_owner, level="mid", kind="lines", cache_dir=CATCHMENT_DIR):
+    """build_catchments の結果を、図形を GeoJSON 文字列にしてキャッシュ付きで返す（同じ持ち主配列なら作り直さない）
+
+    保存済みの図形は文字列のまま返すので、作り直さない限り shapely を読み込まない。
+    """
+    if not np.any(np.asarray(edge_owner) != NO_SHELTER):
+        return _to_geojson(build_catchments(table, edge_owner, level, kind))
+    key = _key(table, edge_owner, level, kind)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    path = os.path.join(cache_dir, f"{key}.json")
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+        result = (np.array(saved["ids"], dtype=np.int16), saved["geometries"])
+        try:
+            os.utime(path)  # 使った時刻を更新し、消す順番を後ろにする
+        except OSError:
+            pass
+    else:
+        result = _to_geojson(build_catchments(table, edge_owner, level, kind))
+        os.makedirs(cache_dir, exist_ok=True)
+        saved = {"ids": result[0].tolist(), "geometries": result[1]}
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(saved, f)
+        os.replace(path + ".tmp", path)
+        prune_files(cache_dir)
+
+    with _lock:
+        _cache[key] = result
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return result
+
+
+def prune_files(cache_dir=CATCHMENT_DIR, max_files=MAX_FILES):
+    """保存した図形のファイルを、最後に使った時刻の新しいものから max_files 個だけ残す"""
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".json"):
+            path = os.path.join(cache_dir, name)
+            try:
+                files.append((os.stat(path).st_mtime_ns, path))
+            except OSError:  # ほかのプロセスが先に消した
+                continue
+    files.sort(reverse=True)
+    for _, path in files[max_files:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def feature_collection(ids, geometries, properties):
+    """GeoJSON の FeatureCollection を作る（geometries は get_catchments の GeoJSON 文字列、
+    properties(避難所ID) が各図形の属性を返す）"""
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": json.loads(geometry), "properties": properties(int(sid))}
+            for sid, geometry in zip(ids, geometries)
+        ],
+    }
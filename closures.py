@@ -0,0 +1,152 @@
+import numpy as np
+from rank_store import DistanceStore, RankStore, sort_by_distance
+
+# --- 通行止めの想定（what-if） ---
+# 保存済みの距離行列を起点に、通行止めにした道路の影響を受けるノードだけ距離を直す。
+# 避難所 s の距離 d について、通行止めの道路が最短経路木に含まれる（d[a] = d[b] + 長さ になっている）
+# 場合だけ、その先で最短経路が「きつい」道路（d[y] = d[x] + 長さ）をたどって届くノード集合を影響範囲とし、
+# 影響範囲の外縁から入る距離を仮想の始点にまとめたダイクストラ法で範囲内だけを計算し直す。
+# 範囲外のノードはどの最短経路も通行止めの道路を通らないので距離は変わらない。
+# 画面は通行止めを指定したときだけ計算するので、scipy は計算する関数の中で読み込む。
+
+TIGHT_TOL = 1e-3  # 距離は float32 で保存しているため、最短経路上の道路かどうかはこの誤差 [m] まで許して判定する
+
+
+def edges_between(table, pairs, both_directions=True):
+    """(始点ノードID, 終点ノードID) の組に該当する道路の番号を返す（既定では逆向きの道路も含める）"""
+    nodes = np.asarray(table["nodes"])
+    u = nodes[np.asarray(table["u"])]
+    v = nodes[np.asarray(table["v"])]
+    pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+    hit = np.zeros(len(u), dtype=bool)
+    for a, b in pairs:
+        hit |= (u == a) & (v == b)
+        if both_directions:
+            hit |= (u == b) & (v == a)
+    return np.flatnonzero(hit)
+
+
+def edges_in_polygon(table, polygon):
+    """形状の頂点が多角形 (shapely) の内側にある道路の番号を返す"""
+    import shapely
+    coords = np.asarray(table["coords"])
+    offsets = np.asarray(table["offsets"])
+    inside = shapely.contains_xy(polygon, coords[:, 0], coords[:, 1])
+    counts = np.add.reduceat(inside.astype(np.int64), offsets[:-1]) if len(coords) else np.zeros(0)
+    return np.flatnonzero(counts > 0)
+
+
+def circle(lat, lon, radius):
+    """中心 (緯度, 経度) と半径 [m] の円を経緯度の多角形 (shapely) で返す"""
+    from shapely import affinity
+    from shapely.geometry import Point
+    deg = radius / 111320.0  # 緯度1度あたりの距離 [m]
+    return affinity.scale(Point(lon, lat).buffer(deg), xfact=1 / np.cos(np.radians(lat)), yfact=1.0)
+
+
+class ClosureModel:
+    """道路形状テーブルと距離行列から、通行止めの影響を部分的に計算し直すためのモデル"""
+
+    def __init__(self, table, distances):
+        self.table = table
+        self.distances = distances
+        from rank_engine import table_to_csr
+        # 距離行列と同じ道路グラフ（辺の向きを逆にし、多重辺は最短のもの）を辺の一覧にして使う
+        graph = table_to_csr(table)[0].tocoo()
+        self.src = graph.row.astype(np.int64)  # 逆向きの辺 src → dst
+        self.dst = graph.col.astype(np.int64)
+        self.w = graph.data.astype(np.float64)
+        self.n_nodes = len(table["nodes"])
+
+    def _closed_mask(self, edge_index):
+        # 道路番号 (u → v) を逆向きの辺 (v → u) の位置に変換する
+        u = np.asarray(self.table["u"], dtype=np.int64)[edge_index]
+        v = np.asarray(self.table["v"], dtype=np.int64)[edge_index]
+        closed_keys = np.unique(v * self.n_nodes + u)
+        return np.isin(self.src * self.n_nodes + self.dst, closed_keys)
+
+    def _repair(self, d, closed):
+        """1つの避難所の距離 d について、通行止めの影響範囲だけを計算し直す（変わらなければ None）"""
+        import scipy.sparse as sp
+        from scipy.sparse.csgraph import breadth_first_order, dijkstra
+        src, dst, w = self.src, self.dst, self.w
+        finite = np.isfinite(d[src])
+        with np.errstate(invalid='ignore'):
+            tight = finite & (np.abs(d[dst] - (d[src] + w)) <= TIGHT_TOL)
+        seeds = np.unique(dst[tight & closed])
+        if len(seeds) == 0:
+            return None
+
+        # 通行止めの道路の先で、最短経路をたどって届くノードが影響範囲
+        n = self.n_nodes
+        t_src = np.concatenate([src[tight & ~closed], np.full(len(seeds), n)])
+        t_dst = np.concatenate([dst[tight & ~closed], seeds])
+        tight_graph = sp.csr_matrix((np.ones(len(t_src)), (t_src, t_dst)), shape=(n + 1, n + 1))
+        area = breadth_first_order(tight_graph, n, directed=True, return_predecessors=False)
+        area = np.sort(area[area != n])
+
+        # 影響範囲の外から範囲内へ入る道路を仮想の始点からの辺にまとめ、範囲内だけダイクストラ法を解く
+        local = np.full(n, -1, dtype=np.int64)
+        local[area] = np.arange(len(area))
+        into = (local[dst] >= 0) & (local[src] < 0) & ~closed & finite
+        entry = np.full(len(area), np.inf)
+        np.minimum.at(entry, local[dst[into]], d[src[into]] + w[into])
+        inner = (local[dst] >= 0) & (local[src] >= 0) & ~closed
+        m = len(area)
+        has_entry = np.isfinite(entry)
+        sub = sp.csr_matrix(
+            (np.concatenate([w[inner], entry[has_entry]]),
+             (np.concatenate([local[src[inner]], np.full(has_entry.sum(), m)]),
+              np.concatenate([local[dst[inner]], np.flatnonzero(has_entry)]))),
+            shape=(m + 1, m + 1),
+        )
+        new = dijkstra(sub, directed=True, indices=m)[:m]
+        return area, new
+
+    def apply(self, edge_index):
+        """道路番号の集合を通行止めにした距離行列を返す
+
+        戻り値は (通行止め後の DistanceStore, 距離が変わったノードの bool 配列, 計算し直した避難所の行番号)。
+        """
+        closed = self._closed_mask(np.asarray(edge_index, dtype=np.int64))
+        base = self.distances.dist
+        dist = np.array(base, dtype=np.float32)
+        changed = np.zeros(self.n_nodes, dtype=bool)
+        repaired = []
+
+        # 通行止めの道路がどれかの最短経路に使われている避難所だけを、まとめて絞り込む
+        c_src, c_dst, c_w = self.src[closed], self.dst[closed], self.w[closed]
+        with np.errstate(invalid='ignore'):
+            uses = np.abs(dist[:, c_dst] - (dist[:, c_src] + c_w)) <= TIGHT_TOL
+        for row in np.flatnonzero(uses.any(axis=1)):
+            result = self._repair(np.asarray(base[row], dtype=np.float64), closed)
+            if result is None:
+                continue
+            area, new = result
+            new = new.astype(np.float32)
+            changed[area[new != dist[row, area]]] = True
+            dist[row, area] = new
+            repaired.append(row)
+        scenario = DistanceStore(self.distances.node_ids, self.distances.shelter_ids, dist)
+        return scenario, changed, np.array(repaired, dtype=np.int64)
+
+
+def scenario_store(store, scenario, changed, shelters=None):
+    """通行止め後の距離行列から、距離が変わったノードの列だけランキングを並べ直した RankStore を返す
+
+    有効な避難所IDを保存していない旧形式のランキングでは shelters に渡す。
+    """
+    if store.shelters is not None:
+        shelters = store.shelters
+    rows = scenario.rows(shelters)
+    cols = np.flatnonzero(changed)
+    ranks = np.array(store.ranks)
+    dist = None if store.dist is None else np.array(store.dist)
+    if len(cols):
+        new_ranks, new_dist = sort_by_distance(
+            scenario.dist[np.ix_(rows, cols)], scenario.shelter_ids[rows], store.depth
+        )
+        ranks[:, cols] = new_ranks
+        if dist is not None:
+            dist[:, cols] = new_dist
+    return RankStore(store.node_ids, ranks, dist, np.asarray(shelters, dtype=np.int16), scenario)
@@ -1,77 +1,60 @@
-import osmnx as ox
-import networkx as nx
 import pandas as pd
-import pickle
 import os
+from build_graph import load_graph
+from cache_manifest import record_artifacts
+from hazards import ALL_SHELTERS, HAZARD_COLS, hazard_active
+from rank_engine import compute_distances, save_rankings
+from rank_store import save_distances, save_manifest, store_path
+from update_ranks import MASTER_TOP_K, shelter_manifest
 
 # --- 設定 ---
 CSV_FILE = "emergency_shelter_maebashi.csv"
 GRAPH_CACHE = "maebashi_graph.graphml"  # 拡張子が .gz か確認してください
 RESULT_CACHE_DIR = "cache_results1"
+TOP_K = 8  # 保存する順位の数（None で全順位）。より深い順位は距離行列から都度計算する
+WORKERS = None  # ダイクストラ法を並列に実行するプロセス数（None でCPUコア数、1 で並列化しない）
 
 if not os.path.exists(RESULT_CACHE_DIR):
     os.makedirs(RESULT_CACHE_DIR)
 
 def generate_rankings():
     print("🚀 解析を開始します。これには時間がかかります...")
-    G = ox.load_graphml(GRAPH_CACHE)
-    # 重みとして距離(length)を使用
+    # GraphML を毎回解析せず、書き出し済みの道路グラフを読む（重みは距離 length）
+    table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
     
     try:
         df = pd.read_csv(CSV_FILE, encoding='utf-8')
     except:
         df = pd.read_csv(CSV_FILE, encoding='cp932')
 
-    # 解析したい災害列リスト（すべて網羅）
-    ST_COLS = {
-        "flood": "flood",
-        "landslides_debrisflow_mudslides": "landslides_debrisflow_mudslides", # mudに統一
-        "storm_surge": "storm_surge",
-        "earthquake": "earthquake",
-        "tsunami": "tsunami",
-        "largescale_fire": "largescale_fire",
-        "inlandflooding": "inlandflooding",
-        "volcanic_phenomena": "volcanic_phenomena"
-    }
-
-    # 全ノードのリスト
-    nodes = list(G.nodes())
-
-    for label, col in ST_COLS.items():
-        save_path = os.path.join(RESULT_CACHE_DIR, f"full_ranks_{col}.pkl")
+    # 全避難所への距離行列を1度だけ計算し、各災害のランキングをそこから導出する
+    # 経路の復元 (routes.py) に使う最短経路木も一緒に保存する
+    node_ids, dist, shelter_idx, pred = compute_distances(
+        table, df, progress=lambda done, total: print(f"\r⏳ 距離計算中... {done}/{total}", end="", flush=True),
+        workers=WORKERS, predecessors=True,
+    )
+    print()
+    save_distances(node_ids, df.index, dist, RESULT_CACHE_DIR, pred)
+    save_manifest(shelter_manifest(df, node_ids[shelter_idx]), RESULT_CACHE_DIR)
+    record_artifacts(["distances"], df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+
+    for col in HAZARD_COLS:
+        save_path = store_path(col, RESULT_CACHE_DIR)
         print(f"--- {col} の解析中 ---")
 
-        # その災害で利用可能な避難所を抽出
-        active_shelters = df[df[col] == True]
-        if active_shelters.empty:
+        if not (df[col] == True).any():
             print(f"⚠️ {col} に該当する避難所がないためスキップします。")
             continue
 
-        # 避難所に最も近い道路ノードを取得
-        target_nodes = ox.nearest_nodes(G, active_shelters['lon'], active_shelters['lat'])
-        # 避難所IDとノードIDの対応マップ
-        node_to_shelter_id = {node: sid for node, sid in zip(target_nodes, active_shelters.index)}
-
-        node_rankings = {}
-        
-        # 多対多の最短経路計算（各ノードから全避難所への距離順を計算）
-        for node in nodes:
-            # 各避難所ノードへの距離を計算し、近い順にソートして保持
-            distances = {}
-            for target_node, sid in node_to_shelter_id.items():
-                try:
-                    dist = nx.shortest_path_length(G, node, target_node, weight='length')
-                    distances[sid] = dist
-                except nx.NetworkXNoPath:
-                    continue
-            
-            # 距離が近い順に避難所IDを並べ替えて保存
-            sorted_shelters = sorted(distances, key=distances.get)
-            node_rankings[node] = sorted_shelters
-
-        with open(save_path, 'wb') as f:
-            pickle.dump(node_rankings, f)
+        save_rankings(save_path, node_ids, dist, df.index, (df[col] == True).to_numpy(), TOP_K)
+        record_artifacts([f"ranks_{col}"], df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
         print(f"✅ {save_path} を作成しました。")
 
+    # 災害を組み合わせた問い合わせ用に、全避難所の全順位のランキングも作る
+    save_rankings(store_path(ALL_SHELTERS, RESULT_CACHE_DIR), node_ids, dist, df.index,
+                  hazard_active(df, ALL_SHELTERS), MASTER_TOP_K)
+    record_artifacts([f"ranks_{ALL_SHELTERS}"], df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+    print(f"✅ {store_path(ALL_SHELTERS, RESULT_CACHE_DIR)} を作成しました。")
+
 if __name__ == "__main__":
     generate_rankings()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from cache_manifest import load_cache_manifest
+from rank_store import RESULT_CACHE_DIR, load_ranks, store_path
+from shelter_table import load_shelters
+
+# --- プロセス全体で共有する読み込み済みデータ ---
+# Streamlit はセッションごと・操作ごとにスクリプトを実行し直すが、このモジュールは
+# プロセスに1度だけ読み込まれるため、ここに置いたデータは全セッションで共有される。
+# ランキングはメモリマップの読み取り専用ビューなので、何セッションから参照しても実体は1つ。
+# キーには災害種類と成果物のハッシュ（目録の記録とファイルの更新時刻）を使い、
+# 入力が変わらない限り再実行では何も読み直さない。保持する数は LRU で上限を設ける。
+
+MAX_STORES = 4  # 同時に保持する災害種類のランキングの数
+
+_lock = threading.Lock()
+_stores = OrderedDict()  # キー → RankStore
+_shelters = {}  # (CSV のパス, キャッシュフォルダ) → (キー, DataFrame)
+
+
+def _stat_key(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def artifact_key(hazard, cache_dir=RESULT_CACHE_DIR):
+    """災害種類のランキングを識別するキー（作り直されると変わる）"""
+    entry = load_cache_manifest(cache_dir)["artifacts"].get(f"ranks_{hazard}")
+    return (
+        os.path.abspath(cache_dir), hazard,
+        json.dumps(entry, sort_keys=True) if entry else None,
+        _stat_key(os.path.join(store_path(hazard, cache_dir), "ranks.npy")),
+        _stat_key(os.path.join(cache_dir, f"full_ranks_{hazard}.pkl")),
+    )
+
+
+def get_ranks(hazard, cache_dir=RESULT_CACHE_DIR):
+    """災害種類のランキング (RankStore) を返す。同じ成果物なら全セッションで同じものを使い回す
+
+    存在しない場合は None（None はキャッシュしない）。
+    """
+    key = artifact_key(hazard, cache_dir)
+    with _lock:
+        if key in _stores:
+            _stores.move_to_end(key)
+            return _stores[key]
+        store = load_ranks(hazard, cache_dir)
+        if store is None:
+            return None
+        # 旧 .pkl から変換した直後は ranks.npy ができてキーが変わるので、変換後のキーで保持する
+        key = artifact_key(hazard, cache_dir)
+        # 作り直される前の同じ災害のランキングは、もう参照されないので捨てる
+        for old in [k for k in _stores if k[:2] == key[:2]]:
+            del _stores[old]
+        _stores[key] = store
+        while len(_stores) > MAX_STORES:
+            _stores.popitem(last=False)
+        return store
+
+
+def get_shelters(csv_file, cache_dir=RESULT_CACHE_DIR):
+    """避難所テーブル (shelter_table.load_shelters) を返す（CSV が変わらない限り読み直さない）
+
+    全セッションで同じ DataFrame を返すので、呼び出し側では書き換えずに .copy() してから加工する。
+    """
+    key = _stat_key(csv_file)
+    with _lock:
+        cached = _shelters.get((csv_file, cache_dir))
+        if cached is None or cached[0] != key:
+            cached = (key, load_shelters(csv_file, cache_dir))
+            _shelters[(csv_file, cache_dir)] = cached
+        return cached[1]
+
+
+def clear():
+    """保持しているデータをすべて捨てる"""
+    with _lock:
+        _stores.clear()
+        _shelters.clear()
@@ -0,0 +1,103 @@
+import numpy as np
+import os
+import sys
+
+# --- 道路形状テーブル ---
+# GraphML の読み込み（XML 解析と shapely の形状生成）は起動のたびに行うと遅いため、
+# 道路の端点・長さ・形状を一度だけ列形式の .npy に書き出し、以降は np.load(mmap_mode='r') で読む。
+# cache_results/edges/ 以下のファイル:
+#   nodes.npy   : ソート済みの道路ノードID (int64, ノード数)
+#   x.npy, y.npy: ノードの経度・緯度 (float64, ノード数)
+#   u.npy, v.npy: 道路の始点・終点ノードの nodes.npy 上の位置 (int32, 道路数)
+#   length.npy  : 道路の長さ [m] (float32, 道路数)
+#   coords.npy  : 全道路の形状の座標を連結したもの (float64, 点数 × 2, [経度, 緯度])
+#   offsets.npy : 道路 i の座標は coords[offsets[i]:offsets[i + 1]] (int64, 道路数 + 1)
+
+GRAPH_CACHE = "maebashi_graph.graphml"
+EDGE_TABLE_DIR = os.path.join("cache_results", "edges")
+EDGE_TABLE_FILES = ("nodes", "x", "y", "u", "v", "length", "coords", "offsets")
+
+
+def edge_table_from_graph(G):
+    """道路グラフから道路形状テーブル（の配列の辞書）を作る"""
+    node_ids = np.array(sorted(G.nodes()), dtype=np.int64)
+    x = np.array([G.nodes[n]['x'] for n in node_ids.tolist()], dtype=np.float64)
+    y = np.array([G.nodes[n]['y'] for n in node_ids.tolist()], dtype=np.float64)
+    node_pos = {node: i for i, node in enumerate(node_ids.tolist())}
+
+    us, vs, lengths, coords, counts = [], [], [], [], []
+    for u, v, data in G.edges(data=True):
+        if 'geometry' in data:
+            points = list(data['geometry'].coords)
+        else:
+            points = [(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])]
+        us.append(node_pos[u])
+        vs.append(node_pos[v])
+        lengths.append(data.get('length', 0.0))
+        coords.extend(points)
+        counts.append(len(points))
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {
+        "nodes": node_ids, "x": x, "y": y,
+        "u": np.array(us, dtype=np.int32), "v": np.array(vs, dtype=np.int32),
+        "length": np.array(lengths, dtype=np.float32),
+        "coords": np.array(coords, dtype=np.float64).reshape(-1, 2),
+        "offsets": offsets,
+    }
+
+
+def save_edge_table(table, path=EDGE_TABLE_DIR):
+    """道路形状テーブルを保存して返す"""
+    os.makedirs(path, exist_ok=True)
+    for name in EDGE_TABLE_FILES:
+        np.save(os.path.join(path, f"{name}.npy"), table[name])
+    return table
+
+
+def build_edge_table(G, path=EDGE_TABLE_DIR):
+    """道路グラフから道路形状テーブルを作って保存する"""
+    return save_edge_table(edge_table_from_graph(G), path)
+
+
+def load_edge_table(path=EDGE_TABLE_DIR):
+    """保存済みの道路形状テーブルをメモリマップで開く（存在しない場合は None）"""
+    if not all(os.path.exists(os.path.join(path, f"{name}.npy")) for name in EDGE_TABLE_FILES):
+        return None
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in EDGE_TABLE_FILES}
+
+
+def load_or_build_edge_table(graph_path=GRAPH_CACHE, path=EDGE_TABLE_DIR):
+    """道路形状テーブルを開く。まだなければ GraphML（または OSM 抽出ファイル）から一度だけ作る
+
+    入力ファイルもない場合は None を返す。入力ファイルとの照合もする場合は build_graph.load_graph を使う。
+    """
+    table = load_edge_table(path)
+    if table is None and os.path.exists(graph_path):
+        from build_graph import build_graph
+        build_graph(graph_path, path)
+        table = load_edge_table(path)
+    return table
+
+
+def edge_node_ids(table):
+    """各道路の始点・終点の道路ノードIDを返す"""
+    nodes = table["nodes"]
+    return nodes[table["u"]], nodes[table["v"]]
+
+
+def edge_paths(table):
+    """道路ごとの [[経度, 緯度], ...] のリストを返す（pydeck の PathLayer 用）"""
+    flat = np.asarray(table["coords"]).tolist()
+    offsets = np.asarray(table["offsets"]).tolist()
+    return [flat[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+if __name__ == "__main__":
+    # 使い方: python edge_table.py [GraphML または OSM 抽出ファイル] [出力フォルダ]
+    from build_graph import build_graph
+    graph_path = sys.argv[1] if len(sys.argv) > 1 else GRAPH_CACHE
+    out_path = sys.argv[2] if len(sys.argv) > 2 else EDGE_TABLE_DIR
+    table = build_graph(graph_path, out_path)
+    print(f"✅ {out_path} に道路 {len(table['u'])} 本の形状を書き出しました。")
@@ -0,0 +1,45 @@
+import numpy as np
+
+# --- 災害種類の設定 ---
+# UI の表示名と CSV の災害フラグ列名の対応表。列名の表記ゆれ（medslides / mudslides など）で
+# キャッシュが見つからなくなるのを防ぐため、すべてのスクリプトはこの表を使う。
+# 複数の災害が重なる場合（地震と火事など）は、避難所ごとの災害フラグをビット列 (HAZARD_BITS) にまとめ、
+# 選んだ災害のビットがすべて立っている避難所だけを、全避難所のランキング (ALL_SHELTERS) から数える。
+
+ST_COLS = {
+    "洪水": "flood", "崖崩れ、土石流及び地滑り": "landslides_debrisflow_mudslides",
+    "高潮": "storm_surge", "地震": "earthquake", "津波": "tsunami",
+    "大規模な火事": "largescale_fire", "内水氾濫": "inlandflooding", "火山現象": "volcanic_phenomena"
+}
+HAZARD_COLS = list(ST_COLS.values())
+HAZARD_BITS = {col: 1 << i for i, col in enumerate(HAZARD_COLS)}
+ALL_SHELTERS = "all"  # 全避難所のランキング（災害の組み合わせの問い合わせに使う）の名前
+
+
+def hazard_active(df, col):
+    """災害 col に対応する避難所の bool 配列（ALL_SHELTERS なら全避難所）"""
+    if col == ALL_SHELTERS:
+        return np.ones(len(df), dtype=bool)
+    return (df[col] == True).to_numpy(dtype=bool)
+
+
+def hazard_mask(cols):
+    """災害列のリストのビット列"""
+    mask = 0
+    for col in cols:
+        mask |= HAZARD_BITS[col]
+    return mask
+
+
+def shelter_bits(df):
+    """避難所ごとの対応する災害のビット列 (uint16)"""
+    bits = np.zeros(len(df), dtype=np.uint16)
+    for col, bit in HAZARD_BITS.items():
+        if col in df.columns:
+            bits[hazard_active(df, col)] |= bit
+    return bits
+
+
+def eligible_shelters(bits, mask):
+    """ビット列 mask の災害すべてに対応する避難所の位置"""
+    return np.flatnonzero((bits & mask) == mask)
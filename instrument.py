@@ -0,0 +1,197 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+# --- 処理時間の計測 ---
+# Streamlit の1回の実行（再実行）ごとに、名前付きの区間 (span) の経過時間とメモリ使用量を記録する。
+#   with trace_run("UI2"):       1回の実行全体を計測する（アプリの main() を囲む）
+#       with span("ランキング読み込み"):  区間を計測する（入れ子にすると "親/子" の名前になる）
+# 計測が無効なとき span は何もしないので、常に埋め込んでおいてよい。
+# 有効にする方法:
+#   環境変数 SHELTER_PROFILE=1        : 計測して、画面下部に内訳を表示し、ログに書き出す
+#   環境変数 SHELTER_PROFILE=cprofile : 上記に加えて cProfile の結果も保存する
+#   サイドバーの「管理者メニュー」     : セッションごとに同じ設定を切り替える
+# PROFILE_DIR に次のファイルを書き出す。
+#   instrument.jsonl    : 実行ごとの区間の内訳（1行1実行の JSON）
+#   <アプリ>_<時刻>.prof  : cProfile の結果 (python -m pstats / snakeviz で開ける)
+#   <アプリ>_<時刻>.folded: 区間の折りたたみスタック形式 (py-spy --format raw と同じ形式。
+#                           flamegraph.pl や speedscope で開ける。値は自分自身の時間 [μs])
+
+ENV_VAR = "SHELTER_PROFILE"
+PROFILE_DIR = "profiles"
+LOG_FILE = "instrument.jsonl"
+SESSION_KEY = "instrument_mode"  # サイドバーで選んだ計測方法を保存する st.session_state のキー
+MODES = {"off": "計測しない", "spans": "区間の計測", "cprofile": "区間の計測 + cProfile"}
+
+_local = threading.local()  # Streamlit はセッションごとに別スレッドで実行するため、計測中の記録はスレッドごとに持つ
+
+
+def rss_mb():
+    """現在の常駐メモリ [MB]（測れない環境では None）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # /proc がない環境ではピーク値で代用する（macOS はバイト単位）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+class RunTrace:
+    """1回の実行で記録した区間の一覧"""
+
+    def __init__(self, app):
+        self.app = app
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = datetime.now()
+        self.spans = []  # 開始順の区間 {path, depth, wall, self, rss, delta}（終了時に値を埋める）
+        self.total = None
+        self._stack = []  # 計測中の区間の (spans 上の位置, 開始時刻, 開始時の RSS)
+
+    def _enter(self, name):
+        path = "/".join([self.spans[i]["path"] for i, _, _ in self._stack[-1:]] + [name])
+        self.spans.append({"path": path, "depth": len(self._stack), "wall": None, "self": None,
+                           "rss": None, "delta": None, "child": 0.0})
+        self._stack.append((len(self.spans) - 1, time.perf_counter(), rss_mb()))
+
+    def _exit(self):
+        index, t0, rss0 = self._stack.pop()
+        wall = time.perf_counter() - t0
+        rss = rss_mb()
+        record = self.spans[index]
+        record.update(wall=wall, self=wall - record.pop("child"), rss=rss,
+                      delta=None if rss is None or rss0 is None else rss - rss0)
+        if self._stack:
+            self.spans[self._stack[-1][0]]["child"] += wall
+
+    def rows(self):
+        """区間を開始順に並べた表示用の行"""
+        return [
+            {"区間": "　" * r["depth"] + r["path"].split("/")[-1], "時間 (ms)": round(r["wall"] * 1000, 1),
+             "割合 (%)": round(r["wall"] / self.total * 100, 1) if self.total else None,
+             "RSS (MB)": None if r["rss"] is None else round(r["rss"], 1),
+             "RSS 増減 (MB)": None if r["delta"] is None else round(r["delta"], 1)}
+            for r in self.spans if r["wall"] is not None
+        ]
+
+    def to_record(self):
+        rss = rss_mb()
+        return {
+            "time": self.started.isoformat(timespec="seconds"),
+            "app": self.app, "run": self.run_id,
+            "total_ms": None if self.total is None else round(self.total * 1000, 2),
+            "rss_mb": None if rss is None else round(rss, 1),
+            "spans": [
+                {"name": r["path"], "ms": round(r["wall"] * 1000, 2), "self_ms": round(r["self"] * 1000, 2),
+                 "rss_mb": None if r["rss"] is None else round(r["rss"], 1),
+                 "rss_delta_mb": None if r["delta"] is None else round(r["delta"], 2)}
+                for r in self.spans if r["wall"] is not None
+            ],
+        }
+
+    def folded(self):
+        """折りたたみスタック形式の行（"アプリ;親;子 自分自身の時間[μs]"）"""
+        return [f"{self.app};{r['path'].replace('/', ';')} {max(int(r['self'] * 1e6), 0)}"
+                for r in self.spans if r["wall"] is not None]
+
+
+def current():
+    """計測中の RunTrace（計測していなければ None）"""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def span(name):
+    """名前付きの区間を計測する（計測中でなければ何もしない）"""
+    trace = current()
+    if trace is None:
+        yield
+        return
+    trace._enter(name)
+    try:
+        yield
+    finally:
+        trace._exit()
+
+
+def mode(session_state=None):
+    """計測方法 ("off" | "spans" | "cprofile")。サイドバーの選択があればそれを、なければ環境変数に従う"""
+    if session_state is not None and session_state.get(SESSION_KEY) in MODES:
+        return session_state[SESSION_KEY]
+    value = os.environ.get(ENV_VAR, "").strip().lower()
+    if value in ("", "0", "off", "false"):
+        return "off"
+    return "cprofile" if value == "cprofile" else "spans"
+
+
+def admin_sidebar():
+    """サイドバーの管理者メニューに計測方法の切り替えを表示する"""
+    import streamlit as st
+    with st.sidebar.expander("管理者メニュー"):
+        current_mode = mode(st.session_state)
+        st.radio("処理時間の計測", list(MODES), index=list(MODES).index(current_mode),
+                 format_func=MODES.get, key=SESSION_KEY)
+        st.caption(f"環境変数 {ENV_VAR}=1 / cprofile でも有効にできます。結果は {PROFILE_DIR}/ に保存されます。")
+
+
+def write_logs(trace, profiler=None, out_dir=PROFILE_DIR):
+    """区間の内訳をログに追記し、cProfile と折りたたみスタックの結果を保存する"""
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, LOG_FILE), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(trace.to_record(), ensure_ascii=False) + "\n")
+    if profiler is not None:
+        stem = os.path.join(out_dir, f"{trace.app}_{trace.started:%Y%m%d_%H%M%S}_{trace.run_id}")
+        profiler.dump_stats(stem + ".prof")
+        with open(stem + ".folded", 'w', encoding='utf-8') as f:
+            f.write("\n".join(trace.folded()) + "\n")
+
+
+def render(trace):
+    """画面下部に区間の内訳を表示する"""
+    import streamlit as st
+    with st.expander(f"⏱ 処理時間の内訳（合計 {trace.total * 1000:.0f} ms）", expanded=False):
+        st.dataframe(trace.rows(), hide_index=True)
+
+
+@contextmanager
+def trace_run(app, enabled=None):
+    """アプリの1回の実行全体を計測する
+
+    enabled を省略すると、サイドバーの選択または環境変数 SHELTER_PROFILE に従う。
+    st.stop() などで途中で終わった場合もログには書き出す（画面への表示は省く）。
+    """
+    import streamlit as st
+    run_mode = mode(st.session_state) if enabled is None else ("spans" if enabled else "off")
+    if run_mode == "off":
+        yield None
+        return
+
+    trace = RunTrace(app)
+    profiler = cProfile.Profile() if run_mode == "cprofile" else None
+    _local.trace = trace
+    t0 = time.perf_counter()
+    completed = False
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield trace
+        completed = True
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        trace.total = time.perf_counter() - t0
+        _local.trace = None
+        write_logs(trace, profiler)
+    if completed:
+        render(trace)
@@ -1,19 +1,29 @@
 import streamlit as st
-import osmnx as ox
-import pandas as pd
 import folium
 from streamlit_folium import st_folium
 import random
 import os
-import pickle
-import networkx as nx
+import numpy as np
+from build_graph import load_graph
+from edge_table import edge_node_ids
+from ownership import edge_segments
+from catchments import feature_collection, get_catchments, zoom_level
+from query import NodeLocator, nearest_shelters, query_frame
+from cache_manifest import artifact_status, record_artifacts
+from data_cache import get_ranks, get_shelters
+from hazards import ST_COLS
+from instrument import admin_sidebar, span, trace_run
+from rank_store import NO_SHELTER, load_distances, save_distances, save_manifest, store_path
+from regions import get_region, is_partitioned, missing_inputs, load_view, rank_limit
+from routes import RouteFinder, has_routes
+from analytics import WALK_SPEED
 
 # --- 1. パスワード認証機能 ---
 APP_PASSWORD = "114" 
 
 def check_password():
     if "password_correct" not in st.session_state:
-        st.title("前橋市 避難所解析システム")
+        st.title(f"{REGION['label']} 避難所解析システム")
         st.subheader("🔒 ログインが必要です")
         st.text_input("パスワードを入力してください", type="password", key="pwd_input")
         if st.button("ログイン"):
@@ -26,58 +36,89 @@ def check_password():
     return True
 
 # --- 2. 高速化のための計算ロジック (全順位一括計算) ---
-def calculate_all_ranks_voronoi(G, shelters_df):
-    """道路上の各地点から、全避難所への『近い順リスト』を作成する"""
-    shelter_nodes = ox.nearest_nodes(G, shelters_df['lon'], shelters_df['lat'])
-    node_to_shelter_id = dict(zip(shelter_nodes, shelters_df.index))
-    
-    node_rankings = {node: [] for node in G.nodes()}
-    unique_shelter_nodes = list(set(shelter_nodes))
-    
+def calculate_all_ranks_voronoi(table, shelters_df):
+    """道路上の各地点から、全避難所への距離行列を作成する（順位はこの行列から導出する）
+
+    戻り値は (ノードID配列, 距離行列 (避難所数, ノード数), 各避難所のノード位置, 最短経路木)。
+    """
+    from rank_engine import shelter_distance_matrix, snap_shelters, table_to_csr
+    csr, node_ids = table_to_csr(table)
+    shelter_idx = snap_shelters(table, shelters_df)
+
     prog_bar = st.progress(0, text="全順位の距離計算中...")
-    for i, s_node in enumerate(unique_shelter_nodes):
-        lengths = nx.single_source_dijkstra_path_length(G, s_node, weight='length')
-        for node, dist in lengths.items():
-            node_rankings[node].append((dist, node_to_shelter_id[s_node]))
-        prog_bar.progress((i + 1) / len(unique_shelter_nodes))
-    
-    # 距離順にソートしてIDだけのリストに変換
-    for node in node_rankings:
-        node_rankings[node].sort()
-        node_rankings[node] = [val[1] for val in node_rankings[node]]
-    
+    dist, pred = shelter_distance_matrix(
+        csr, shelter_idx, progress=lambda done, total: prog_bar.progress(done / total), workers=WORKERS,
+        predecessors=True,
+    )
+
     prog_bar.empty()
-    return node_rankings
+    return node_ids, dist, shelter_idx, pred
 
 # --- 3. メインアプリ設定 ---
-CSV_FILE = "emergency_shelter_maebashi.csv"
-GRAPH_CACHE = "maebashi_graph.graphml"
-RESULT_CACHE_DIR = "cache_results"
+# 対象地域は環境変数 SHELTER_REGION で選ぶ（regions.json。既定は前橋市）
+REGION = get_region()
+CSV_FILE = REGION["csv"]
+GRAPH_CACHE = REGION["graph"]
+RESULT_CACHE_DIR = REGION["cache_dir"]
+TOP_K = 8  # 保存する順位の数（None で全順位）。より深い順位は距離行列から都度計算する
+# ダイクストラ法を並列に実行するプロセス数。Streamlit のサーバー（スレッドを使う）から fork するのは安全でなく、
+# セッションごとにプロセスが増えるため、画面では並列化しない。全コアでの計算は python update_ranks.py などで行う
+WORKERS = 1
+
+@st.cache_resource
+def get_road_graph():
+    # 計算・描画とも書き出し済みの道路形状テーブルを使う（GraphML / OSM 抽出ファイルと一致しなければ作り直す）
+    table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+    if table is not None:
+        return table
+    # 手元にグラフも抽出ファイルもない場合だけ、OpenStreetMap からダウンロードする
+    import osmnx as ox
+    ox.save_graphml(ox.graph_from_place(REGION["place"], network_type='walk'), GRAPH_CACHE)
+    return load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+
+@st.cache_resource
+def load_graph_edges():
+    table = get_road_graph()
+    u, v = edge_node_ids(table)
+    return {"u": u, "v": v, "table": table}
+
+@st.cache_resource
+def get_locator():
+    # 地図上の任意の地点を道路ノードに紐づける KD 木（道路形状テーブルのノード座標から1度だけ作る）
+    table = get_road_graph()
+    return NodeLocator(table["nodes"], table["x"], table["y"])
 
 @st.cache_resource
-def get_maebashi_graph():
-    if os.path.exists(GRAPH_CACHE):
-        return ox.load_graphml(GRAPH_CACHE)
-    G = ox.graph_from_place("Maebashi, Gunma, Japan", network_type='walk')
-    ox.save_graphml(G, GRAPH_CACHE)
-    return G
+def get_route_finder():
+    # 最短経路木をたどった経路に道路の形状をつけるための索引（道路形状テーブルから1度だけ作る）
+    return RouteFinder(get_road_graph())
+
+def find_route(store, point, n_rank):
+    """クリック地点から n番目に近い避難所までの経路 (避難所ID, 座標, 道路距離 [m])。求まらない場合は None"""
+    if is_partitioned(REGION) or not has_routes(store.distances):
+        return None
+    node_ids, _ = get_locator().nearest([point[0]], [point[1]])
+    ids, _ = nearest_shelters(store, node_ids, n_rank)
+    if ids[0, n_rank - 1] == NO_SHELTER:
+        return None
+    found = get_route_finder().route(store.distances, node_ids[0], int(ids[0, n_rank - 1]))
+    return None if found is None else (int(ids[0, n_rank - 1]), found[1], found[2])
 
 def main():
     if not check_password(): st.stop()
 
+    missing = missing_inputs(REGION)
+    if missing:
+        st.error(f"{REGION['label']} の入力ファイルが見つかりません: {', '.join(missing)}（regions.json の設定を確認してください）")
+        st.stop()
+
     # データの読み込み
-    try:
-        df = pd.read_csv(CSV_FILE, encoding='utf-8')
-    except:
-        df = pd.read_csv(CSV_FILE, encoding='cp932')
+    # CSV とランキングはプロセス全体で共有し、入力が変わらない限り再実行では読み直さない
+    with span("CSV 読み込み"):
+        df = get_shelters(CSV_FILE, RESULT_CACHE_DIR)
 
     # サイドバー設定
     st.sidebar.header("1. 解析条件")
-    ST_COLS = {
-        "洪水": "flood", "崖崩れ,土石流及び地滑り": "landslides_debrisflow_medslides",
-        "高潮": "storm_surge", "地震": "earthquake", "津波": "tsunami",
-        "大規模な火事": "largescale_fire", "内水氾濫": "inlandflooding", "火山現象": "volcanic_phenomena"
-    }
     selected_label = st.sidebar.selectbox("災害種類", list(ST_COLS.keys()))
     disaster_col = ST_COLS[selected_label]
     
@@ -88,7 +129,10 @@ def main():
         st.error("利用可能な施設がありません")
         st.stop()
 
-    n_rank = st.sidebar.number_input(f"何番目に近い施設 (n) [1〜{max_n}]", 1, max_n, 1)
+    n_limit = rank_limit(REGION, max_n)
+    n_rank = st.sidebar.number_input(f"何番目に近い施設 (n) [1〜{n_limit}]", 1, n_limit, 1)
+    if n_limit < max_n:
+        st.sidebar.caption(f"この地域は分割して計算しているため、n は {n_limit} までです。")
 
     # 強調表示の制御
     if "target_name" not in st.session_state:
@@ -100,6 +144,7 @@ def main():
         index=(["なし"] + active_shelters['name'].tolist()).index(st.session_state.target_name)
     )
     st.session_state.target_name = selected_shelter
+    admin_sidebar()
 
     # 解析実行ボタン
     if st.sidebar.button("解析実行/更新"):
@@ -107,21 +152,80 @@ def main():
         pass
 
     # --- データの準備 ---
-    G = get_maebashi_graph()
-    cache_path = os.path.join(RESULT_CACHE_DIR, f"full_ranks_{disaster_col}.pkl")
+    # 目録と照合し、道路グラフや CSV が変わっていればランキングを計算し直す
+    with span("ランキング読み込み"):
+        status = artifact_status(f"ranks_{disaster_col}", df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+        if is_partitioned(REGION):
+            # 分割して計算した地域は、前回表示していた範囲に重なるタイルだけを読む
+            store = load_view(REGION, disaster_col, st.session_state.get("map_bounds"))
+        else:
+            store = get_ranks(disaster_col, RESULT_CACHE_DIR) if status != "stale" else None
 
-    if os.path.exists(cache_path):
-        with open(cache_path, 'rb') as f:
-            node_rankings = pickle.load(f)
-    else:
+    if store is None and is_partitioned(REGION):
+        st.error(f"解析データがありません。python regions.py {REGION['name']} で作成してください。")
+        st.stop()
+    if status == "stale" and is_partitioned(REGION):
+        st.warning(f"解析データが現在の入力と一致しません。python regions.py {REGION['name']} で更新してください。")
+    if store is None:
         with st.spinner("新規災害パターンの全順位を計算中... (数分かかります)"):
-            node_rankings = calculate_all_ranks_voronoi(G, active_shelters)
-            with open(cache_path, 'wb') as f:
-                pickle.dump(node_rankings, f)
+            # 計算にだけ使うモジュール（scipy を読み込む）は、計算が必要になったときに読み込む
+            from rank_engine import save_rankings, snap_shelters, table_to_csr
+            from streaming import MEMORY_LIMIT_MB, dense_bytes, stream_rankings
+            from update_ranks import shelter_manifest
+            # 全避難所への距離行列があれば再利用し、なければ一度だけ計算して保存する
+            distances = load_distances(RESULT_CACHE_DIR)
+            dist_status = artifact_status("distances", df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+            active = (df[disaster_col] == True).to_numpy()
+            if distances is None or dist_status == "stale" or len(distances.shelter_ids) != len(df):
+                table = get_road_graph()
+                if dense_bytes(len(df), len(table['nodes'])) > MEMORY_LIMIT_MB * 2**20:
+                    # 距離行列がメモリに載らない大きさなら、避難所を少しずつ計算してファイルに書き出す
+                    csr, node_ids = table_to_csr(table)
+                    shelter_idx = snap_shelters(table, df)
+                    prog_bar = st.progress(0, text="全順位の距離計算中...")
+                    stream_rankings(csr, node_ids, shelter_idx, df.index, {disaster_col: active},
+                                    RESULT_CACHE_DIR, TOP_K, MEMORY_LIMIT_MB,
+                                    progress=lambda done, total: prog_bar.progress(done / total))
+                    prog_bar.empty()
+                else:
+                    node_ids, dist, shelter_idx, pred = calculate_all_ranks_voronoi(table, df)
+                    save_distances(node_ids, df.index, dist, RESULT_CACHE_DIR, pred)
+                    save_rankings(store_path(disaster_col, RESULT_CACHE_DIR), node_ids, dist, df.index, active, TOP_K)
+                save_manifest(shelter_manifest(df, node_ids[shelter_idx]), RESULT_CACHE_DIR)
+                record_artifacts(["distances"], df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+            elif distances.dist.nbytes > MEMORY_LIMIT_MB * 2**20:
+                # 保存済みの距離行列を少しずつ読んで、この災害のランキングだけを作る
+                stream_rankings(None, distances.node_ids, None, distances.shelter_ids, {disaster_col: active},
+                                RESULT_CACHE_DIR, TOP_K, MEMORY_LIMIT_MB,
+                                reuse=(distances, np.arange(len(df))), write_distances=False)
+            else:
+                save_rankings(
+                    store_path(disaster_col, RESULT_CACHE_DIR), distances.node_ids, distances.dist,
+                    distances.shelter_ids, active, TOP_K
+                )
+            record_artifacts([f"ranks_{disaster_col}"], df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE)
+            store = get_ranks(disaster_col, RESULT_CACHE_DIR)
             st.success("全順位データの計算・保存が完了しました！")
 
+    # 全道路の n番目の持ち主をまとめて求める
+    with span("道路形状の読み込み"):
+        all_edges = load_graph_edges()
+    # 両端の持ち主が異なる道路は、持ち主が切り替わる位置で分割する
+    with span("道路の分割"):
+        u_pos, v_pos = store.node_index(all_edges['u']), store.node_index(all_edges['v'])
+        segments = edge_segments(all_edges['table'], store.owner(n_rank), store.distance(n_rank), u_pos, v_pos)
+    # 持ち主のない道路も灰色で描くため、避難所IDの範囲外の番号を割り当てる
+    # （読み込んだタイルの外の道路は描かない）
+    edge_owner = segments['owner'].copy()
+    in_view = ((u_pos >= 0) | (v_pos >= 0))[segments['edge']]
+    edge_owner[(edge_owner == NO_SHELTER) & in_view] = len(df)
+
     # --- 地図の作成 ---
-    m = folium.Map(location=[36.3895, 139.0634], zoom_start=13, tiles="cartodbpositron")
+    # 表示中のズームと中心を引き継ぎ、ズームに応じた詳細度の担当範囲を描く
+    zoom = st.session_state.get("map_zoom", REGION["zoom"] + 1)
+    m = folium.Map(location=st.session_state.get("map_center", REGION["center"]), zoom_start=zoom,
+                   tiles="cartodbpositron")
+    level = zoom_level(zoom)
     
     # 色の設定 (施設IDと領域色を一致させる)
     random.seed(42)
@@ -131,21 +235,18 @@ def main():
     if st.session_state.target_name != "なし":
         target_id = active_shelters[active_shelters['name'] == st.session_state.target_name].index[0]
 
-    # 道路網の描画
-    for u, v, data in G.edges(data=True):
-        # n番目の持ち主を特定
-        ranks = node_rankings.get(u, [])
-        owner_id = ranks[n_rank-1] if len(ranks) >= n_rank else None
-        
-        color = color_map.get(owner_id, "#888888")
+    # 道路網の描画（道路1本ずつではなく、施設ごとにまとめた担当範囲を1つの GeoJSON で描く）
+    def road_style(feature):
+        owner_id = feature["properties"]["id"]
         weight, opacity = (8, 1.0) if owner_id == target_id and target_id is not None else (3, 0.6)
         if target_id is not None and owner_id != target_id: opacity = 0.1 # 強調時は他を薄く
+        return {"color": color_map.get(owner_id, "#888888"), "weight": weight, "opacity": opacity}
 
-        points = [(lat, lon) for lon, lat in (data['geometry'].coords if 'geometry' in data else [(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])])]
-        # x, y が逆転している場合があるため修正
-        if not 'geometry' in data: points = [(G.nodes[u]['y'], G.nodes[u]['x']), (G.nodes[v]['y'], G.nodes[v]['x'])]
-        
-        folium.PolyLine(points, color=color, weight=weight, opacity=opacity).add_to(m)
+    with span("担当範囲の図形"):
+        catchment_ids, geoms = get_catchments(segments, edge_owner, level)
+        folium.GeoJson(
+            feature_collection(catchment_ids, geoms, lambda sid: {"id": sid}), style_function=road_style
+        ).add_to(m)
 
     # 施設の描画
     for idx, row in active_shelters.iterrows():
@@ -160,8 +261,55 @@ def main():
             tooltip=row['name']
         ).add_to(m)
 
+    # クリック地点から n番目の避難所までの経路（保存済みの最短経路木をたどるだけで求まる）
+    route_point = st.session_state.get("route_point")
+    route = None
+    if route_point is not None:
+        with span("避難経路"):
+            route = find_route(store, route_point, n_rank)
+    if route is not None:
+        route_id, coords, length = route
+        folium.PolyLine(
+            [route_point] + [(lat, lon) for lon, lat in coords], color="#d62728", weight=6, opacity=0.9,
+            tooltip=f"{df.loc[route_id, 'name']} まで {length:.0f} m（徒歩 約{length / WALK_SPEED:.0f} 分）",
+        ).add_to(m)
+
     # 地図の表示とクリック検知
-    out = st_folium(m, width=1200, height=700, key="main_map")
+    with span("地図の描画 (folium)"):
+        out = st_folium(m, width=1200, height=700, key="main_map")
+
+    # ズームが変わって詳細度が切り替わる場合（分割した地域では表示範囲が動いた場合も）だけ描き直す
+    if out.get("zoom"):
+        st.session_state.map_zoom = out["zoom"]
+        if out.get("center"):
+            st.session_state.map_center = [out["center"]["lat"], out["center"]["lng"]]
+        moved = False
+        if is_partitioned(REGION) and out.get("bounds"):
+            sw, ne = out["bounds"]["_southWest"], out["bounds"]["_northEast"]
+            bounds = (sw["lng"], sw["lat"], ne["lng"], ne["lat"])
+            moved = bounds != st.session_state.get("map_bounds")
+            st.session_state.map_bounds = bounds
+        if zoom_level(out["zoom"]) != level or moved:
+            st.rerun()
+
+    # 地図上の地点クリック: その地点から近い順の避難所と道路距離を表示
+    if out.get("last_clicked"):
+        clicked = out["last_clicked"]
+        st.subheader(f"📍 クリック地点 ({clicked['lat']:.5f}, {clicked['lng']:.5f}) から近い避難所")
+        result = query_frame(get_locator(), store, df, [clicked['lat']], [clicked['lng']], max(n_rank, 3))
+        st.dataframe(result.drop(columns=["地点", "避難所ID"]), hide_index=True)
+        point = (clicked['lat'], clicked['lng'])
+        if st.session_state.get("route_point") != point:
+            # 経路を地図に描くため、クリック地点を覚えて描き直す
+            st.session_state.route_point = point
+            st.rerun()
+        if route is not None:
+            st.caption(f"🚶 {n_rank}番目の避難所「{df.loc[route[0], 'name']}」までの経路を赤線で表示しています"
+                       f"（道路距離 {route[2]:.0f} m・徒歩 約{route[2] / WALK_SPEED:.0f} 分）")
+        elif is_partitioned(REGION) or not has_routes(store.distances):
+            st.caption("経路データがありません。python update_ranks.py --full で距離を計算し直すと経路も表示できます。")
+        else:
+            st.caption(f"この地点から {n_rank}番目の避難所へは道路でたどり着けません。")
 
     # 地図クリック時の連動 (施設クリック)
     if out.get("last_object_clicked_popup"):
@@ -172,4 +320,6 @@ def main():
 
 if __name__ == "__main__":
     if not os.path.exists(RESULT_CACHE_DIR): os.makedirs(RESULT_CACHE_DIR)
-    main()
\ No newline at end of file
+    # 環境変数 SHELTER_PROFILE または管理者メニューで有効にすると、区間ごとの処理時間を表示・記録する
+    with trace_run("order_n-1"):
+        main()
\ No newline at end of file
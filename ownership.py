@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from itertools import compress
+from rank_store import NO_SHELTER
+
+# --- 道路の担当避難所（持ち主）をまとめて求める処理 ---
+# 道路ごとの Python ループをやめ、u側ノードの位置配列とランキングから
+# 持ち主・表示色・避難所ごとの担当道路数を NumPy の一括処理で求める。
+#
+# edge_split / split_segments は道路を両端の持ち主で分割する。道路 (長さ L) 上の u から t の地点の
+# 最寄り避難所までの距離は min(d_u + t, d_v + L - t) なので、u側の持ち主 a と v側の持ち主 b が
+# 異なる道路は t = (d_v(b) + L - d_u(a)) / 2 で持ち主が切り替わる（n = 1 では厳密、n > 1 では
+# 両端の n番目の持ち主だけで決める近似）。担当範囲は道路本数ではなく道路延長 [m] で数えられる。
+
+DEFAULT_COLOR = [200, 200, 200]  # 持ち主がいない道路の色
+
+
+def make_palette(color_map, size, default=DEFAULT_COLOR):
+    """{避難所ID: [R, G, B]} から避難所IDで引ける色表 (size + 1, 3) を作る
+
+    最終行は持ち主なし (NO_SHELTER = -1) 用の色で、owner をそのまま添字に使える。
+    """
+    palette = np.tile(np.asarray(default, dtype=np.uint8), (size + 1, 1))
+    if color_map:
+        ids = np.fromiter(color_map.keys(), dtype=np.int64, count=len(color_map))
+        palette[ids] = np.asarray(list(color_map.values()), dtype=np.uint8)
+    return palette
+
+
+def edge_owners(owners, u_pos):
+    """各道路の持ち主（u側ノードの持ち主）を返す。u側ノードがない道路は NO_SHELTER"""
+    owners = np.asarray(owners)
+    u_pos = np.asarray(u_pos)
+    edge_owner = np.full(len(u_pos), NO_SHELTER, dtype=np.int16)
+    has_node = u_pos >= 0
+    edge_owner[has_node] = owners[u_pos[has_node]]
+    return edge_owner
+
+
+def edge_ownership(owners, u_pos, palette):
+    """全道路の持ち主・色・避難所ごとの担当道路数を一括で求める
+
+    owners  : ノードごとの n番目の避難所ID (ランキングの1行)
+    u_pos   : 各道路の u側ノードのランキング上の位置（ノードがなければ -1）
+    palette : make_palette で作った色表
+    戻り値は (道路ごとの避難所ID, 道路ごとの色 (道路数, 3), 避難所IDごとの担当道路数)。
+    """
+    edge_owner = edge_owners(owners, u_pos)
+    colors = palette[edge_owner]
+    assigned = edge_owner[edge_owner != NO_SHELTER]
+    counts = np.bincount(assigned, minlength=len(palette) - 1)
+    return edge_owner, colors, counts
+
+
+def path_frame(paths, colors, mask):
+    """pydeck の PathLayer に渡す列形式のデータを作る（色は r, g, b の列に分ける）"""
+    colors = colors[mask]
+    return pd.DataFrame({
+        "path": list(compress(paths, mask)),
+        "r": colors[:, 0], "g": colors[:, 1], "b": colors[:, 2],
+    })
+
+
+def _edge_values(values, pos, fill):
+    values = np.asarray(values)
+    pos = np.asarray(pos)
+    out = np.full(len(pos), fill, dtype=values.dtype)
+    has_node = pos >= 0
+    out[has_node] = values[pos[has_node]]
+    return out
+
+
+def edge_split(owners, dist, u_pos, v_pos, length):
+    """各道路の u側・v側の持ち主と、持ち主が切り替わる位置を一括で求める
+
+    owners : ノードごとの避難所ID (ランキングの1行など)
+    dist   : 上記避難所までのノードごとの距離 (RankStore.distance_to)。None なら道路の中点で切り替える
+    u_pos, v_pos : 各道路の両端ノードのランキング上の位置（ノードがなければ -1）
+    length : 道路の長さ [m]
+    戻り値は (u側の持ち主, v側の持ち主, 切り替え位置)。切り替え位置は u からの割合 (0〜1) で、
+    1 なら道路全体が u側の持ち主、0 なら v側の持ち主のもの。
+    """
+    owner_u = edge_owners(owners, u_pos)
+    owner_v = edge_owners(owners, v_pos)
+    length = np.asarray(length, dtype=np.float64)
+    if dist is None:
+        split = np.full(len(length), 0.5)
+    else:
+        d_u = np.where(owner_u != NO_SHELTER, _edge_values(dist, u_pos, np.inf), np.inf).astype(np.float64)
+        d_v = np.where(owner_v != NO_SHELTER, _edge_values(dist, v_pos, np.inf), np.inf).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            split = (d_v + length - d_u) / 2 / length
+        split = np.where(length > 0, split, 0.5)
+        split = np.clip(np.nan_to_num(split, nan=1.0), 0.0, 1.0)
+    split[owner_u == owner_v] = 1.0
+    # 片側にしか持ち主がいない道路は、その持ち主が道路全体を受け持つ
+    split[(owner_u == NO_SHELTER) & (owner_v != NO_SHELTER)] = 0.0
+    split[(owner_v == NO_SHELTER) & (owner_u != NO_SHELTER)] = 1.0
+    return owner_u, owner_v, split
+
+
+def split_segments(table, owner_u, owner_v, split):
+    """道路を切り替え位置で分割した区間のテーブルを作る
+
+    戻り値は道路形状テーブルと同じ "coords" / "offsets" に、区間ごとの
+    "edge" (元の道路番号), "owner" (避難所ID), "length" (延長 [m]) を加えた辞書。
+    切り替え位置が 0 または 1 の道路は分割せず1区間のままにする。
+    """
+    coords = np.asarray(table["coords"])
+    offsets = np.asarray(table["offsets"])
+    length = np.asarray(table["length"], dtype=np.float64)
+    n_edges = len(offsets) - 1
+    start, end = offsets[:-1], offsets[1:]
+    cut = (split > 0) & (split < 1) & (owner_u != owner_v) & (end - start >= 2)
+
+    # 形状に沿った累積距離（緯度による経度方向の縮みだけ補正した平面近似）で切り替え位置の座標を求める
+    scale = np.cos(np.radians(coords[:, 1].mean())) if len(coords) else 1.0
+    step = np.zeros(len(coords))
+    if len(coords) > 1:
+        step[1:] = np.hypot(np.diff(coords[:, 0]) * scale, np.diff(coords[:, 1]))
+    step[start[start < len(coords)]] = 0.0
+    cum = np.cumsum(step)
+    e = np.flatnonzero(cut)
+    target = cum[start[e]] + split[e] * (cum[end[e] - 1] - cum[start[e]])
+    k = np.clip(np.searchsorted(cum, target, side='right') - 1, start[e], end[e] - 2)
+    span = cum[k + 1] - cum[k]
+    frac = np.divide(target - cum[k], span, out=np.zeros(len(e)), where=span > 0)
+    cut_points = coords[k] + frac[:, None] * (coords[k + 1] - coords[k])
+
+    # 区間ごとに「先頭の切断点 + 元の座標の範囲 + 末尾の切断点」として並べる（切断点は coords の後ろに足す）
+    n_seg = 1 + cut.astype(np.int64)
+    seg_first = np.r_[0, np.cumsum(n_seg)[:-1]]
+    total = int(n_seg.sum())
+    seg_edge = np.repeat(np.arange(n_edges), n_seg)
+    r0, r1 = start[seg_edge].copy(), end[seg_edge].copy()
+    head = np.full(total, -1, dtype=np.int64)
+    tail = np.full(total, -1, dtype=np.int64)
+    first, second = seg_first[e], seg_first[e] + 1
+    cut_index = len(coords) + np.arange(len(e))
+    r1[first] = k + 1
+    tail[first] = cut_index
+    r0[second] = k + 1
+    head[second] = cut_index
+
+    seg_owner = owner_u[seg_edge].copy()
+    seg_owner[second] = owner_v[e]
+    whole = np.flatnonzero(~cut)
+    seg_owner[seg_first[whole]] = np.where(split[whole] > 0, owner_u[whole], owner_v[whole])
+    seg_length = length[seg_edge].copy()
+    seg_length[first] = length[e] * split[e]
+    seg_length[second] = length[e] * (1 - split[e])
+
+    counts = (head >= 0) + (r1 - r0) + (tail >= 0)
+    seg_offsets = np.zeros(total + 1, dtype=np.int64)
+    np.cumsum(counts, out=seg_offsets[1:])
+    index = np.repeat(r0 - seg_offsets[:-1] - (head >= 0), counts) + np.arange(seg_offsets[-1])
+    index[seg_offsets[:-1][head >= 0]] = head[head >= 0]
+    index[seg_offsets[1:][tail >= 0] - 1] = tail[tail >= 0]
+    return {
+        "coords": np.concatenate([coords, cut_points])[index],
+        "offsets": seg_offsets,
+        "edge": seg_edge,
+        "owner": seg_owner.astype(np.int16),
+        "length": seg_length.astype(np.float32),
+    }
+
+
+def edge_segments(table, owners, dist, u_pos, v_pos):
+    """edge_split と split_segments をまとめて行い、持ち主ごとに分割した区間のテーブルを返す"""
+    return split_segments(table, *edge_split(owners, dist, u_pos, v_pos, table["length"]))
+
+
+def coverage_meters(segments, size):
+    """避難所IDごとの担当道路延長 [m] を返す"""
+    owner = segments["owner"]
+    has_owner = owner != NO_SHELTER
+    return np.bincount(owner[has_owner], weights=segments["length"][has_owner], minlength=size)
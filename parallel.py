@@ -0,0 +1,117 @@
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from rank_store import NO_NODE
+
+# --- プロセスプールによる並列計算 ---
+# 道路グラフ（CSR 行列の3本の配列）と出力の距離行列を共有メモリに置き、ワーカーは起動時に
+# それを添付して使う。タスクごとに渡すのは始点ノード番号の小さな配列だけなので、グラフが
+# タスクごとに pickle されることはない。各タスクは距離行列の決まった行だけに書き込むため、
+# ワーカー数やタスクの完了順によらず直列版と同じ結果になる。
+
+_worker = {}  # ワーカープロセス内で添付した共有メモリと配列
+
+
+def worker_count(workers=None):
+    """ワーカー数（None ならCPUコア数）"""
+    return workers if workers is not None else (os.cpu_count() or 1)
+
+
+def empty_shared(shape, dtype):
+    """共有メモリ上に配列の領域を確保し、(SharedMemory, ワーカーに渡す仕様) を返す"""
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, (shm.name, tuple(shape), dtype.str)
+
+
+def share_array(array):
+    """配列を共有メモリにコピーし、(SharedMemory, ワーカーに渡す仕様) を返す"""
+    array = np.asarray(array)
+    shm, spec = empty_shared(array.shape, array.dtype)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, spec
+
+
+def attach_array(spec):
+    """share_array の仕様から共有メモリ上の配列を開く（戻り値は (SharedMemory, 配列)）"""
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def run_tasks(fn, tasks, workers=None, progress=None, initializer=None, initargs=()):
+    """tasks の各引数タプルで fn をプロセスプール上で実行し、結果を tasks の順に返す
+
+    fn の戻り値は (結果, 進捗の重み) の組。progress を渡すとタスクの完了ごとに
+    progress(完了したタスクの重みの合計) を呼ぶ。
+    """
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=worker_count(workers), initializer=initializer,
+                             initargs=initargs) as pool:
+        futures = {pool.submit(fn, *args): i for i, args in enumerate(tasks)}
+        done = 0
+        for future in as_completed(futures):
+            results[futures[future]], weight = future.result()
+            done += weight
+            if progress is not None:
+                progress(done)
+    return results
+
+
+def _init_dijkstra_worker(csr_specs, shape, out_spec, pred_spec=None):
+    import scipy.sparse as sp
+    blocks = [attach_array(spec) for spec in (*csr_specs, out_spec)]
+    (_, data), (_, indices), (_, indptr), (_, out) = blocks
+    if pred_spec is not None:
+        blocks.append(attach_array(pred_spec))
+        _worker["pred"] = blocks[-1][1]
+    _worker["shm"] = [shm for shm, _ in blocks]  # 参照を保持して共有メモリを開いたままにする
+    _worker["csr"] = sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+    _worker["out"] = out
+
+
+def _dijkstra_rows(start, sources):
+    from scipy.sparse.csgraph import dijkstra
+    rows = slice(start, start + len(sources))
+    if "pred" in _worker:
+        _worker["out"][rows], _worker["pred"][rows] = dijkstra(
+            _worker["csr"], directed=True, indices=sources, return_predecessors=True
+        )
+    else:
+        _worker["out"][rows] = dijkstra(_worker["csr"], directed=True, indices=sources)
+    return None, len(sources)
+
+
+def parallel_dijkstra(csr, sources, workers=None, progress=None, chunk_size=4, predecessors=False):
+    """始点ごとの全ノードへの距離 (始点数, ノード数) を float32 で並列に求める
+
+    始点を chunk_size 個ずつのタスクに分け、各ワーカーは共有メモリ上の出力の該当行に直接書き込む。
+    progress を渡すとタスクの完了ごとに progress(完了した始点数, 全始点数) を呼ぶ。
+    predecessors=True なら (距離, 最短経路木 (int32。直前のノードがなければ NO_NODE)) を返す。
+    """
+    csr = csr.tocsr()
+    shared = [share_array(a) for a in (csr.data, csr.indices, csr.indptr)]
+    out_shm, out_spec = empty_shared((len(sources), csr.shape[0]), np.float32)
+    pred_shm, pred_spec = empty_shared((len(sources), csr.shape[0]), np.int32) if predecessors else (None, None)
+    try:
+        tasks = [(start, np.asarray(sources[start:start + chunk_size]))
+                 for start in range(0, len(sources), chunk_size)]
+        run_tasks(
+            _dijkstra_rows, tasks, workers,
+            progress=None if progress is None else (lambda done: progress(done, len(sources))),
+            initializer=_init_dijkstra_worker,
+            initargs=([spec for _, spec in shared], csr.shape, out_spec, pred_spec),
+        )
+        _, shape, dtype = out_spec
+        dist = np.ndarray(shape, dtype=np.dtype(dtype), buffer=out_shm.buf).copy()
+        if not predecessors:
+            return dist
+        pred = np.ndarray(shape, dtype=np.int32, buffer=pred_shm.buf).copy()
+        pred[pred < 0] = NO_NODE  # scipy は -9999 で表す
+        return dist, pred
+    finally:
+        for shm in [out_shm, pred_shm] + [shm for shm, _ in shared]:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
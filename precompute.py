@@ -1,83 +1,142 @@
-import osmnx as ox
 import pandas as pd
-import folium
+import numpy as np
+import json
 import random
 import os
-import pickle
+import shutil
+from cache_manifest import artifact_status
+from build_graph import load_graph
+from edge_table import edge_node_ids
+from ownership import edge_owners
+from parallel import run_tasks
+from hazards import ST_COLS
+from rank_store import NO_SHELTER, load_ranks
 
 # --- 設定 ---
 CSV_FILE = "emergency_shelter_maebashi.csv"
 GRAPH_CACHE = "maebashi_graph.graphml"
-MAP_SAVE_DIR = "static_maps" # HTML地図の保存先
+MAP_SAVE_DIR = "static_maps" # 地図データの保存先
 RESULT_CACHE_DIR = "cache_results"
+VIEWER_HTML = "map_viewer.html" # static_maps/index.html としてコピーする表示用ページ
+N_CHUNK = 16 # 1タスクで書き出す順位の数
+
+# --- 出力形式 ---
+# 道路の形状は全災害・全順位で共通なので1回だけ書き出し、色分けはブラウザ側で行う。
+#   roads_coords.bin  : 全道路の座標 [経度, 緯度] を連結したもの (float32, リトルエンディアン)
+#   roads_offsets.bin : 道路 i の座標は点 offsets[i]〜offsets[i + 1] (uint32, 道路数 + 1)
+#   owners/<災害列>_n<n>.bin : 道路ごとの持ち主の、その災害の避難所一覧上の番号 (uint8 または uint16)
+#                              持ち主がいない道路は型の最大値
+#   index.json        : 災害種類・避難所一覧・色・ファイルの型などの目録
+#   index.html        : 上記を読み込んで deck.gl で描画するページ
+
+_worker = {}  # ワーカープロセス内の道路の u側ノードIDと、災害種類ごとの全順位ランキング
+
+def _init_map_worker(edge_u):
+    _worker["edge_u"] = edge_u
+    _worker["ranks"] = {}
+
+def _hazard_ranks(col):
+    # 同じワーカーが同じ災害の別の順位を担当したときは並べ直した結果を使い回す
+    if col not in _worker["ranks"]:
+        store = load_ranks(col, RESULT_CACHE_DIR)
+        _worker["ranks"][col] = (store.full_ranks(), store.node_index(_worker["edge_u"]), len(store.node_ids))
+    return _worker["ranks"][col]
+
+def owner_dtype(n_shelters):
+    return np.dtype(np.uint8 if n_shelters < 0xFF else np.uint16).newbyteorder('<')
+
+def write_owner_arrays(col, shelter_ids, n_start, n_stop):
+    """1つの災害種類の n = n_start〜n_stop - 1 の持ち主配列を書き出す（プロセスプールで並列実行）"""
+    ranks, u_pos, n_nodes = _hazard_ranks(col)
+
+    dtype = owner_dtype(len(shelter_ids))
+    none = np.iinfo(dtype).max
+    # 避難所ID → 一覧上の番号 の変換表（最終要素は持ち主なし用）
+    lookup = np.full(max(shelter_ids, default=0) + 2, none, dtype=dtype)
+    lookup[shelter_ids] = np.arange(len(shelter_ids))
+
+    for n in range(n_start, n_stop):
+        owners = ranks[n - 1] if n <= len(ranks) else np.full(n_nodes, NO_SHELTER, dtype=np.int16)
+        edge_owner = edge_owners(owners, u_pos)
+        edge_owner[edge_owner == NO_SHELTER] = len(lookup) - 1
+        lookup[edge_owner].tofile(
+            os.path.join(MAP_SAVE_DIR, "owners", f"{col}_n{n}.bin")
+        )
+    return col, n_stop - n_start
+
+def generate_all_maps(workers=None):
+    os.makedirs(os.path.join(MAP_SAVE_DIR, "owners"), exist_ok=True)
 
-def generate_all_maps():
-    if not os.path.exists(MAP_SAVE_DIR): os.makedirs(MAP_SAVE_DIR)
-    
     print("🚀 地図の全パターン生成を開始します...")
-    G = ox.load_graphml(GRAPH_CACHE)
-    
+    table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+
     try:
         df = pd.read_csv(CSV_FILE, encoding='utf-8')
     except:
         df = pd.read_csv(CSV_FILE, encoding='cp932')
 
-    ST_COLS = {
-        "洪水": "flood", "崖崩れ,土石流及び地滑り": "landslides_debrisflow_medslides",
-        "高潮": "storm_surge", "地震": "earthquake", "津波": "tsunami",
-        "大規模な火事": "largescale_fire", "内水氾濫": "inlandflooding", "火山現象": "volcanic_phenomena"
-    }
+    # 道路の形状（全パターン共通）
+    np.asarray(table["coords"], dtype='<f4').tofile(os.path.join(MAP_SAVE_DIR, "roads_coords.bin"))
+    np.asarray(table["offsets"], dtype='<u4').tofile(os.path.join(MAP_SAVE_DIR, "roads_offsets.bin"))
+    edge_u, _ = edge_node_ids(table)
+    edge_u = np.asarray(edge_u)
 
+    hazards = []
+    tasks = []
     for label, col in ST_COLS.items():
-        cache_path = os.path.join(RESULT_CACHE_DIR, f"full_ranks_{col}.pkl")
-        if not os.path.exists(cache_path):
+        if load_ranks(col, RESULT_CACHE_DIR) is None:
             print(f"⚠️ キャッシュがないため {label} をスキップします。")
             continue
-            
-        with open(cache_path, 'rb') as f:
-            node_rankings = pickle.load(f)
-        
+        if artifact_status(f"ranks_{col}", df, RESULT_CACHE_DIR, GRAPH_CACHE, CSV_FILE) == "stale":
+            print(f"⚠️ キャッシュが古いため {label} をスキップします。python build_cache.py で更新してください。")
+            continue
+
         active_shelters = df[df[col] == True].copy()
-        max_n = len(active_shelters)
-        
+        if active_shelters.empty:
+            print(f"⚠️ 利用可能な施設がないため {label} をスキップします。")
+            continue
+
         # 避難所の色を固定（IDベース）
         random.seed(42)
         color_map = {sid: "#%06x" % random.randint(0, 0xFFFFFF) for sid in active_shelters.index}
 
-        for n in range(1, max_n + 1):
-            file_name = f"map_{col}_n{n}.html"
-            save_path = os.path.join(MAP_SAVE_DIR, file_name)
-            
-            if os.path.exists(save_path): continue # すでに作成済みならスキップ
-
-            # 地図作成
-            m = folium.Map(location=[36.3895, 139.0634], zoom_start=13, tiles="cartodbpositron")
-            
-            # 道路網の描画
-            for u, v, data in G.edges(data=True):
-                ranks = node_rankings.get(u, [])
-                if not ranks or len(ranks) < n: continue
-                owner_id = ranks[n-1]
-                color = color_map.get(owner_id, "#888888")
-                points = [(G.nodes[u]['y'], G.nodes[u]['x']), (G.nodes[v]['y'], G.nodes[v]['x'])]
-                folium.PolyLine(points, color=color, weight=3, opacity=0.7).add_to(m)
-
-            # 施設の描画
-            for idx, row in active_shelters.iterrows():
-                folium.CircleMarker(
-                    location=[row['lat'], row['lon']],
-                    radius=6, color="black", weight=1,
-                    fill=True, fill_color=color_map[idx], fill_opacity=1.0,
-                    popup=row['name']
-                ).add_to(m)
-
-            m.save(save_path)
-            print(f"✅ 保存完了: {label} n={n}")
+        hazards.append({
+            "label": label, "col": col,
+            "shelters": [
+                {"id": int(idx), "name": row['name'], "lat": row['lat'], "lon": row['lon'], "color": color_map[idx]}
+                for idx, row in active_shelters.iterrows()
+            ],
+        })
+        tasks.append((col, active_shelters.index.to_numpy()))
+
+    # (災害種類, 順位の範囲) ごとのタスクに分け、プロセスプールで並列に書き出す
+    tasks = [
+        (col, ids, n_start, min(n_start + N_CHUNK, len(ids) + 1))
+        for col, ids in tasks for n_start in range(1, len(ids) + 1, N_CHUNK)
+    ]
+    total = sum(n_stop - n_start for _, _, n_start, n_stop in tasks)
+    run_tasks(
+        write_owner_arrays, tasks, workers,
+        progress=lambda done: print(f"\r⏳ 持ち主配列を書き出し中... {done}/{total}", end="", flush=True),
+        initializer=_init_map_worker, initargs=(edge_u,),
+    )
+    print()
+
+    for hazard in hazards:
+        hazard["dtype"] = owner_dtype(len(hazard["shelters"])).name
+    index = {
+        "center": [36.3895, 139.0634],
+        "edge_count": int(len(table["u"])),
+        "hazards": hazards,
+    }
+    with open(os.path.join(MAP_SAVE_DIR, "index.json"), 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    shutil.copyfile(VIEWER_HTML, os.path.join(MAP_SAVE_DIR, "index.html"))
 
     print("\n" + "="*30)
     print("✨ すべての計算と地図生成が完了しました！ ✨")
-    print("アプリ(UI.py)を起動して確認してください。")
+    print(f"python -m http.server -d {MAP_SAVE_DIR} を実行し、ブラウザで開いて確認してください。")
     print("="*30)
 
 if __name__ == "__main__":
-    generate_all_maps()
\ No newline at end of file
+    generate_all_maps()
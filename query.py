@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import sys
+from rank_store import NO_SHELTER, RESULT_CACHE_DIR, load_ranks, sort_by_distance
+
+# --- 任意の地点から近い避難所を引く問い合わせ ---
+# 道路ノードの座標で KD 木を1度だけ作っておき、緯度経度の一括問い合わせを
+# 「最寄りノードへの紐づけ → 保存済みランキング・距離の列を取り出す」だけで答える。
+# ox.nearest_nodes のように毎回グラフ全体を走査しないので、数千件の住所リストもまとめて処理できる。
+
+GRAPH_CACHE = "maebashi_graph.graphml"
+EARTH_RADIUS = 6371008.8  # [m]
+
+
+class NodeLocator:
+    """道路ノード座標の KD 木（経緯度を基準点まわりの平面 [m] に投影して使う）"""
+
+    def __init__(self, node_ids, x, y):
+        from scipy.spatial import cKDTree  # KD 木を作るときだけ読み込み、画面の起動を遅くしない
+        self.node_ids = np.asarray(node_ids)
+        self.lat0 = float(np.mean(y))
+        self.lon0 = float(np.mean(x))
+        self.tree = cKDTree(self._project(np.asarray(y), np.asarray(x)))
+
+    def _project(self, lat, lon):
+        # 市域程度の範囲なら正距円筒図法で十分な精度が出る
+        scale = np.cos(np.radians(self.lat0))
+        return np.column_stack([
+            np.radians(np.asarray(lon, dtype=np.float64) - self.lon0) * EARTH_RADIUS * scale,
+            np.radians(np.asarray(lat, dtype=np.float64) - self.lat0) * EARTH_RADIUS,
+        ])
+
+    def nearest(self, lat, lon):
+        """各地点の最寄り道路ノードID と、そのノードまでの直線距離 [m] を返す"""
+        snap_dist, pos = self.tree.query(self._project(lat, lon))
+        return self.node_ids[pos], snap_dist
+
+
+def load_locator(graph_path=GRAPH_CACHE):
+    """道路形状テーブルのノード座標から NodeLocator を作る（グラフがない場合は None）"""
+    from build_graph import load_graph
+    table = load_graph(graph_path)
+    if table is None:
+        return None
+    return NodeLocator(table["nodes"], table["x"], table["y"])
+
+
+def nearest_shelters(store, node_ids, n):
+    """各ノードの近い順 n件の避難所IDと道路距離 [m] を (地点数, n) の行列の組で返す
+
+    保存範囲内は保存済みの配列から取り出し、より深い順位は距離行列のその列だけを並べ替える。
+    距離が分からない場合（旧形式のキャッシュ）は nan。
+    """
+    pos = store.node_index(node_ids)
+    found = pos >= 0
+    ids = np.full((len(pos), n), NO_SHELTER, dtype=np.int16)
+    dist = np.full((len(pos), n), np.nan, dtype=np.float32)
+    cols = pos[found]
+
+    if n > store.depth and store.truncated:
+        rows = store.distances.rows(store.shelters)
+        ranks, sorted_dist = sort_by_distance(
+            np.asarray(store.distances.dist[np.ix_(rows, cols)]), store.distances.shelter_ids[rows], n
+        )
+        ids[found, :ranks.shape[0]] = ranks.T
+        dist[found, :ranks.shape[0]] = sorted_dist.T
+    else:
+        depth = min(n, store.depth)
+        ids[found, :depth] = np.asarray(store.ranks[:depth])[:, cols].T
+        if store.dist is not None:
+            dist[found, :depth] = np.asarray(store.dist[:depth])[:, cols].T
+    dist[ids == NO_SHELTER] = np.nan
+    return ids, dist
+
+
+def query_points(locator, store, lat, lon, n=3):
+    """緯度経度の配列について、近い順 n件の避難所をまとめて求める
+
+    戻り値は (避難所ID (地点数, n), 道路距離 [m] (地点数, n), 最寄りノードまでの直線距離 [m])。
+    道路距離は最寄りノードからの値なので、地点からの距離には直線距離を足して使う。
+    """
+    node_ids, snap_dist = locator.nearest(lat, lon)
+    ids, dist = nearest_shelters(store, node_ids, n)
+    return ids, dist, snap_dist
+
+
+def query_frame(locator, store, shelters_df, lat, lon, n=3):
+    """query_points の結果を (地点, 順位) ごとの1行の DataFrame にする"""
+    ids, dist, snap_dist = query_points(locator, store, lat, lon, n)
+    point = np.repeat(np.arange(len(ids)), n)
+    rank = np.tile(np.arange(1, n + 1), len(ids))
+    flat_ids = ids.ravel()
+    ok = flat_ids != NO_SHELTER
+    return pd.DataFrame({
+        "地点": point[ok],
+        "順位": rank[ok],
+        "避難所ID": flat_ids[ok],
+        "避難所名": shelters_df.loc[flat_ids[ok], 'name'].to_numpy(),
+        "道路距離[m]": (dist.ravel() + np.repeat(snap_dist, n))[ok].round(1),
+    })
+
+
+if __name__ == "__main__":
+    # 使い方: python query.py 災害列 入力CSV(lat, lon 列) [n]
+    from shelter_table import read_csv, read_shelters
+    hazard, points_csv = sys.argv[1], sys.argv[2]
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    points = read_csv(points_csv)
+    result = query_frame(
+        load_locator(), load_ranks(hazard, RESULT_CACHE_DIR), read_shelters(),
+        points['lat'], points['lon'], n,
+    )
+    print(result.to_csv(index=False))
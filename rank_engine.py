@@ -0,0 +1,137 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+from parallel import parallel_dijkstra, worker_count
+from query import NodeLocator
+from rank_store import NO_NODE, save_store, sort_by_distance
+
+# --- 避難所ランキング計算エンジン ---
+# 避難所ノードごとに1回だけダイクストラ法を実行して「ノード×避難所」の距離行列を作り、
+# すべての災害種類のランキングをその1つの行列から導出する。
+
+
+def graph_to_csr(G, weight='length'):
+    """道路グラフを (CSR隣接行列, ソート済みノードID配列) に変換する
+
+    各ノードから避難所へ向かう距離を求めるため、行列の辺の向きは元のグラフと逆にしてある。
+    多重辺は最も短いものだけを残す。
+    """
+    node_ids = np.array(sorted(G.nodes()), dtype=np.int64)
+    u, v, w = zip(*G.edges(data=weight))
+    u = np.searchsorted(node_ids, np.array(u, dtype=np.int64))
+    v = np.searchsorted(node_ids, np.array(v, dtype=np.int64))
+    return edges_to_csr(u, v, np.array(w, dtype=np.float64), len(node_ids)), node_ids
+
+
+def edges_to_csr(u, v, w, n):
+    """道路 (始点位置, 終点位置, 長さ) の配列から、辺の向きを逆にした CSR 隣接行列 (n, n) を作る
+
+    自己ループを除外し、同じ (u, v) の多重辺は最短のものだけ残す。
+    """
+    u, v, w = np.asarray(u), np.asarray(v), np.asarray(w, dtype=np.float64)
+    keep = u != v
+    u, v, w = u[keep], v[keep], w[keep]
+    order = np.lexsort((w, v, u))
+    u, v, w = u[order], v[order], w[order]
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    return sp.csr_matrix((w[first], (v[first], u[first])), shape=(n, n))
+
+
+def table_to_csr(table):
+    """道路形状テーブルを (CSR隣接行列, ソート済みノードID配列) に変換する（graph_to_csr と同じ行列）"""
+    return edges_to_csr(table["u"], table["v"], table["length"], len(table["nodes"])), np.asarray(table["nodes"])
+
+
+def snap_shelters(table, shelters_df):
+    """各避難所に最も近い道路ノードを、道路形状テーブルのノード位置で返す"""
+    locator = NodeLocator(np.arange(len(table["nodes"])), table["x"], table["y"])
+    return locator.nearest(shelters_df['lat'].to_numpy(), shelters_df['lon'].to_numpy())[0]
+
+
+def shelter_distance_matrix(csr, shelter_idx, progress=None, chunk_size=16, workers=1, predecessors=False):
+    """避難所ごとの全ノードからの道路距離を (避難所数, ノード数) の行列で返す
+
+    同じノードに紐づく避難所はダイクストラ法を1回だけ実行して距離を共有する。
+    到達できないノードの距離は inf になる。距離は保存形式と同じ float32 で返し、
+    順位付けもこの精度で行うことで、後から距離行列だけで同じ順位を再現できるようにする。
+    progress を渡すと chunk_size 個の始点ごとに progress(完了数, 全体数) を呼ぶ。
+    workers が 1 以外ならプロセスプールで並列に計算する（None でCPUコア数。結果は同じ）。
+    predecessors=True なら (距離行列, 最短経路木) を返す。最短経路木は同じ形の int32 で、
+    各ノードから避難所へ向かう経路の次のノード位置（避難所のノード自身と到達不能は NO_NODE）。
+    """
+    unique_nodes, inverse = np.unique(shelter_idx, return_inverse=True)
+    if worker_count(workers) > 1:
+        result = parallel_dijkstra(csr, unique_nodes, workers, progress, predecessors=predecessors)
+        return tuple(a[inverse] for a in result) if predecessors else result[inverse]
+
+    dist = np.empty((len(unique_nodes), csr.shape[0]), dtype=np.float32)
+    pred = np.empty((len(unique_nodes), csr.shape[0]), dtype=np.int32) if predecessors else None
+    for start in range(0, len(unique_nodes), chunk_size):
+        chunk = unique_nodes[start:start + chunk_size]
+        if predecessors:
+            # 辺の向きを逆にしたグラフでの「直前のノード」は、元の向きでは避難所へ向かう「次のノード」
+            dist[start:start + len(chunk)], pred[start:start + len(chunk)] = dijkstra(
+                csr, directed=True, indices=chunk, return_predecessors=True
+            )
+        else:
+            dist[start:start + len(chunk)] = dijkstra(csr, directed=True, indices=chunk)
+        if progress is not None:
+            progress(start + len(chunk), len(unique_nodes))
+    if predecessors:
+        pred[pred < 0] = NO_NODE  # scipy は -9999 で表す
+        return dist[inverse], pred[inverse]
+    return dist[inverse]
+
+
+def rank_shelters(dist, shelter_ids, active=None, top_k=None):
+    """距離行列から近い順の避難所IDと距離を (順位, ノード数) の行列の組で返す
+
+    active で対象の避難所（行）を絞り込める。距離が同じ場合は避難所IDの小さい順。
+    到達できない順位には NO_SHELTER が入る。top_k を指定すると上位 top_k 件だけを返す。
+    """
+    shelter_ids = np.asarray(shelter_ids)
+    if active is not None:
+        active = np.asarray(active, dtype=bool)
+        dist, shelter_ids = dist[active], shelter_ids[active]
+
+    return sort_by_distance(dist, shelter_ids, top_k)
+
+
+def save_rankings(path, node_ids, dist, shelter_ids, active, top_k=None):
+    """距離行列から1つの災害種類のランキングを作って保存する
+
+    上位 top_k 件だけを保存する場合も、深い順位を後から計算できるよう有効な避難所IDを残す。
+    """
+    shelter_ids = np.asarray(shelter_ids)
+    active = np.asarray(active, dtype=bool)
+    ranks, sorted_dist = rank_shelters(dist, shelter_ids, active, top_k)
+    save_store(path, node_ids, ranks, sorted_dist, shelters=shelter_ids[active])
+
+
+def compute_distances(table, shelters_df, progress=None, workers=1, predecessors=False):
+    """道路形状テーブル (build_graph.load_graph) から全避難所への距離行列を計算する
+
+    戻り値は (ノードID配列, 距離行列 (避難所数, ノード数), 各避難所のノード位置)。
+    predecessors=True なら最後に最短経路木 (shelter_distance_matrix) を加えた4つ組を返す。
+    """
+    csr, node_ids = table_to_csr(table)
+    shelter_idx = snap_shelters(table, shelters_df)
+    result = shelter_distance_matrix(csr, shelter_idx, progress, workers=workers, predecessors=predecessors)
+    if predecessors:
+        return node_ids, result[0], shelter_idx, result[1]
+    return node_ids, result, shelter_idx
+
+
+def compute_rankings(table, shelters_df, hazard_cols, top_k=None, workers=1):
+    """全災害種類のランキングを1つの距離行列から計算する
+
+    戻り値は ({災害列: ランク行列}, ノードID配列)。
+    """
+    node_ids, dist, _ = compute_distances(table, shelters_df, workers=workers)
+
+    rankings = {}
+    for col in hazard_cols:
+        active = (shelters_df[col] == True).to_numpy()
+        rankings[col] = rank_shelters(dist, shelters_df.index.to_numpy(), active, top_k)[0]
+    return rankings, node_ids
@@ -0,0 +1,372 @@
+import numpy as np
+import json
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+# --- 配列形式のランキング保存形式 ---
+# cache_results/ranks_<災害列>/ 以下に次の .npy を置き、np.load(mmap_mode='r') で開く。
+#   nodes.npy    : ソート済みの道路ノードID (int64, ノード数)
+#   ranks.npy    : n番目に近い避難所ID (int16, 順位 × ノード数)。該当なしは NO_SHELTER
+#   dist.npy     : 上記避難所までの道路距離 [m] (float32, 順位 × ノード数)。省略可
+#   shelters.npy : その災害で有効な全避難所ID (int16)。上位K件だけ保存した場合に置く
+# 順位ごとに行を分けているので、n番目の持ち主は全ノード分が1本の連続したスライスで取れる。
+#
+# cache_results/distances/ には全避難所への距離行列を置く。
+#   nodes.npy    : ソート済みの道路ノードID (int64, ノード数)
+#   shelters.npy : 避難所ID (int16, 避難所数)
+#   dist.npy     : 道路距離 [m] (float32, 避難所数 × ノード数)。到達不能は inf
+#   pred.npy     : 避難所ごとの最短経路木 (int32, 避難所数 × ノード数)。各ノードから避難所へ向かう
+#                  経路の次のノードの位置。避難所のノード自身と到達不能は NO_NODE。省略可（routes.py で使う）
+#   shelters.json: 各行の避難所の名前・座標・紐づく道路ノード・災害フラグ（差分更新用の目録）
+# 上位K件より深い順位は、この距離行列から要求された順位だけをその場で計算する。
+
+RESULT_CACHE_DIR = "cache_results"
+DISTANCE_DIR = "distances"
+NO_SHELTER = -1  # 到達できる避難所がない順位を表す値
+NO_NODE = -1  # 最短経路木で次のノードがないことを表す値
+MASK_BLOCK = 8  # 条件に合う避難所を数えるときに、一度に調べる順位の数
+DEEP_CACHED = 4  # 保存範囲より深い順位の計算結果を、1つの RankStore で保持する数（順位ごとに ノード数×6 バイト）
+
+
+class DistanceStore:
+    """全避難所 × ノードの距離行列を扱う読み取り用ラッパー"""
+
+    def __init__(self, node_ids, shelter_ids, dist, pred=None):
+        self.node_ids = node_ids
+        self.shelter_ids = shelter_ids
+        self.dist = dist
+        self.pred = pred
+
+    def rows(self, shelter_ids):
+        """避難所IDの距離行列上の行番号を返す"""
+        return np.flatnonzero(np.isin(self.shelter_ids, np.asarray(shelter_ids)))
+
+
+class RankStore:
+    """ノード×順位のランキング配列をまとめて扱う読み取り用ラッパー"""
+
+    def __init__(self, node_ids, ranks, dist=None, shelters=None, distances=None):
+        self.node_ids = node_ids
+        self.ranks = ranks
+        self.dist = dist
+        self.shelters = shelters
+        self.distances = distances
+        self._deep = OrderedDict()
+        self._lock = threading.Lock()  # RankStore はプロセス内のセッションで共有される (data_cache.get_ranks)
+
+    @property
+    def depth(self):
+        """保存されている順位の数"""
+        return self.ranks.shape[0]
+
+    @property
+    def truncated(self):
+        """上位K件だけを保存していて、より深い順位を距離行列から計算できるか"""
+        return (self.shelters is not None and self.distances is not None
+                and self.depth < len(self.shelters))
+
+    def node_index(self, node_ids):
+        """道路ノードIDを配列上の位置に変換する（存在しないノードは -1）"""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        pos = np.searchsorted(self.node_ids, node_ids)
+        pos = np.minimum(pos, len(self.node_ids) - 1)
+        return np.where(self.node_ids[pos] == node_ids, pos, -1)
+
+    def owner(self, n, allowed=None):
+        """全ノードの n番目に近い避難所IDを1本のベクトルで返す
+
+        allowed を渡すと、その避難所ID集合だけで数えた n番目を返す。
+        """
+        if allowed is None:
+            if n <= self.depth:
+                return self.ranks[n - 1]
+            return self._deep_rank(n)[0]
+
+        allowed = np.asarray(list(allowed), dtype=np.int16)
+        owners = np.full(len(self.node_ids), NO_SHELTER, dtype=np.int16)
+        table = allowed_table(allowed)
+        # 順位を MASK_BLOCK 行ずつ調べ、n番目が見つかったノードと、到達できる避難所が尽きたノードは
+        # 以降の行で調べない（全順位を保存したランキングでも、たいていは浅い順位で決まる）
+        cols = np.arange(len(self.node_ids))
+        count = np.zeros(len(cols), dtype=np.int32)
+        for start in range(0, self.depth, MASK_BLOCK):
+            if len(cols) == 0:
+                break
+            block = np.asarray(self.ranks[start:start + MASK_BLOCK])[:, cols]
+            ok = table[block]
+            hit = ok & (count + np.cumsum(ok, axis=0, dtype=np.int32) == n)
+            found = hit.any(axis=0)
+            owners[cols[found]] = block[hit.argmax(axis=0)[found], np.flatnonzero(found)]
+            count += ok.sum(axis=0, dtype=np.int32)
+            keep = ~found & (block[-1] != NO_SHELTER)
+            cols, count = cols[keep], count[keep]
+
+        # 上位K件の中に allowed が n件ない地点だけ、距離行列から求め直す
+        missing = owners == NO_SHELTER
+        if self.truncated and missing.any():
+            rows = self.distances.rows(np.intersect1d(self.shelters, allowed))
+            dist = self.distances.dist[rows][:, missing]
+            owners[missing] = nth_from_distances(dist, self.distances.shelter_ids[rows], n)[0]
+        return owners
+
+    def candidates(self, allowed, depth=None):
+        """allowed の避難所だけで数えた近い順の (避難所ID, 距離) を (depth, ノード数) の行列の組で返す
+
+        保存範囲内の順位を詰め直すだけなので、保存範囲より深い候補は含まない。距離がなければ距離は None。
+        """
+        ok = allowed_table(allowed)[self.ranks]
+        depth = self.depth if depth is None else min(depth, self.depth)
+        order = np.argsort(~ok, axis=0, kind='stable')[:depth]
+        ids = np.take_along_axis(np.asarray(self.ranks), order, axis=0)
+        ids[~np.take_along_axis(ok, order, axis=0)] = NO_SHELTER
+        if self.dist is None:
+            return ids, None
+        dist = np.take_along_axis(np.asarray(self.dist), order, axis=0)
+        dist[ids == NO_SHELTER] = np.inf
+        return ids, dist
+
+    def distance(self, n):
+        """全ノードの n番目に近い避難所までの距離を返す（距離がない場合は None）"""
+        if self.dist is not None and n <= self.depth:
+            return self.dist[n - 1]
+        if self.truncated and n > self.depth:
+            return self._deep_rank(n)[1]
+        return None
+
+    def distance_to(self, owners):
+        """ノードごとに指定した避難所 (owner の1行など) までの距離を返す
+
+        上位K件にない避難所は距離行列から引く。距離を保存していない旧形式では None。
+        """
+        if self.dist is None and self.distances is None:
+            return None
+        owners = np.asarray(owners)
+        out = np.full(len(self.node_ids), np.inf, dtype=np.float32)
+        found = np.zeros(len(self.node_ids), dtype=bool)
+        if self.dist is not None and self.depth > 0:
+            hit = np.asarray(self.ranks) == owners
+            found = hit.any(axis=0) & (owners != NO_SHELTER)
+            row = hit.argmax(axis=0)
+            out[found] = np.asarray(self.dist)[row, np.arange(len(owners))][found]
+        missing = np.flatnonzero(~found & (owners != NO_SHELTER))
+        if len(missing) and self.distances is not None:
+            shelter_ids = np.asarray(self.distances.shelter_ids, dtype=np.int64)
+            lookup = np.full(max(shelter_ids.max(), owners.max()) + 1, -1, dtype=np.int64)
+            lookup[shelter_ids] = np.arange(len(shelter_ids))
+            rows = lookup[owners[missing]]
+            ok = rows >= 0
+            out[missing[ok]] = self.distances.dist[rows[ok], missing[ok]]
+        return out
+
+    def full_ranks(self):
+        """全順位のランク行列を返す（上位K件だけ保存している場合は距離行列から並べ直す）"""
+        if not self.truncated:
+            return self.ranks
+        rows = self.distances.rows(self.shelters)
+        return sort_by_distance(np.asarray(self.distances.dist[rows]), self.distances.shelter_ids[rows])[0]
+
+    def _deep_rank(self, n):
+        """保存範囲より深い n番目を距離行列から計算する（直近の DEEP_CACHED 個の順位の結果を保持する）"""
+        if not self.truncated:
+            return (np.full(len(self.node_ids), NO_SHELTER, dtype=np.int16), None)
+        with self._lock:
+            if n in self._deep:
+                self._deep.move_to_end(n)
+                return self._deep[n]
+        rows = self.distances.rows(self.shelters)
+        result = nth_from_distances(self.distances.dist[rows], self.distances.shelter_ids[rows], n)
+        with self._lock:
+            self._deep[n] = result
+            while len(self._deep) > DEEP_CACHED:
+                self._deep.popitem(last=False)
+        return result
+
+
+def sort_by_distance(dist, shelter_ids, top_k=None):
+    """距離行列 (避難所数, ノード数) を近い順に並べ、(ランク行列, 距離行列) を返す
+
+    距離が同じ場合は行の順（避難所IDの小さい順）。到達できない順位には NO_SHELTER が入る。
+    top_k を指定すると上位 top_k 件だけを返す。
+    """
+    order = np.argsort(dist, axis=0, kind='stable')[:top_k]
+    ranks = np.asarray(shelter_ids)[order].astype(np.int16)
+    sorted_dist = np.take_along_axis(dist, order, axis=0).astype(np.float32)
+    ranks[~np.isfinite(sorted_dist)] = NO_SHELTER
+    return ranks, sorted_dist
+
+
+def nth_from_distances(dist, shelter_ids, n):
+    """距離行列 (避難所数, ノード数) から各ノードの n番目に近い避難所だけを求める
+
+    全順位を並べ替えずに n番目の距離を選び出し、同じ距離の避難所は
+    sort_by_distance と同じく行の順（避難所IDの小さい順）で数える。
+    戻り値は (避難所ID, 距離) のベクトルの組。
+    """
+    n_nodes = dist.shape[1]
+    if n > dist.shape[0]:
+        return (np.full(n_nodes, NO_SHELTER, dtype=np.int16),
+                np.full(n_nodes, np.inf, dtype=np.float32))
+
+    dist = np.asarray(dist)
+    kth = np.partition(dist, n - 1, axis=0)[n - 1]
+    less = (dist < kth).sum(axis=0)
+    tie = dist == kth
+    hit = tie & (np.cumsum(tie, axis=0) == n - less)
+    owners = np.asarray(shelter_ids, dtype=np.int16)[hit.argmax(axis=0)]
+    owners[~np.isfinite(kth)] = NO_SHELTER
+    return owners, kth
+
+
+def allowed_table(allowed):
+    """避難所ID (int16) で引ける「allowed に含まれるか」の表。table[ranks] で順位ごとの bool 行列になる
+
+    NO_SHELTER (-1) は表の末尾を引くので、末尾は常に False にしておく。
+    """
+    table = np.zeros(np.iinfo(np.int16).max + 2, dtype=bool)
+    table[np.asarray(list(allowed), dtype=np.int64)] = True
+    return table
+
+
+def filter_ranks(ranks, allowed):
+    """ランク行列から allowed に含まれる避難所だけを順序を保って詰め直す"""
+    allowed = np.asarray(list(allowed), dtype=np.int16)
+    ok = allowed_table(allowed)[ranks]
+    order = np.argsort(~ok, axis=0, kind='stable')[:len(allowed)]
+    filtered = np.take_along_axis(np.asarray(ranks), order, axis=0)
+    filtered[~np.take_along_axis(ok, order, axis=0)] = NO_SHELTER
+    return filtered
+
+
+def store_path(hazard, cache_dir=RESULT_CACHE_DIR):
+    return os.path.join(cache_dir, f"ranks_{hazard}")
+
+
+def save_array(path, array, dtype):
+    """配列を .npy に保存する（一時ファイルに書いてから置き換え、メモリマップで開いている読み手を壊さない）"""
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, np.asarray(array, dtype=dtype))
+    os.replace(tmp_path, path)
+
+
+def _save_optional(path, array, dtype):
+    if array is not None:
+        save_array(path, array, dtype)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _load_optional(path):
+    return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+
+def save_store(path, node_ids, ranks, dist=None, shelters=None):
+    """ランキング配列を .npy ファイル群として保存する
+
+    上位K件だけを保存するときは、深い順位を計算できるよう shelters に有効な全避難所IDを渡す。
+    """
+    os.makedirs(path, exist_ok=True)
+    save_array(os.path.join(path, "nodes.npy"), node_ids, np.int64)
+    save_array(os.path.join(path, "ranks.npy"), ranks, np.int16)
+    _save_optional(os.path.join(path, "dist.npy"), dist, np.float32)
+    _save_optional(os.path.join(path, "shelters.npy"), shelters, np.int16)
+
+
+def load_store(path, distances=None):
+    """保存済みのランキング配列をメモリマップで開く"""
+    node_ids = np.load(os.path.join(path, "nodes.npy"), mmap_mode='r')
+    ranks = np.load(os.path.join(path, "ranks.npy"), mmap_mode='r')
+    dist = _load_optional(os.path.join(path, "dist.npy"))
+    shelters = _load_optional(os.path.join(path, "shelters.npy"))
+    if distances is not None and len(distances.node_ids) != len(node_ids):
+        distances = None
+    return RankStore(node_ids, ranks, dist, shelters, distances)
+
+
+def save_distances(node_ids, shelter_ids, dist, cache_dir=RESULT_CACHE_DIR, pred=None):
+    """全避難所への距離行列を保存する（pred を渡すと最短経路木も保存し、省略すると古いものは消す）"""
+    path = os.path.join(cache_dir, DISTANCE_DIR)
+    os.makedirs(path, exist_ok=True)
+    save_array(os.path.join(path, "nodes.npy"), node_ids, np.int64)
+    save_array(os.path.join(path, "shelters.npy"), shelter_ids, np.int16)
+    save_array(os.path.join(path, "dist.npy"), dist, np.float32)
+    _save_optional(os.path.join(path, "pred.npy"), pred, np.int32)
+
+
+def load_distances(cache_dir=RESULT_CACHE_DIR):
+    """全避難所への距離行列をメモリマップで開く（存在しない場合は None）"""
+    path = os.path.join(cache_dir, DISTANCE_DIR)
+    if not os.path.exists(os.path.join(path, "dist.npy")):
+        return None
+    return DistanceStore(
+        np.load(os.path.join(path, "nodes.npy"), mmap_mode='r'),
+        np.load(os.path.join(path, "shelters.npy"), mmap_mode='r'),
+        np.load(os.path.join(path, "dist.npy"), mmap_mode='r'),
+        _load_optional(os.path.join(path, "pred.npy")),
+    )
+
+
+def save_manifest(manifest, cache_dir=RESULT_CACHE_DIR):
+    """距離行列の各行に対応する避難所の目録を保存する"""
+    path = os.path.join(cache_dir, DISTANCE_DIR, "shelters.json")
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def load_manifest(cache_dir=RESULT_CACHE_DIR):
+    """避難所の目録を読む（存在しない場合は None）"""
+    path = os.path.join(cache_dir, DISTANCE_DIR, "shelters.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def ranks_from_dict(node_rankings):
+    """従来の {ノードID: [避難所ID, ...]} 形式を (ノードID配列, ランク行列) に変換する"""
+    node_ids = np.array(sorted(node_rankings), dtype=np.int64)
+    lists = [node_rankings[node] for node in node_ids.tolist()]
+    lengths = np.array([len(r) for r in lists], dtype=np.int64)
+
+    ranks = np.full((lengths.max(initial=0), len(node_ids)), NO_SHELTER, dtype=np.int16)
+    flat = np.fromiter((sid for r in lists for sid in r), dtype=np.int16, count=lengths.sum())
+    cols = np.repeat(np.arange(len(node_ids)), lengths)
+    rows = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ranks[rows, cols] = flat
+    return node_ids, ranks
+
+
+def convert_pickle(pkl_path, out_path):
+    """full_ranks_*.pkl を配列形式に変換して保存する"""
+    with open(pkl_path, 'rb') as f:
+        node_rankings = pickle.load(f)
+    node_ids, ranks = ranks_from_dict(node_rankings)
+    save_store(out_path, node_ids, ranks)
+
+
+def load_ranks(hazard, cache_dir=RESULT_CACHE_DIR):
+    """災害種類のランキングを開く。配列形式がなく旧 .pkl がある場合は変換してから開く
+
+    どちらも存在しない場合は None を返す。
+    """
+    path = store_path(hazard, cache_dir)
+    if not os.path.exists(os.path.join(path, "ranks.npy")):
+        pkl_path = os.path.join(cache_dir, f"full_ranks_{hazard}.pkl")
+        if not os.path.exists(pkl_path):
+            return None
+        convert_pickle(pkl_path, path)
+    return load_store(path, load_distances(cache_dir))
+
+
+if __name__ == "__main__":
+    # 使い方: python rank_store.py [キャッシュフォルダ]
+    # フォルダ内の full_ranks_*.pkl をすべて配列形式に変換する
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else RESULT_CACHE_DIR
+    for name in sorted(os.listdir(cache_dir)):
+        if name.startswith("full_ranks_") and name.endswith(".pkl"):
+            hazard = name[len("full_ranks_"):-len(".pkl")]
+            convert_pickle(os.path.join(cache_dir, name), store_path(hazard, cache_dir))
+            print(f"✅ {name} を {store_path(hazard, cache_dir)} に変換しました。")
@@ -0,0 +1,332 @@
+import numpy as np
+import json
+import os
+import sys
+from functools import lru_cache
+from cache_manifest import record_artifacts
+from data_cache import get_ranks
+from build_graph import load_graph
+from edge_table import load_edge_table
+from parallel import run_tasks
+from rank_store import NO_SHELTER, RankStore, load_store, save_store, sort_by_distance
+from shelter_table import hazard_columns, read_shelters
+
+# --- 地域の設定と、大きな道路グラフの分割計算 ---
+# 対象地域（市・県など）ごとの道路グラフ・避難所 CSV・キャッシュの置き場所・地図の中心を
+# regions.json で切り替える。環境変数 SHELTER_REGION で使う地域を選ぶ（既定は前橋市）。
+# regions.json はリポジトリに含めない。regions.example.json（群馬県全体の例）をコピーし、
+# 道路グラフ・避難所 CSV・人口メッシュを用意してから使う。
+#
+# tile_m を指定した地域は、道路ノードを経緯度の格子（タイル）に分け、タイルごとに
+# 「タイル + 周囲 overlap_m の重なり」の部分グラフだけでランキングを計算する。
+# ダイクストラ法の計算時間と距離行列のメモリはタイルの大きさで決まり、地域全体の大きさには比例しない。
+# 重なりの外を通る経路は、道路が直線より短くならないことから「重なりの外縁までの直線距離」以上になる。
+# そこで各ノードの上位K件目の距離が外縁までの直線距離より短ければ、部分グラフの結果は地域全体で
+# 計算した結果と一致する（証明済み）とみなす。証明できないノードだけ、重なりを倍にして計算し直す。
+# 到達できる避難所がK件に満たないノードは、同じ連結成分にある避難所の数を上限として判定する。
+# 各タイルは自分のノードの結果だけを保存するため、つなぎ合わせは単純な連結になる。
+# 画面はタイルを読むだけなので、計算にだけ使う scipy は計算する関数の中で読み込む。
+#   <cache_dir>/tiles/index.json             : タイルの範囲・ノード数・最終的な重なり
+#   <cache_dir>/tiles/<タイル>/ranks_<災害列>/ : タイル内のノードの上位K件 (RankStore 形式)
+
+REGIONS_FILE = "regions.json"
+DEFAULT_REGION = "maebashi"
+REGION_ENV = "SHELTER_REGION"
+TILE_DIR = "tiles"
+TOP_K = 8
+WORKERS = None  # タイルを並列に計算するプロセス数（None でCPUコア数）
+METERS_PER_DEGREE = 111320.0
+MARGIN_SAFETY = 0.95  # 外縁までの直線距離に掛ける係数（県程度の範囲での投影の誤差を見込む）
+
+BUILTIN_REGIONS = {
+    "maebashi": {
+        "label": "前橋市",
+        "place": "Maebashi, Gunma, Japan",
+        "graph": "maebashi_graph.graphml",
+        "csv": "emergency_shelter_maebashi.csv",
+        "population": "population_mesh.csv",  # 人口メッシュの CSV（analytics.py。なければ人口の集計を省く）
+        "cache_dir": "cache_results",
+        "center": [36.3895, 139.0634],
+        "zoom": 12,
+        "tile_m": None,  # None なら分割しない（従来の build_cache.py で作る）
+        "overlap_m": 1500,
+    },
+}
+
+
+def load_regions(path=REGIONS_FILE):
+    """{地域名: 設定} を返す（regions.json の内容を組み込みの設定に重ねる）"""
+    regions = {name: dict(config) for name, config in BUILTIN_REGIONS.items()}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for name, config in json.load(f).items():
+                regions[name] = {**BUILTIN_REGIONS[DEFAULT_REGION], **regions.get(name, {}), **config}
+    return regions
+
+
+def get_region(name=None, path=REGIONS_FILE):
+    """地域の設定を返す（name を省略すると環境変数 SHELTER_REGION、なければ前橋市）"""
+    name = name or os.environ.get(REGION_ENV) or DEFAULT_REGION
+    regions = load_regions(path)
+    if name not in regions:
+        raise KeyError(f"unknown region: {name} ({', '.join(regions)})")
+    return {"name": name, **regions[name]}
+
+
+def missing_inputs(region):
+    """地域の設定にある必須の入力ファイル（避難所 CSV）のうち、見つからないものを返す"""
+    return [path for path in (region["csv"],) if not os.path.exists(path)]
+
+
+def is_partitioned(region):
+    return bool(region.get("tile_m"))
+
+
+def tile_dir(region):
+    return os.path.join(region["cache_dir"], TILE_DIR)
+
+
+def edge_dir(region):
+    return os.path.join(region["cache_dir"], "edges")
+
+
+# --- タイル分割 ---
+def _scales(y):
+    """経度・緯度1度あたりの距離 [m]"""
+    return METERS_PER_DEGREE * np.cos(np.radians(float(np.mean(y)))), METERS_PER_DEGREE
+
+
+def tile_keys(x, y, extent, tile_m):
+    """各ノードのタイル番号 (列, 行) を返す"""
+    mx, my = _scales(y)
+    ix = np.floor((np.asarray(x) - extent[0]) * mx / tile_m).astype(np.int64)
+    iy = np.floor((np.asarray(y) - extent[1]) * my / tile_m).astype(np.int64)
+    return ix, iy
+
+
+def tile_bounds(ix, iy, extent, tile_m, y):
+    """タイルの範囲 (最小経度, 最小緯度, 最大経度, 最大緯度)"""
+    mx, my = _scales(y)
+    return (extent[0] + ix * tile_m / mx, extent[1] + iy * tile_m / my,
+            extent[0] + (ix + 1) * tile_m / mx, extent[1] + (iy + 1) * tile_m / my)
+
+
+_worker = {}  # ワーカープロセス内の道路形状テーブル・避難所・連結成分
+
+
+def _init_tile_worker(edges_path, shelter_pos, shelter_ids, active, comp, comp_shelters, scales, extent, top_k):
+    table = load_edge_table(edges_path)
+    _worker.update(
+        x=np.asarray(table["x"]), y=np.asarray(table["y"]),
+        u=np.asarray(table["u"], dtype=np.int64), v=np.asarray(table["v"], dtype=np.int64),
+        length=np.asarray(table["length"], dtype=np.float64),
+        nodes=np.asarray(table["nodes"]), shelter_pos=shelter_pos, shelter_ids=shelter_ids,
+        active=active, comp=comp, comp_shelters=comp_shelters, scales=scales, extent=extent, top_k=top_k,
+    )
+
+
+def _solve(core, bounds, buffer_m):
+    """タイルの範囲を buffer_m 広げた部分グラフで、core のノードの災害ごとの上位K件と証明の可否を求める"""
+    from rank_engine import edges_to_csr, shelter_distance_matrix
+    w = _worker
+    mx, my = w["scales"]
+    lo_x, lo_y = bounds[0] - buffer_m / mx, bounds[1] - buffer_m / my
+    hi_x, hi_y = bounds[2] + buffer_m / mx, bounds[3] + buffer_m / my
+    x, y, extent = w["x"], w["y"], w["extent"]
+    inside = (x >= lo_x) & (x <= hi_x) & (y >= lo_y) & (y <= hi_y)
+    local = np.full(len(x), -1, dtype=np.int64)
+    sel = np.flatnonzero(inside)
+    local[sel] = np.arange(len(sel))
+    keep = inside[w["u"]] & inside[w["v"]]
+    csr = edges_to_csr(local[w["u"][keep]], local[w["v"][keep]], w["length"][keep], len(sel))
+
+    # 外縁までの直線距離 [m]。地域全体の端に達している辺はそれ以上外がないので無限大
+    # （正距円筒図法の誤差の分だけ MARGIN_SAFETY で短めに見積もる）
+    cx, cy = x[core], y[core]
+    margin = np.full(len(core), np.inf)
+    for open_side, dist in ((lo_x > extent[0], (cx - lo_x) * mx), (hi_x < extent[2], (hi_x - cx) * mx),
+                            (lo_y > extent[1], (cy - lo_y) * my), (hi_y < extent[3], (hi_y - cy) * my)):
+        if open_side:
+            margin = np.minimum(margin, dist * MARGIN_SAFETY)
+    covers_all = lo_x <= extent[0] and lo_y <= extent[1] and hi_x >= extent[2] and hi_y >= extent[3]
+
+    rows = np.flatnonzero(inside[w["shelter_pos"]])
+    dist = shelter_distance_matrix(csr, local[w["shelter_pos"][rows]]) if len(rows) else \
+        np.empty((0, len(sel)), dtype=np.float32)
+    results = []
+    for h in range(w["active"].shape[0]):
+        active = w["active"][h, rows]
+        ranks, sorted_dist = sort_by_distance(dist[active][:, local[core]], w["shelter_ids"][rows][active], w["top_k"])
+        if len(ranks) < w["top_k"]:
+            pad = w["top_k"] - len(ranks)
+            ranks = np.vstack([ranks, np.full((pad, len(core)), NO_SHELTER, dtype=np.int16)])
+            sorted_dist = np.vstack([sorted_dist, np.full((pad, len(core)), np.inf, dtype=np.float32)])
+        need = np.minimum(w["top_k"], w["comp_shelters"][h, w["comp"][core]])
+        found = (ranks != NO_SHELTER).sum(axis=0)
+        kth = sorted_dist[np.maximum(need - 1, 0), np.arange(len(core))]
+        certified = (need == 0) | ((found >= need) & (kth < margin))
+        results.append((ranks, sorted_dist, certified | covers_all))
+    return results, covers_all
+
+
+def build_tile(key, core, bounds, overlap_m, out_dir, hazards):
+    """1つのタイルのランキングを、全ノードが証明できるまで重なりを広げながら計算して保存する"""
+    core = np.asarray(core)
+    ranks = [None] * len(hazards)
+    pending = np.ones(len(core), dtype=bool)
+    buffer_m = overlap_m
+    rounds = 0
+    while pending.any():
+        rounds += 1
+        results, covers_all = _solve(core[pending], bounds, buffer_m)
+        still = np.zeros(pending.sum(), dtype=bool)
+        for h, (r, d, certified) in enumerate(results):
+            if ranks[h] is None:
+                ranks[h] = (np.full((len(r), len(core)), NO_SHELTER, dtype=np.int16),
+                            np.full((len(r), len(core)), np.inf, dtype=np.float32))
+            ranks[h][0][:, pending] = r
+            ranks[h][1][:, pending] = d
+            still |= ~certified
+        if covers_all:
+            break
+        pending[np.flatnonzero(pending)[~still]] = False
+        buffer_m *= 2
+
+    node_ids = _worker["nodes"][core]
+    for h, col in enumerate(hazards):
+        active_ids = _worker["shelter_ids"][_worker["active"][h]]
+        save_store(os.path.join(out_dir, key, f"ranks_{col}"), node_ids, ranks[h][0], ranks[h][1],
+                   shelters=active_ids)
+    return {"nodes": int(len(core)), "rounds": rounds, "buffer_m": buffer_m}, len(core)
+
+
+def build_partitions(region, workers=WORKERS, top_k=TOP_K):
+    """分割する地域の全タイルのランキングを作る"""
+    from scipy.sparse.csgraph import connected_components
+    from query import NodeLocator
+    from rank_engine import edges_to_csr
+    tile_m, overlap_m = float(region["tile_m"]), float(region["overlap_m"])
+    table = load_graph(region["graph"], region["cache_dir"])
+    if table is None:
+        print(f"⚠️ グラフファイル {region['graph']} がないため、計算できません。")
+        return None
+    df = read_shelters(region["csv"])
+    hazards = hazard_columns(df)
+    x, y = np.asarray(table["x"]), np.asarray(table["y"])
+    n = len(x)
+
+    # 避難所を最寄りの道路ノードに紐づけ、ノードの連結成分ごとに避難所の数を数える
+    locator = NodeLocator(np.arange(n), x, y)
+    shelter_pos, _ = locator.nearest(df['lat'].to_numpy(), df['lon'].to_numpy())
+    shelter_pos = np.asarray(shelter_pos, dtype=np.int64)
+    csr = edges_to_csr(np.asarray(table["u"]), np.asarray(table["v"]), np.asarray(table["length"]), n)
+    n_comp, comp = connected_components(csr, directed=False)
+    active = np.stack([(df[col] == True).to_numpy() for col in hazards])
+    comp_shelters = np.stack([np.bincount(comp[shelter_pos[a]], minlength=n_comp) for a in active])
+
+    extent = (float(x.min()), float(y.min()), float(x.max()), float(y.max()))
+    ix, iy = tile_keys(x, y, extent, tile_m)
+    order = np.lexsort((iy, ix))
+    starts = np.flatnonzero(np.r_[True, (ix[order][1:] != ix[order][:-1]) | (iy[order][1:] != iy[order][:-1])])
+    groups = np.split(order, starts[1:])
+    tasks, tiles = [], {}
+    for group in groups:
+        key = f"{ix[group[0]]}_{iy[group[0]]}"
+        bounds = tile_bounds(ix[group[0]], iy[group[0]], extent, tile_m, y)
+        tiles[key] = {"bounds": list(bounds)}
+        tasks.append((key, np.sort(group), bounds, overlap_m, tile_dir(region), hazards))
+
+    print(f"🚀 {region.get('label', region['name'])}: ノード {n} 件を {len(tasks)} タイルに分けて計算します...")
+    results = run_tasks(
+        build_tile, tasks, workers,
+        progress=lambda done: print(f"\r⏳ {done}/{n} ノード", end="", flush=True),
+        initializer=_init_tile_worker,
+        initargs=(edge_dir(region), shelter_pos, df.index.to_numpy().astype(np.int16), active, comp,
+                  comp_shelters, _scales(y), extent, top_k),
+    )
+    print()
+    for (key, *_), stats in zip(tasks, results):
+        tiles[key].update(stats)
+    index = {"tile_m": tile_m, "overlap_m": overlap_m, "extent": list(extent), "hazards": hazards,
+             "top_k": top_k, "tiles": tiles}
+    os.makedirs(tile_dir(region), exist_ok=True)
+    with open(os.path.join(tile_dir(region), "index.json"), 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    record_artifacts(["edges"] + [f"ranks_{col}" for col in hazards], df, region["cache_dir"], region["graph"],
+                     region["csv"])
+    expanded = sum(t["rounds"] > 1 for t in tiles.values())
+    print(f"✅ {len(tiles)} タイルを保存しました（重なりを広げて計算し直したタイル: {expanded}）。")
+    return index
+
+
+# --- 表示範囲のタイルだけを読み込む ---
+def load_tile_index(region):
+    path = os.path.join(tile_dir(region), "index.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=256)
+def _tile_store(path, mtime):
+    return load_store(path)
+
+
+def tiles_in_view(index, bounds=None):
+    """表示範囲 (最小経度, 最小緯度, 最大経度, 最大緯度) に重なるタイルの名前（None なら全タイル）"""
+    if bounds is None:
+        return sorted(index["tiles"])
+    return sorted(
+        key for key, tile in index["tiles"].items()
+        if tile["bounds"][0] <= bounds[2] and tile["bounds"][2] >= bounds[0]
+        and tile["bounds"][1] <= bounds[3] and tile["bounds"][3] >= bounds[1]
+    )
+
+
+def load_view(region, hazard, bounds=None):
+    """表示範囲に重なるタイルのランキングをつなぎ合わせた RankStore を返す（タイルがなければ None）"""
+    index = load_tile_index(region)
+    if index is None:
+        return None
+    stores = []
+    for key in tiles_in_view(index, bounds):
+        path = os.path.join(tile_dir(region), key, f"ranks_{hazard}")
+        ranks_file = os.path.join(path, "ranks.npy")
+        if os.path.exists(ranks_file):
+            stores.append(_tile_store(path, os.stat(ranks_file).st_mtime_ns))
+    if not stores:
+        return None
+    node_ids = np.concatenate([s.node_ids for s in stores])
+    order = np.argsort(node_ids, kind='stable')
+    ranks = np.concatenate([s.ranks for s in stores], axis=1)[:, order]
+    dist = np.concatenate([s.dist for s in stores], axis=1)[:, order]
+    return RankStore(node_ids[order], ranks, dist, np.asarray(stores[0].shelters))
+
+
+def rank_limit(region, n):
+    """画面で選べる順位 n の上限
+
+    分割した地域のタイルは上位K件だけを持ち、深い順位を計算する距離行列がないので、K件までに制限する。
+    """
+    if is_partitioned(region):
+        index = load_tile_index(region)
+        if index is not None and index.get("top_k") is not None:
+            return min(n, index["top_k"])
+    return n
+
+
+def region_ranks(region, hazard, bounds=None):
+    """地域のランキングを返す。分割した地域では bounds に重なるタイルだけを読む"""
+    if is_partitioned(region):
+        return load_view(region, hazard, bounds)
+    return get_ranks(hazard, region["cache_dir"])
+
+
+if __name__ == "__main__":
+    # 使い方: python regions.py [地域名] [ワーカー数]
+    region = get_region(sys.argv[1] if len(sys.argv) > 1 else None)
+    if not is_partitioned(region):
+        print(f"⚠️ {region['name']} は分割しない地域です。python build_cache.py を使ってください。")
+        sys.exit(1)
+    build_partitions(region, int(sys.argv[2]) if len(sys.argv) > 2 else WORKERS)
@@ -0,0 +1,132 @@
+import numpy as np
+import json
+import sys
+from analytics import WALK_SPEED
+from rank_store import NO_NODE, NO_SHELTER, RESULT_CACHE_DIR
+
+# --- 避難経路の復元 ---
+# 距離行列と一緒に保存した最短経路木 (cache_results/distances/pred.npy) から、
+# 任意の道路ノードから避難所までの経路をたどり直す。pred[避難所の行, ノード位置] が
+# 避難所へ向かう次のノードなので、NO_NODE に着くまで追うだけで経路が決まり、
+# ダイクストラ法を実行し直さずに経路の長さに比例する時間で求まる。
+# 経路の形状は、たどったノードの間の道路（同じ向きの多重辺は最短のもの）の座標をつないで作る。
+
+
+class RouteFinder:
+    """道路形状テーブルと最短経路木から避難経路を組み立てる"""
+
+    def __init__(self, table):
+        self.node_ids = np.asarray(table["nodes"])
+        self.xy = np.column_stack([table["x"], table["y"]])
+        self.coords = np.asarray(table["coords"])
+        self.offsets = np.asarray(table["offsets"])
+        self.length = np.asarray(table["length"], dtype=np.float64)
+        # (始点位置, 終点位置) → 道路番号。rank_engine.edges_to_csr と同じく最短の道路を使う
+        u, v = np.asarray(table["u"], dtype=np.int64), np.asarray(table["v"], dtype=np.int64)
+        keys = u * len(self.node_ids) + v
+        order = np.lexsort((self.length, keys))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = keys[order][1:] != keys[order][:-1]
+        self.keys = keys[order][first]
+        self.edges = order[first]
+
+    def route_nodes(self, pred_row, start):
+        """ノード位置 start から最短経路木 pred_row をたどったノード位置の配列（避難所のノードで終わる）"""
+        nodes = [int(start)]
+        while pred_row[nodes[-1]] != NO_NODE:
+            nodes.append(int(pred_row[nodes[-1]]))
+            if len(nodes) > len(pred_row):
+                raise ValueError("最短経路木に閉路があります")
+        return np.array(nodes, dtype=np.int64)
+
+    def route_edges(self, nodes):
+        """連続するノード位置の間の道路番号"""
+        keys = nodes[:-1] * len(self.node_ids) + nodes[1:]
+        pos = np.searchsorted(self.keys, keys)
+        return self.edges[pos]
+
+    def route(self, distances, node_id, shelter_id):
+        """道路ノード node_id から避難所 shelter_id までの経路
+
+        distances は最短経路木を持つ DistanceStore。戻り値は (ノードIDの配列, 経路の座標 (点数, 2) の
+        (経度, 緯度), 道路距離 [m])。到達できない場合は None。
+        """
+        pos = int(np.searchsorted(self.node_ids, node_id))
+        if pos >= len(self.node_ids) or self.node_ids[pos] != node_id:
+            return None
+        row = int(distances.rows([shelter_id])[0])
+        if not np.isfinite(distances.dist[row, pos]):
+            return None
+        nodes = self.route_nodes(distances.pred[row], pos)
+        if len(nodes) == 1:  # 避難所のノードそのもの
+            return self.node_ids[nodes], self.xy[nodes], 0.0
+        edges = self.route_edges(nodes)
+        # 各道路の座標をつなぎ、道路のつなぎ目で重なる点（2本目以降の始点）を除く
+        counts = self.offsets[edges + 1] - self.offsets[edges]
+        starts = np.repeat(self.offsets[edges] - np.r_[0, np.cumsum(counts)[:-1]], counts)
+        points = starts + np.arange(counts.sum())
+        keep = np.ones(len(points), dtype=bool)
+        keep[np.cumsum(counts)[:-1]] = False
+        return self.node_ids[nodes], self.coords[points[keep]], float(self.length[edges].sum())
+
+
+def has_routes(distances):
+    """経路を復元できる（最短経路木が保存されている）か"""
+    return distances is not None and distances.pred is not None
+
+
+def routes_geojson(finder, distances, shelters_df, node_ids, shelter_ids, labels=None):
+    """地点ごとの経路を LineString の GeoJSON FeatureCollection にする
+
+    node_ids は各地点の道路ノードID、shelter_ids は行き先の避難所ID（NO_SHELTER は省く）。
+    labels を渡すと各地点の名前を属性 "地点" に入れる。
+    """
+    features = []
+    for i, (node_id, shelter_id) in enumerate(zip(node_ids, shelter_ids)):
+        if shelter_id == NO_SHELTER:
+            continue
+        found = finder.route(distances, node_id, int(shelter_id))
+        if found is None:
+            continue
+        _, coords, length = found
+        if len(coords) < 2:  # 避難所のノード上の地点は長さ 0 の線にする
+            coords = np.repeat(coords, 2, axis=0)
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": coords.round(7).tolist()},
+            "properties": {
+                "地点": labels[i] if labels is not None else i,
+                "避難所ID": int(shelter_id),
+                "避難所名": str(shelters_df.loc[int(shelter_id), 'name']),
+                "道路距離[m]": round(length, 1),
+                "徒歩[分]": round(length / WALK_SPEED, 1),
+            },
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+if __name__ == "__main__":
+    # 使い方: python routes.py 災害列 地点CSV(lat, lon 列。name 列があれば地点名) [n] [出力.geojson]
+    # 例えば学区ごとの代表地点の CSV を渡すと、各地点から n番目に近い避難所までの経路をまとめて書き出す
+    from build_graph import load_graph
+    from query import NodeLocator, nearest_shelters
+    from rank_store import load_ranks
+    from shelter_table import read_csv, read_shelters
+    from update_ranks import GRAPH_CACHE
+    hazard, points_csv = sys.argv[1], sys.argv[2]
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    out_path = sys.argv[4] if len(sys.argv) > 4 else f"routes_{hazard}.geojson"
+
+    store = load_ranks(hazard, RESULT_CACHE_DIR)
+    if store is None or not has_routes(store.distances):
+        sys.exit("⚠️ 最短経路木がありません。python update_ranks.py --full で作り直してください。")
+    table = load_graph(GRAPH_CACHE, RESULT_CACHE_DIR)
+    points = read_csv(points_csv)
+    locator = NodeLocator(table["nodes"], table["x"], table["y"])
+    node_ids, _ = locator.nearest(points['lat'], points['lon'])
+    ids, _ = nearest_shelters(store, node_ids, n)
+    labels = points['name'].astype(str).tolist() if 'name' in points.columns else None
+    collection = routes_geojson(RouteFinder(table), store.distances, read_shelters(), node_ids, ids[:, n - 1], labels)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(collection, f, ensure_ascii=False)
+    print(f"✅ {len(collection['features'])} / {len(points)} 地点の経路を {out_path} に書き出しました。")
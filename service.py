@@ -0,0 +1,293 @@
+import numpy as np
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from build_graph import load_graph
+from edge_table import edge_node_ids
+from hazards import HAZARD_COLS
+from ownership import coverage_meters, edge_owners, edge_segments
+from query import NodeLocator, query_points
+from rank_store import NO_SHELTER, RESULT_CACHE_DIR, load_ranks, store_path
+from shelter_table import read_shelters
+
+# --- 問い合わせ用の HTTP サービス（標準ライブラリの asyncio のみ） ---
+# Streamlit のように操作のたびにスクリプト全体を実行し直さず、ランキング・道路形状・KD 木を
+# プロセス内に1度だけ読み込んで、次のエンドポイントで応答する。
+#   GET  /meta                          : 災害種類・ノード数・道路数
+#   GET  /owners?hazard=&n=[&per=edge]  : n番目の持ち主 (int16, リトルエンディアン。ノード順または道路順)
+#   GET  /coverage?hazard=&n=           : 避難所ごとの担当道路数と担当道路延長 [m] (JSON)
+#   GET  /query?hazard=&lat=&lon=[&n=]  : 地点から近い避難所 (JSON)
+#   POST /query                         : {"hazard", "points": [[緯度, 経度], ...], "n"} の一括問い合わせ
+# 符号化済みの応答は LRU キャッシュに保持し、ETag が一致する場合は 304 を返す。
+# キャッシュのキーにはランキングファイルの更新時刻を含めるので、再計算後は自動的に作り直される。
+# 応答を作る numpy の計算はスレッドプールで実行し、計算中もイベントループは他の接続に応答する。
+
+HOST = "127.0.0.1"
+PORT = 8502
+CACHE_SIZE = 256  # LRU キャッシュに保持する応答の数
+MAX_POINTS = 10000  # 1回の問い合わせで受け付ける地点数の上限
+THREADS = 4  # 応答を作るスレッドの数
+
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    """符号化済みの応答 (本文, Content-Type, ETag) を保持する LRU キャッシュ"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """保持している応答を返す（なければ None）"""
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            return None
+
+    def get(self, key, build):
+        entry = self.lookup(key)
+        if entry is not None:
+            return entry
+        with self._lock:
+            self.misses += 1
+        # 作る間はロックを外し、他のスレッドのキャッシュの参照を止めない
+        body, content_type = build()
+        entry = (body, content_type, '"%s"' % hashlib.sha1(body).hexdigest())
+        with self._lock:
+            self.entries[key] = entry
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+class ShelterService:
+    """ランキング・道路形状・避難所一覧を保持し、各エンドポイントの応答を作る"""
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, cache_size=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.df = read_shelters()
+        self.table = load_graph(cache_dir=cache_dir)
+        self.edge_u, self.edge_v = (np.asarray(ids) for ids in edge_node_ids(self.table))
+        self.locator = NodeLocator(self.table["nodes"], self.table["x"], self.table["y"])
+        self.cache = ResponseCache(cache_size)
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def _version(self, hazard):
+        path = os.path.join(store_path(hazard, self.cache_dir), "ranks.npy")
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    def _store(self, hazard):
+        """災害種類のランキングを開く（ファイルが更新されていれば開き直す）"""
+        if hazard not in HAZARD_COLS:
+            raise HttpError(404, f"unknown hazard: {hazard}")
+        with self._lock:
+            version = self._version(hazard)
+            cached = self._stores.get(hazard)
+            if cached is None or cached[0] != version:
+                store = load_ranks(hazard, self.cache_dir)
+                if store is None:
+                    raise HttpError(404, f"no rankings for {hazard}")
+                u_pos, v_pos = store.node_index(self.edge_u), store.node_index(self.edge_v)
+                cached = (self._version(hazard), store, u_pos, v_pos)
+                self._stores[hazard] = cached
+            return cached
+
+    def meta(self):
+        body = {
+            "hazards": [h for h in HAZARD_COLS if self._version(h) is not None],
+            "node_count": int(len(self.table["nodes"])),
+            "edge_count": int(len(self.edge_u)),
+        }
+        return json.dumps(body, ensure_ascii=False).encode(), "application/json"
+
+    def owners(self, hazard, n, per):
+        _, store, u_pos, _ = self._store(hazard)
+        owners = store.owner(n)
+        if per == "edge":
+            owners = edge_owners(owners, u_pos)
+        return np.asarray(owners, dtype='<i2').tobytes(), "application/octet-stream"
+
+    def coverage(self, hazard, n):
+        _, store, u_pos, v_pos = self._store(hazard)
+        owners = store.owner(n)
+        edge_owner = edge_owners(owners, u_pos)
+        counts = np.bincount(edge_owner[edge_owner != NO_SHELTER], minlength=len(self.df))
+        meters = coverage_meters(edge_segments(self.table, owners, store.distance(n), u_pos, v_pos), len(self.df))
+        body = [
+            {"id": int(sid), "name": self.df.at[sid, 'name'], "roads": int(counts[sid]),
+             "meters": round(float(meters[sid]), 1)}
+            for sid in np.flatnonzero((counts > 0) | (meters > 0))
+        ]
+        body.sort(key=lambda row: (-row["meters"], row["id"]))
+        return json.dumps(body, ensure_ascii=False).encode(), "application/json"
+
+    def _checked(self, hazard, n):
+        """災害種類のランキングを開き、n がその災害の避難所数以下か確かめる"""
+        cached = self._store(hazard)
+        store = cached[1]
+        max_n = len(store.shelters) if store.shelters is not None else store.depth
+        if n > max_n:
+            raise HttpError(400, f"n must be <= {max_n} for {hazard}")
+        return cached
+
+    def query(self, hazard, points, n):
+        _, store, _, _ = self._store(hazard)
+        ids, dist, snap_dist = query_points(self.locator, store, points[:, 0], points[:, 1], n)
+        names = self.df['name'].to_numpy()
+        body = [
+            {
+                "snap_m": round(float(snap), 1),
+                "shelters": [
+                    {"id": int(sid), "name": names[sid], "road_m": round(float(d + snap), 1)}
+                    for sid, d in zip(row_ids, row_dist) if sid != NO_SHELTER
+                ],
+            }
+            for row_ids, row_dist, snap in zip(ids, dist, snap_dist)
+        ]
+        return json.dumps(body, ensure_ascii=False).encode(), "application/json"
+
+    def handle(self, method, target, body):
+        """(メソッド, パス+クエリ, 本文) から (本文, Content-Type, ETag) を返す"""
+        return self.cache.get(*self.route(method, target, body))
+
+    def route(self, method, target, body):
+        """要求を検証し、(キャッシュのキー, 応答を作る関数) を返す"""
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if method == "POST" and url.path == "/query":
+                request = json.loads(body or b"{}")
+                if not isinstance(request, dict):
+                    raise HttpError(400, "bad request: body must be a JSON object")
+                params = {"hazard": request.get("hazard", "")}
+                points = request.get("points", [])
+                n = request.get("n", 3)
+                # JSON の整数だけを受け付ける（2.7 や true を丸めない）
+                if isinstance(n, bool) or not isinstance(n, int):
+                    raise ValueError(f"n must be an integer: {n!r}")
+            elif method != "GET":
+                raise HttpError(405, "method not allowed")
+            else:
+                if url.path == "/query":
+                    points = [[params["lat"], params["lon"]]]
+                n = params.get("n", "1" if url.path != "/query" else "3")
+                if not n.lstrip("+-").isdigit():
+                    raise ValueError(f"n must be an integer: {n!r}")
+                n = int(n)
+            hazard = params.get("hazard", "")
+            if url.path == "/query":
+                # [[緯度, 経度], ...] の数値の組だけを受け付ける
+                points = np.asarray(points, dtype=np.float64)
+                if points.size % 2 or (points.size and points.shape[-1] != 2):
+                    raise ValueError("points must be [[lat, lon], ...]")
+                points = points.reshape(-1, 2)
+                if not np.isfinite(points).all():
+                    raise ValueError("points must be finite numbers")
+        except (KeyError, TypeError, ValueError, OverflowError) as e:
+            raise HttpError(400, f"bad request: {e}")
+        if n < 1:
+            raise HttpError(400, "n must be >= 1")
+
+        if url.path == "/meta":
+            return ("meta",) + tuple(self._version(h) for h in HAZARD_COLS), self.meta
+        if url.path == "/owners":
+            per = params.get("per", "node")
+            key = ("owners", hazard, n, per, self._checked(hazard, n)[0])
+            return key, lambda: self.owners(hazard, n, per)
+        if url.path == "/coverage":
+            key = ("coverage", hazard, n, self._checked(hazard, n)[0])
+            return key, lambda: self.coverage(hazard, n)
+        if url.path == "/query":
+            if len(points) > MAX_POINTS:
+                raise HttpError(400, f"too many points (max {MAX_POINTS})")
+            key = ("query", hazard, n, self._checked(hazard, n)[0], points.tobytes())
+            return key, lambda: self.query(hazard, points, n)
+        raise HttpError(404, f"not found: {url.path}")
+
+
+def _response(status, body=b"", content_type="text/plain; charset=utf-8", etag=None, keep_alive=True):
+    headers = [
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(body)}",
+        "Access-Control-Allow-Origin: *",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    if etag:
+        headers += [f"ETag: {etag}", "Cache-Control: no-cache"]
+    return ("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body
+
+
+async def _serve_connection(service, reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, version = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+            try:
+                # キャッシュにある応答はそのまま返し、作り直しが必要なものだけスレッドで計算する
+                key, build = service.route(method, target, body)
+                entry = service.cache.lookup(key)
+                if entry is None:
+                    entry = await loop.run_in_executor(executor, service.cache.get, key, build)
+                payload, content_type, etag = entry
+                if headers.get("if-none-match") == etag:
+                    writer.write(_response(304, etag=etag, keep_alive=keep_alive))
+                else:
+                    writer.write(_response(200, payload, content_type, etag, keep_alive))
+            except HttpError as e:
+                writer.write(_response(e.status, str(e).encode(), keep_alive=keep_alive))
+            except Exception as e:
+                writer.write(_response(500, repr(e).encode(), keep_alive=keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ValueError, asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host=HOST, port=PORT, cache_dir=RESULT_CACHE_DIR, threads=THREADS):
+    service = ShelterService(cache_dir)
+    with ThreadPoolExecutor(threads) as executor:
+        server = await asyncio.start_server(lambda r, w: _serve_connection(service, r, w, executor), host, port)
+        print(f"🚀 http://{host}:{port} で待ち受けています。")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    # 使い方: python service.py [ポート番号]
+    asyncio.run(serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else PORT))
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import json
+import os
+import sys
+from capacity import CAPACITY_COL
+from rank_store import RESULT_CACHE_DIR, save_array
+
+# --- 避難所テーブル ---
+# 避難所 CSV を型を揃えた表にして読み込む。
+#   name         : 文字列
+#   lat, lon     : float64
+#   capacity     : float64（列がある場合。空欄は NaN）
+#   その他の列    : 災害フラグ (bool)。TRUE / 1 だけを True とし、空欄などは False にする
+# 画面の起動のたびに CSV を文字コードを試しながら解析し直さないよう、型を揃えた表を
+# <キャッシュフォルダ>/shelter_table/ に列ごとの .npy として書き出しておき、次回からはそれを読む。
+# CSV の中身が変わったら（サイズ・更新時刻、変わっていれば sha256 で判定）書き出し直す。
+
+CSV_FILE = "emergency_shelter_maebashi.csv"
+SHELTER_TABLE_DIR = "shelter_table"
+BASE_COLS = ("name", "lat", "lon")
+NUMERIC_COLS = (CAPACITY_COL,)  # 災害フラグではなく数値として扱う列
+
+
+def hazard_columns(df):
+    """CSV の災害フラグ列（名前・座標・収容上限以外の列）"""
+    return [col for col in df.columns if col not in BASE_COLS + NUMERIC_COLS]
+
+
+def normalize(df):
+    """CSV から読んだ表の型を揃える（災害フラグは bool、座標は float64）"""
+    df = df.copy()
+    df['name'] = df['name'].astype(str)
+    for col in ("lat", "lon") + tuple(c for c in NUMERIC_COLS if c in df.columns):
+        df[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float64)
+    for col in hazard_columns(df):
+        df[col] = (df[col] == True).to_numpy(dtype=bool)
+    return df
+
+
+def read_csv(path):
+    """CSV をそのまま読む（UTF-8 で読めなければ cp932）"""
+    try:
+        return pd.read_csv(path, encoding='utf-8')
+    except UnicodeDecodeError:
+        return pd.read_csv(path, encoding='cp932')
+
+
+def read_shelters(csv_file=CSV_FILE):
+    """避難所 CSV を解析して型を揃えた表を返す"""
+    return normalize(read_csv(csv_file))
+
+
+def table_path(cache_dir=RESULT_CACHE_DIR):
+    return os.path.join(cache_dir, SHELTER_TABLE_DIR)
+
+
+def save_table(df, source, cache_dir=RESULT_CACHE_DIR):
+    """型を揃えた表を列ごとの .npy と列の情報 (table.json) として書き出す"""
+    path = table_path(cache_dir)
+    os.makedirs(path, exist_ok=True)
+    hazards = hazard_columns(df)
+    numeric = [col for col in NUMERIC_COLS if col in df.columns]
+    save_array(os.path.join(path, "name.npy"), df['name'].to_numpy(dtype=str), str)
+    save_array(os.path.join(path, "coords.npy"), df[["lat", "lon"] + numeric].to_numpy(), np.float64)
+    save_array(os.path.join(path, "flags.npy"), df[hazards].to_numpy(dtype=bool).reshape(len(df), -1), bool)
+    info = {"columns": list(df.columns), "hazards": hazards, "numeric": numeric, "csv": source}
+    # 列の情報は最後に書き、途中で止まった書き出しを読まないようにする
+    with open(os.path.join(path, "table.json.tmp"), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False)
+    os.replace(os.path.join(path, "table.json.tmp"), os.path.join(path, "table.json"))
+
+
+def load_table(cache_dir=RESULT_CACHE_DIR):
+    """書き出した表を読む（ない場合は None）。戻り値は (表, 元の CSV の記録)"""
+    path = table_path(cache_dir)
+    if not os.path.exists(os.path.join(path, "table.json")):
+        return None
+    with open(os.path.join(path, "table.json"), encoding='utf-8') as f:
+        info = json.load(f)
+    coords = np.load(os.path.join(path, "coords.npy"))
+    flags = np.load(os.path.join(path, "flags.npy"))
+    columns = {"name": np.load(os.path.join(path, "name.npy")).astype(object)}
+    for i, col in enumerate(["lat", "lon"] + info["numeric"]):
+        columns[col] = coords[:, i]
+    for i, col in enumerate(info["hazards"]):
+        columns[col] = flags[:, i]
+    df = pd.DataFrame(columns)[info["columns"]]
+    df['name'] = df['name'].astype(str)
+    return df, info["csv"]
+
+
+def load_shelters(csv_file=CSV_FILE, cache_dir=RESULT_CACHE_DIR):
+    """型を揃えた避難所テーブルを返す。書き出した表が CSV と一致すればそれを読み、なければ作り直す"""
+    from cache_manifest import file_digest
+    cached = load_table(cache_dir)
+    known = cached[1] if cached is not None else None
+    source = file_digest(csv_file, known)
+    if source is None:
+        if cached is None:
+            raise FileNotFoundError(csv_file)
+        return cached[0]  # CSV がなければ書き出した表をそのまま使う
+    if cached is not None and known.get("sha256") == source["sha256"]:
+        return cached[0]
+    df = read_shelters(csv_file)
+    try:
+        save_table(df, source, cache_dir)
+    except OSError as e:  # 読み取り専用の配置でも CSV から読んだ表で動かす
+        print(f"⚠️ 避難所テーブルを書き出せませんでした: {e}")
+    return df
+
+
+if __name__ == "__main__":
+    # 使い方: python shelter_table.py [CSV] [キャッシュフォルダ]
+    csv_file = sys.argv[1] if len(sys.argv) > 1 else CSV_FILE
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else RESULT_CACHE_DIR
+    df = read_shelters(csv_file)
+    from cache_manifest import file_digest
+    save_table(df, file_digest(csv_file), cache_dir)
+    print(f"✅ 避難所 {len(df)} 件・災害 {len(hazard_columns(df))} 種類の表を {table_path(cache_dir)} に書き出しました。")
@@ -0,0 +1,166 @@
+import numpy as np
+import os
+from scipy.sparse.csgraph import dijkstra
+from instrument import rss_mb
+from rank_store import DISTANCE_DIR, NO_NODE, NO_SHELTER, RESULT_CACHE_DIR, save_array, store_path
+
+# --- メモリ使用量に上限を設けたランキング計算 ---
+# 避難所 × ノードの距離行列をメモリ上に持たず、避難所を数件ずつのかたまり (chunk) に分けて処理する。
+#   1. かたまりの避難所からダイクストラ法で距離を求め、距離行列のファイルに直接書き出す
+#   2. 災害種類ごとの「ここまでの上位K件」と合わせて並べ直し、上位K件だけを残す
+# 上位K件の途中結果も出力先の .npy をメモリマップで開いたものに直接書き、かたまりごとに閉じる。
+# 並べ直しはノードを区切った範囲 (block) ごとに行うので、作業用のメモリはかたまりの行数と
+# 範囲の大きさだけで決まり、グラフや避難所の数によらず memory_limit_mb 以下に収まる。
+# 避難所は行の順に処理し、ここまでの上位K件（先の行）を前に置いて安定ソートするので、
+# 同じ距離の並びも含めて sort_by_distance でまとめて並べた結果と完全に一致する。
+# 距離行列を書き出す場合は、経路の復元 (routes.py) に使う最短経路木 pred.npy も同じ行ごとに書き出す。
+
+MEMORY_LIMIT_MB = 1024  # 計算中のピーク RSS の目安 [MB]
+MAX_CHUNK_ROWS = 64  # 1回のダイクストラ法で扱う避難所の数の上限
+MIN_WORK_MB = 16  # 上限が小さすぎる場合も確保する作業用のメモリ [MB]
+MERGE_BYTES = 4 + 2 + 8 + 4 + 2  # 並べ直しで候補1件あたりに使う量（距離・ID・並び順・取り出した距離とID）
+
+
+def dense_bytes(n_shelters, n_nodes):
+    """距離行列と最短経路木をメモリ上に持つ場合の大きさ [バイト]（float32 と int32）"""
+    return n_shelters * n_nodes * 8
+
+
+def plan_chunks(n_nodes, top_k, memory_limit_mb=MEMORY_LIMIT_MB):
+    """(かたまりの行数, 並べ直す範囲のノード数) を、いまの RSS と上限の差から決める"""
+    base = rss_mb() or 0.0
+    avail = max(memory_limit_mb - base, MIN_WORK_MB) * 2**20
+    # ダイクストラ法の出力 (float64 と int32) と float32 への変換で1行あたり 16 バイト × ノード数
+    rows = int(min(max(avail * 0.5 // (n_nodes * 16), 1), MAX_CHUNK_ROWS))
+    block = int(min(max(avail * 0.25 // ((top_k + rows) * MERGE_BYTES), 1024), n_nodes))
+    return rows, max(block, 1)
+
+
+def _open_output(path, shape, dtype, fill):
+    """出力の .npy を一時ファイルとしてメモリマップで作り、fill で埋める（一時ファイルのパスを返す）"""
+    tmp = path + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+    out[...] = fill
+    out.flush()
+    del out
+    return tmp
+
+
+def merge_top_k(run_dist, run_ids, rows, row_ids, block):
+    """上位K件 (run_dist, run_ids) に距離の行 rows を合わせ、上位K件をその場で書き換える
+
+    run_* は先に処理した（行番号の小さい）避難所の結果なので、前に置いて安定ソートすれば
+    同じ距離は行番号の順になる。到達できない順位の ID は NO_SHELTER にする。
+    """
+    k = run_dist.shape[0]
+    ids = np.asarray(row_ids, dtype=np.int16)[:, None]
+    for b0 in range(0, run_dist.shape[1], block):
+        b1 = min(b0 + block, run_dist.shape[1])
+        cand_dist = np.concatenate([run_dist[:, b0:b1], rows[:, b0:b1]])
+        cand_ids = np.concatenate([run_ids[:, b0:b1], np.broadcast_to(ids, (len(ids), b1 - b0))])
+        order = np.argsort(cand_dist, axis=0, kind='stable')[:k]
+        top_dist = np.take_along_axis(cand_dist, order, axis=0)
+        top_ids = np.take_along_axis(cand_ids, order, axis=0)
+        top_ids[~np.isfinite(top_dist)] = NO_SHELTER
+        run_dist[:, b0:b1] = top_dist
+        run_ids[:, b0:b1] = top_ids
+
+
+def stream_rankings(csr, node_ids, shelter_idx, shelter_ids, hazards, cache_dir=RESULT_CACHE_DIR, top_k=None,
+                    memory_limit_mb=MEMORY_LIMIT_MB, reuse=None, write_distances=True, progress=None):
+    """距離行列と災害種類ごとのランキングを、メモリ上に距離行列を持たずに計算して保存する
+
+    shelter_idx は各避難所（距離行列の行）の道路ノード位置、hazards は {災害列: 有効な避難所の bool 配列}。
+    reuse=(DistanceStore, source) を渡すと、source[i] >= 0 の行は保存済みの距離行列の source[i] 行を
+    そのまま使い、ダイクストラ法は source[i] < 0 の行だけ実行する（差分更新用）。
+    全行を再利用して災害のランキングだけを作る場合は write_distances=False で距離行列を書き直さない。
+    距離行列と一緒に最短経路木も書き出す。再利用元に最短経路木がなければ書き出さず、古いものは消す。
+    結果は update_ranks / save_rankings と同じ形式で cache_dir に保存する。
+    progress を渡すとかたまりごとに progress(完了した行数, 全行数) を呼ぶ。
+    """
+    node_ids = np.asarray(node_ids)
+    shelter_idx = None if shelter_idx is None else np.asarray(shelter_idx)
+    shelter_ids = np.asarray(shelter_ids)
+    n_rows, n_nodes = len(shelter_ids), len(node_ids)
+    old, source = reuse if reuse is not None else (None, np.full(n_rows, -1))
+    depth = {col: int(active.sum()) if top_k is None else min(top_k, int(active.sum()))
+             for col, active in hazards.items()}
+    rows_per_chunk, block = plan_chunks(n_nodes, max(depth.values(), default=1), memory_limit_mb)
+
+    dist_dir = os.path.join(cache_dir, DISTANCE_DIR)
+    with_pred = write_distances and (old is None or old.pred is not None or not (source >= 0).any())
+    if write_distances:
+        os.makedirs(dist_dir, exist_ok=True)
+        dist_tmp = _open_output(os.path.join(dist_dir, "dist.npy"), (n_rows, n_nodes), np.float32, np.inf)
+    if with_pred:
+        pred_tmp = _open_output(os.path.join(dist_dir, "pred.npy"), (n_rows, n_nodes), np.int32, NO_NODE)
+    outputs = {}
+    for col, k in depth.items():
+        path = store_path(col, cache_dir)
+        os.makedirs(path, exist_ok=True)
+        outputs[col] = (
+            _open_output(os.path.join(path, "dist.npy"), (k, n_nodes), np.float32, np.inf),
+            _open_output(os.path.join(path, "ranks.npy"), (k, n_nodes), np.int16, NO_SHELTER),
+        )
+
+    for start in range(0, n_rows, rows_per_chunk):
+        stop = min(start + rows_per_chunk, n_rows)
+        rows = np.empty((stop - start, n_nodes), dtype=np.float32)
+        pred = np.empty((stop - start, n_nodes), dtype=np.int32) if with_pred else None
+        reused = source[start:stop] >= 0
+        if reused.any():
+            rows[reused] = old.dist[source[start:stop][reused]]
+            if with_pred:
+                pred[reused] = old.pred[source[start:stop][reused]]
+        if (~reused).any():
+            # 同じノードに紐づく避難所はダイクストラ法を1回だけ実行する
+            unique_nodes, inverse = np.unique(shelter_idx[start:stop][~reused], return_inverse=True)
+            if with_pred:
+                d, p = dijkstra(csr, directed=True, indices=unique_nodes, return_predecessors=True)
+                p[p < 0] = NO_NODE  # scipy は -9999 で表す
+                rows[~reused], pred[~reused] = d.astype(np.float32)[inverse], p[inverse]
+                del d, p
+            else:
+                rows[~reused] = dijkstra(csr, directed=True, indices=unique_nodes).astype(np.float32)[inverse]
+
+        if write_distances:
+            dist_out = np.load(dist_tmp, mmap_mode='r+')
+            dist_out[start:stop] = rows
+            dist_out.flush()
+            del dist_out
+        if with_pred:
+            pred_out = np.load(pred_tmp, mmap_mode='r+')
+            pred_out[start:stop] = pred
+            pred_out.flush()
+            del pred_out, pred
+        for col, active in hazards.items():
+            chunk_active = np.asarray(active[start:stop], dtype=bool)
+            if not chunk_active.any() or depth[col] == 0:
+                continue
+            # 途中結果は毎回開き直し、書き終えたページをプロセスのメモリに残さない
+            run_dist = np.load(outputs[col][0], mmap_mode='r+')
+            run_ids = np.load(outputs[col][1], mmap_mode='r+')
+            merge_top_k(run_dist, run_ids, rows[chunk_active], shelter_ids[start:stop][chunk_active], block)
+            run_dist.flush()
+            run_ids.flush()
+            del run_dist, run_ids
+        del rows
+        if progress is not None:
+            progress(stop, n_rows)
+
+    # 一時ファイルを置き換えて確定する（読み手がメモリマップで開いている旧ファイルは壊さない）
+    if write_distances:
+        save_array(os.path.join(dist_dir, "nodes.npy"), node_ids, np.int64)
+        save_array(os.path.join(dist_dir, "shelters.npy"), shelter_ids, np.int16)
+        os.replace(dist_tmp, os.path.join(dist_dir, "dist.npy"))
+    if with_pred:
+        os.replace(pred_tmp, os.path.join(dist_dir, "pred.npy"))
+    elif write_distances and os.path.exists(os.path.join(dist_dir, "pred.npy")):
+        os.remove(os.path.join(dist_dir, "pred.npy"))  # 書き直した距離行列と合わない古い最短経路木
+    for col, (dist_path, ranks_path) in outputs.items():
+        path = store_path(col, cache_dir)
+        save_array(os.path.join(path, "nodes.npy"), node_ids, np.int64)
+        save_array(os.path.join(path, "shelters.npy"), shelter_ids[np.asarray(hazards[col], dtype=bool)], np.int16)
+        os.replace(dist_path, os.path.join(path, "dist.npy"))
+        os.replace(ranks_path, os.path.join(path, "ranks.npy"))
+    return rows_per_chunk, block
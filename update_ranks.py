@@ -0,0 +1,197 @@
+import numpy as np
+import os
+import sys
+from collections import Counter
+from cache_manifest import record_artifacts
+from hazards import ALL_SHELTERS, hazard_active
+from rank_engine import save_rankings, shelter_distance_matrix, snap_shelters, table_to_csr
+from shelter_table import hazard_columns, read_shelters
+from rank_store import (
+    load_distances, load_manifest, save_distances, save_manifest, store_path,
+)
+from streaming import MEMORY_LIMIT_MB, dense_bytes, stream_rankings
+
+# --- ランキングの差分更新 ---
+# CSV を前回の目録 (cache_results/distances/shelters.json) と比べ、
+# 追加・移動された避難所だけダイクストラ法を実行する。削除やフラグの変更は
+# 保存済みの距離行列の行を並べ替えるだけで済むため、道路グラフも読み込まない。
+# 距離行列が MEMORY_LIMIT_MB を超える大きさになる場合は、streaming.py で避難所を少しずつ
+# 計算してファイルに書き出し、距離行列全体をメモリに載せない。
+# 災害ごとのランキングに加え、全避難所の全順位のランキング (ranks_all) も作っておき、
+# 災害を組み合わせた問い合わせはそこから条件に合う避難所だけを数えて答える。
+
+CSV_FILE = "emergency_shelter_maebashi.csv"
+GRAPH_CACHE = "maebashi_graph.graphml"
+RESULT_CACHE_DIR = "cache_results"
+TOP_K = 8
+MASTER_TOP_K = None  # 全避難所のランキングに保存する順位の数（None で全順位）
+WORKERS = None  # ダイクストラ法を並列に実行するプロセス数（None でCPUコア数、1 で並列化しない）
+
+def shelter_manifest(df, shelter_nodes):
+    """距離行列の各行に対応する避難所の目録を作る"""
+    hazards = hazard_columns(df)
+    return {
+        "hazards": hazards,
+        "shelters": [
+            {
+                "name": row['name'], "lat": float(row['lat']), "lon": float(row['lon']),
+                "node": int(node), "flags": {col: bool(row[col] == True) for col in hazards},
+            }
+            for (_, row), node in zip(df.iterrows(), shelter_nodes)
+        ],
+    }
+
+def _was_active(shelter, col):
+    # 前回の目録で、その避難所が災害 col のランキングに含まれていたか
+    return col == ALL_SHELTERS or shelter['flags'].get(col, False)
+
+def _shelter_keys(names):
+    # 同名の施設があるため、(名前, 同名の中での出現順) で施設を識別する
+    seen = Counter()
+    keys = []
+    for name in names:
+        keys.append((name, seen[name]))
+        seen[name] += 1
+    return keys
+
+def diff_shelters(df, manifest):
+    """CSV の各行について、距離を再利用できる前回の行番号を返す
+
+    戻り値は (再利用元の行番号の配列（再計算が必要な行は -1）, 移動した行の前回の行番号,
+    削除された前回の行番号のリスト)。
+    """
+    old = manifest["shelters"]
+    old_rows = dict(zip(_shelter_keys([s['name'] for s in old]), range(len(old))))
+
+    source = np.full(len(df), -1, dtype=np.int64)
+    moved_from = np.full(len(df), -1, dtype=np.int64)
+    for i, (key, lat, lon) in enumerate(zip(_shelter_keys(df['name']), df['lat'], df['lon'])):
+        j = old_rows.pop(key, None)
+        if j is None:
+            continue
+        if old[j]['lat'] == lat and old[j]['lon'] == lon:
+            source[i] = j
+        else:
+            moved_from[i] = j
+    return source, moved_from, sorted(old_rows.values())
+
+def update_rankings(cache_dir=RESULT_CACHE_DIR, csv_file=CSV_FILE, graph_path=GRAPH_CACHE, top_k=TOP_K,
+                    force=(), full=False, streaming=None, memory_limit_mb=MEMORY_LIMIT_MB):
+    """CSV の変更点だけを反映して距離行列と各災害のランキングを更新する
+
+    force に渡した災害は変更がなくても作り直す。full=True で全避難所の距離を計算し直す
+    （道路グラフが変わった場合など）。streaming=None のときは距離行列が memory_limit_mb を
+    超える場合だけ逐次計算 (streaming.py) に切り替える。True / False で常に使う・使わない。
+    """
+    df = read_shelters(csv_file)
+    hazards = hazard_columns(df)
+    distances = load_distances(cache_dir)
+    manifest = load_manifest(cache_dir)
+
+    if distances is None or manifest is None or full:
+        if not full:
+            print("⚠️ 前回の目録がないため、全避難所の距離を計算します。")
+        source = np.full(len(df), -1, dtype=np.int64)
+        moved_from = source.copy()
+        removed = []
+        old_nodes = []
+    else:
+        source, moved_from, removed = diff_shelters(df, manifest)
+        old_nodes = [s['node'] for s in manifest["shelters"]]
+
+    # 追加・移動された避難所だけ道路ノードに紐づけ、ノードが変わったものだけ距離を計算する
+    shelter_nodes = np.array([old_nodes[j] if j >= 0 else -1 for j in source], dtype=np.int64)
+    pending = np.flatnonzero(source < 0)
+    n_pending = len(pending)
+    computed = 0
+    if len(pending):
+        from build_graph import load_graph
+        table = load_graph(graph_path, cache_dir)
+        csr, node_ids = table_to_csr(table)
+        if distances is not None and not np.array_equal(node_ids, distances.node_ids):
+            print("⚠️ 道路グラフが変わっているため、全避難所の距離を計算し直します。")
+            source[:] = -1
+            moved_from[:] = -1
+            full = True
+            pending = np.arange(len(df))
+            n_pending = len(pending)
+
+        idx = snap_shelters(table, df.iloc[pending])
+        shelter_nodes[pending] = node_ids[idx]
+        for i in pending:
+            j = moved_from[i]
+            if j >= 0 and old_nodes[j] == shelter_nodes[i]:
+                source[i] = j  # 移動しても最寄りノードが同じなら距離はそのまま使える
+        computed = int((source < 0).sum())
+    else:
+        node_ids = np.asarray(distances.node_ids)
+
+    # 行番号（避難所ID）が変わった行・距離を計算し直した行・フラグが変わった行・
+    # 削除された行のいずれかを含む災害だけランキングを作り直す
+    changed = source != np.arange(len(df))
+    old_shelters = manifest["shelters"] if manifest is not None else []
+    dirty = []
+    for col in hazards + [ALL_SHELTERS]:
+        if full or col in force:
+            dirty.append(col)
+            continue
+        active = hazard_active(df, col)
+        was_active = np.array([j >= 0 and _was_active(old_shelters[j], col) for j in source], dtype=bool)
+        removed_active = any(_was_active(old_shelters[j], col) for j in removed)
+        has_store = os.path.exists(os.path.join(store_path(col, cache_dir), "ranks.npy"))
+        if (changed & active).any() or (active != was_active).any() or removed_active or not has_store:
+            dirty.append(col)
+
+    if streaming is None:
+        streaming = dense_bytes(len(df), len(node_ids)) > memory_limit_mb * 2**20
+    if streaming:
+        # 距離行列をメモリに載せず、避難所のかたまりごとに計算してファイルへ書き出す
+        rows, block = stream_rankings(
+            csr if computed else None, node_ids, np.searchsorted(node_ids, shelter_nodes), df.index,
+            {col: hazard_active(df, col) for col in dirty if col != ALL_SHELTERS}, cache_dir, top_k,
+            memory_limit_mb, reuse=(distances, source) if distances is not None else None,
+        )
+        if ALL_SHELTERS in dirty:
+            # 全避難所のランキングは保存する順位の数が違うので、書き出した距離行列から作る
+            stream_rankings(None, node_ids, None, df.index, {ALL_SHELTERS: hazard_active(df, ALL_SHELTERS)},
+                            cache_dir, MASTER_TOP_K, memory_limit_mb,
+                            reuse=(load_distances(cache_dir), np.arange(len(df))), write_distances=False)
+        print(f"距離行列を {rows} 件ずつ、ノード {block} 件ごとに計算しました（上限 {memory_limit_mb} MB）")
+    else:
+        dist = np.empty((len(df), len(node_ids)), dtype=np.float32)
+        # 最短経路木（経路の復元用）は、再利用する行の分も保存済みのものがある場合だけ作る
+        reused = source >= 0
+        pred = np.empty(dist.shape, dtype=np.int32) if not reused.any() or distances.pred is not None else None
+        if pred is None:
+            print("⚠️ 保存済みの最短経路木がないため、経路は保存しません（--full で作り直すと経路も保存されます）。")
+        if computed:
+            result = shelter_distance_matrix(
+                csr, np.searchsorted(node_ids, shelter_nodes[~reused]), workers=WORKERS,
+                predecessors=pred is not None,
+            )
+            if pred is None:
+                dist[~reused] = result
+            else:
+                dist[~reused], pred[~reused] = result
+        if reused.any():
+            dist[reused] = distances.dist[source[reused]]
+            if pred is not None:
+                pred[reused] = distances.pred[source[reused]]
+        save_distances(node_ids, df.index, dist, cache_dir, pred)
+        for col in dirty:
+            save_rankings(store_path(col, cache_dir), node_ids, dist, df.index,
+                          hazard_active(df, col), MASTER_TOP_K if col == ALL_SHELTERS else top_k)
+    save_manifest(shelter_manifest(df, shelter_nodes), cache_dir)
+    record_artifacts(["distances"] + [f"ranks_{col}" for col in dirty], df, cache_dir, graph_path, csv_file)
+
+    print(f"追加・移動: {n_pending} 件 (距離を計算: {computed} 件), 削除: {len(removed)} 件")
+    print(f"✅ ランキングを更新した災害: {', '.join(dirty) if dirty else 'なし'}")
+    return dirty
+
+if __name__ == "__main__":
+    # 使い方: python update_ranks.py [キャッシュフォルダ] [メモリ上限 MB] [--full]
+    # --full で全避難所の距離と最短経路木を計算し直す（経路の保存がない古いキャッシュの作り直しなど）
+    args = [a for a in sys.argv[1:] if a != "--full"]
+    update_rankings(args[0] if len(args) > 0 else RESULT_CACHE_DIR,
+                    memory_limit_mb=float(args[1]) if len(args) > 1 else MEMORY_LIMIT_MB,
+                    full="--full" in sys.argv[1:])